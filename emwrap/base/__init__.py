@@ -16,4 +16,5 @@
 
 from .processing_pipeline import ProcessingPipeline
 from .project_manager import ProjectManager
-from .config import ProcessingConfig
\ No newline at end of file
+from .config import ProcessingConfig
+from .image_dims import ImageDims
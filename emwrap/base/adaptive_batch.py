@@ -0,0 +1,183 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import time
+import queue
+import threading
+
+from emtools.jobs import BatchManager
+
+_END = object()
+
+
+class AdaptiveBatchManager(BatchManager):
+    """ BatchManager that chooses the size of each batch.
+
+    Input items are read in a background thread, so a batch can be
+    created when items wait for too long, even if no new items arrive.
+    The size of each batch is chosen as follows:
+        - startup: until some batches are done, use minSize to get
+          results soon
+        - backlog: if there are more items waiting than the target size,
+          or batches waiting in the output queue, use up to maxSize
+          items to reduce the per-batch overhead
+        - rate: otherwise, the largest size that can be collected and
+          processed within maxLatency seconds, given the input arrival
+          rate and the measured per-item processing time
+        - latency: if the oldest waiting item has waited maxLatency
+          seconds minus the expected processing time, create a batch
+          with the waiting items
+    """
+    def __init__(self, batchSize, inputItemsIterator, workingPath,
+                 minSize=None, maxSize=None, maxLatency=600,
+                 queueDepth=None, log=print, **kwargs):
+        """
+        Args:
+            batchSize: initial target size
+            minSize: minimum batch size (except for the last one),
+                by default batchSize / 4
+            maxSize: maximum batch size, by default batchSize * 4
+            maxLatency: seconds from the arrival of an item until its
+                batch should be processed
+            queueDepth: function returning the number of batches waiting
+                to be processed
+            log: function used to log the size chosen for each batch
+        Other arguments are passed to BatchManager.
+        """
+        BatchManager.__init__(self, batchSize, inputItemsIterator, workingPath, **kwargs)
+        self.minSize = max(1, int(minSize or batchSize // 4))
+        self.maxSize = max(self.minSize, int(maxSize or batchSize * 4))
+        self.maxLatency = maxLatency
+        self.queueDepth = queueDepth or (lambda: 0)
+        self.log = log
+        self._inputQueue = queue.Queue()
+        self._lock = threading.Lock()
+        self._arrival = None  # EMA of seconds between arrivals
+        self._lastArrival = None
+        self._itemTime = None  # EMA of processing seconds per item
+        self._done = 0  # batches recorded as done
+        self._created = {}  # batch id -> creation time
+
+    @staticmethod
+    def _ema(old, value, alpha=0.2):
+        return value if old is None else alpha * value + (1 - alpha) * old
+
+    def _readItems(self):
+        for item in self._items:
+            now = time.time()
+            with self._lock:
+                if self._lastArrival is not None:
+                    self._arrival = self._ema(self._arrival, now - self._lastArrival)
+                self._lastArrival = now
+            self._inputQueue.put((now, item))
+        self._inputQueue.put((None, _END))
+
+    def record(self, items, elapsed):
+        """ Record the time (seconds) that took to process a batch
+        with the given number of items. """
+        if items:
+            with self._lock:
+                self._itemTime = self._ema(self._itemTime, elapsed / items)
+                self._done += 1
+
+    def batchDone(self, batch):
+        """ Record a batch created by this manager as processed. The
+        processing time is taken from its creation until now. """
+        with self._lock:
+            created = self._created.pop(batch['id'], None)
+        if created is not None:
+            self.record(len(batch['items']), time.time() - created)
+
+    def target(self, waiting):
+        """ Return the target size and the reason for it, given
+        the number of items waiting. """
+        with self._lock:
+            arrival, itemTime, done = self._arrival, self._itemTime, self._done
+
+        if done == 0:
+            return self.minSize, 'startup'
+
+        if waiting > self.minSize and (self.queueDepth() > 0 or waiting >= self._rateSize(arrival, itemTime)):
+            return max(self.minSize, min(waiting, self.maxSize)), 'backlog'
+
+        return self._rateSize(arrival, itemTime), 'rate'
+
+    def _rateSize(self, arrival, itemTime):
+        # Collecting n items takes n * arrival and processing them n * itemTime
+        perItem = (arrival or 0) + (itemTime or 0)
+        n = int(self.maxLatency / perItem) if perItem else self.maxSize
+        return max(self.minSize, min(n, self.maxSize))
+
+    def _deadline(self, firstArrival):
+        """ Time when the waiting items should go in a batch. """
+        with self._lock:
+            itemTime = self._itemTime or 0
+        return firstArrival + max(0, self.maxLatency - itemTime * self.minSize)
+
+    def _describe(self, size, reason, waiting):
+        with self._lock:
+            arrival, itemTime = self._arrival, self._itemTime
+
+        def _fmt(v):
+            return 'n/a' if v is None else '%0.1fs' % v
+
+        return (f"Batch size: {size} ({reason}), waiting items: {waiting}, "
+                f"queued batches: {self.queueDepth()}, "
+                f"arrival: {_fmt(arrival)}/item, processing: {_fmt(itemTime)}/item")
+
+    def generate(self):
+        """ Generate batches based on the input items. """
+        threading.Thread(target=self._readItems, daemon=True).start()
+        items = []  # (arrival time, item) pairs
+        finished = False
+
+        while not finished:
+            if items:
+                timeout = max(0, self._deadline(items[0][0]) - time.time())
+            else:
+                timeout = None
+            try:
+                arrival, item = self._inputQueue.get(timeout=timeout)
+                if item is _END:
+                    finished = True
+                else:
+                    items.append((arrival, item))
+                    # Take all items already waiting
+                    while True:
+                        arrival, item = self._inputQueue.get_nowait()
+                        if item is _END:
+                            finished = True
+                            break
+                        items.append((arrival, item))
+            except queue.Empty:
+                pass
+
+            while items:
+                size, reason = self.target(len(items))
+                if finished:
+                    reason = 'last'
+                elif len(items) < size:
+                    # Wait for more items until the oldest one reaches the deadline
+                    if time.time() < self._deadline(items[0][0]):
+                        break
+                    reason = 'latency'
+                self.log(self._describe(min(size, len(items)), reason, len(items)))
+                batchItems = [item for _, item in items[:size]]
+                items = items[size:]
+                batch = self._createBatch(batchItems)
+                with self._lock:
+                    self._created[batch['id']] = time.time()
+                yield batch
@@ -0,0 +1,333 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import time
+import ctypes
+import ctypes.util
+import struct
+from fnmatch import fnmatch
+from glob import has_magic
+
+# Filesystems where inotify will not report changes made from other hosts
+NETWORK_FS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'lustre', 'gpfs',
+              'beegfs', 'ceph', 'panfs', 'fuse.sshfs', 'fuse.glusterfs'}
+
+
+def _splitall(path):
+    parts = []
+    while True:
+        head, tail = os.path.split(path)
+        if head == path:  # absolute path root
+            parts.insert(0, head)
+            break
+        if tail == path:  # relative path first part
+            parts.insert(0, tail)
+            break
+        path = head
+        if tail:
+            parts.insert(0, tail)
+    return parts
+
+
+def _fstype(path):
+    """ Return the filesystem type of the mount containing path. """
+    path = os.path.realpath(path)
+    fstype, mountLen = None, -1
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mnt = parts[1]
+                if (path == mnt or path.startswith(mnt.rstrip('/') + '/')) and len(mnt) > mountLen:
+                    fstype, mountLen = parts[2], len(mnt)
+    except OSError:
+        pass
+    return fstype
+
+
+class FileWatcher:
+    """ Watch for new files matching a glob pattern.
+
+    The pattern is split into a fixed root folder and the pattern parts
+    below it. Watchers keep track of the entries already seen in each
+    matching directory, so each call to newFiles() only returns files
+    that appeared since the previous call. The first call returns all
+    existing files, as glob would do.
+    """
+    name = 'base'
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        parts = _splitall(pattern)
+        rootParts = []
+        for p in parts:
+            if has_magic(p):
+                break
+            rootParts.append(p)
+        self._parts = parts[len(rootParts):]
+        if not self._parts:  # Not a pattern, just watch a single file
+            self._parts = rootParts[-1:]
+            rootParts = rootParts[:-1]
+        self._root = os.path.join(*rootParts) if rootParts else '.'
+        self._prefix = os.path.join(*rootParts) if rootParts else ''
+        self._last = len(self._parts) - 1
+        # Map directory path to (depth, set of seen entries)
+        self._dirs = {}
+
+    def _match(self, name, depth):
+        p = self._parts[depth]
+        if name.startswith('.') and not p.startswith('.'):
+            return False
+        return fnmatch(name, p)
+
+    def _path(self, parent, name):
+        return os.path.join(parent, name) if parent else name
+
+    def _scanDir(self, dirPath, depth, newFiles):
+        """ List dirPath and register new entries. New matching files are
+        added to newFiles and new matching sub-directories are scanned.
+        """
+        listPath = dirPath or '.'
+        seen = self._dirs.setdefault(dirPath, (depth, set()))[1]
+        try:
+            entries = list(os.scandir(listPath))
+        except (FileNotFoundError, NotADirectoryError):
+            self._forget(dirPath)
+            return
+        current = set()
+        for entry in entries:
+            name = entry.name
+            current.add(name)
+            if name in seen or not self._match(name, depth):
+                continue
+            path = self._path(dirPath, name)
+            if depth < self._last:
+                if entry.is_dir():
+                    self._addDir(path, depth + 1, newFiles)
+            elif not entry.is_dir():
+                newFiles.append(path)
+        # Keep only existing entries, so re-created files are detected
+        seen.intersection_update(current)
+        seen.update(current)
+
+    def _addDir(self, dirPath, depth, newFiles):
+        self._scanDir(dirPath, depth, newFiles)
+
+    def _forget(self, dirPath):
+        for d in [d for d in self._dirs
+                  if d == dirPath or d.startswith(dirPath + os.sep)]:
+            del self._dirs[d]
+
+    def newFiles(self):
+        """ Return the list of new files matching the pattern. """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    @classmethod
+    def create(cls, pattern, backend='auto'):
+        """ Create a watcher for the given pattern.
+
+        Args:
+            pattern: glob pattern of the files to watch
+            backend: 'inotify', 'poll' or 'auto'. With 'auto', inotify will be
+                used if available and the root folder is not in a network
+                filesystem (where events from other hosts are not reported).
+        """
+        if backend == 'auto':
+            watcher = PollingWatcher(pattern)
+            if InotifyWatcher.available() and _fstype(watcher._root) not in NETWORK_FS:
+                backend = 'inotify'
+            else:
+                return watcher
+
+        if backend == 'inotify':
+            try:
+                return InotifyWatcher(pattern)
+            except OSError:
+                return PollingWatcher(pattern)
+        elif backend == 'poll':
+            return PollingWatcher(pattern)
+
+        raise Exception(f"Unknown file watcher backend: {backend}")
+
+
+class PollingWatcher(FileWatcher):
+    """ Polling watcher that only lists directories whose modification
+    time has changed since the last check. """
+    name = 'poll'
+    MTIME_RESOLUTION = 2 * 10**9  # ns
+
+    def __init__(self, pattern):
+        FileWatcher.__init__(self, pattern)
+        self._mtimes = {}
+
+    def _scanDir(self, dirPath, depth, newFiles):
+        # Store the modification time before listing, files created
+        # during the listing will change it again and will be caught
+        # in the next check
+        try:
+            mtime = os.stat(dirPath or '.').st_mtime_ns
+        except FileNotFoundError:
+            self._forget(dirPath)
+            return
+        # Some filesystems have coarse timestamps, so a directory modified
+        # very recently is always listed again in the next check
+        recent = time.time_ns() - mtime < self.MTIME_RESOLUTION
+        self._mtimes[dirPath] = None if recent else mtime
+        FileWatcher._scanDir(self, dirPath, depth, newFiles)
+
+    def _forget(self, dirPath):
+        FileWatcher._forget(self, dirPath)
+        for d in [d for d in self._mtimes if d not in self._dirs]:
+            del self._mtimes[d]
+
+    def newFiles(self):
+        newFiles = []
+        if not self._dirs:
+            self._scanDir(self._prefix, 0, newFiles)
+        else:
+            for dirPath, (depth, _) in list(self._dirs.items()):
+                if dirPath not in self._dirs:  # Removed in this loop
+                    continue
+                try:
+                    mtime = os.stat(dirPath or '.').st_mtime_ns
+                except FileNotFoundError:
+                    self._forget(dirPath)
+                    continue
+                if mtime != self._mtimes.get(dirPath):
+                    self._scanDir(dirPath, depth, newFiles)
+        return newFiles
+
+
+class InotifyWatcher(FileWatcher):
+    """ Watcher based on Linux inotify events (through libc). """
+    name = 'inotify'
+
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = (IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM |
+            IN_DELETE_SELF | IN_MOVE_SELF)
+
+    _EVENT = struct.Struct('iIII')
+    _libc = None
+
+    @classmethod
+    def _getLibc(cls):
+        if cls._libc is None:
+            cls._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                    use_errno=True)
+        return cls._libc
+
+    @classmethod
+    def available(cls):
+        try:
+            return hasattr(cls._getLibc(), 'inotify_init1')
+        except OSError:
+            return False
+
+    def __init__(self, pattern):
+        FileWatcher.__init__(self, pattern)
+        self._fd = self._getLibc().inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._wds = {}  # Map watch descriptors to directory paths
+        self._started = False
+
+    def _addDir(self, dirPath, depth, newFiles):
+        # Add the watch before listing, so no entry is missed
+        wd = self._getLibc().inotify_add_watch(
+            self._fd, os.fsencode(dirPath or '.'), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {dirPath}")
+        self._wds[wd] = dirPath
+        self._scanDir(dirPath, depth, newFiles)
+
+    def _forget(self, dirPath):
+        FileWatcher._forget(self, dirPath)
+        for wd in [wd for wd, d in self._wds.items() if d not in self._dirs]:
+            self._getLibc().inotify_rm_watch(self._fd, wd)
+            del self._wds[wd]
+
+    def _readEvents(self):
+        try:
+            data = os.read(self._fd, 1024 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        i = 0
+        while i + self._EVENT.size <= len(data):
+            wd, mask, _, nameLen = self._EVENT.unpack_from(data, i)
+            i += self._EVENT.size
+            name = data[i:i + nameLen].rstrip(b'\0')
+            i += nameLen
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def newFiles(self):
+        newFiles = []
+        if not self._started:
+            # The root folder might not have been created yet
+            if os.path.isdir(self._root):
+                self._started = True
+                self._addDir(self._prefix, 0, newFiles)
+            return newFiles
+
+        while events := self._readEvents():
+            for wd, mask, name in events:
+                if mask & self.IN_Q_OVERFLOW:
+                    # Events were lost, rescan all known directories
+                    for dirPath, (depth, _) in list(self._dirs.items()):
+                        if dirPath in self._dirs:
+                            self._scanDir(dirPath, depth, newFiles)
+                    continue
+                dirPath = self._wds.get(wd, None)
+                if dirPath is None or dirPath not in self._dirs:
+                    continue
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                    self._forget(dirPath)
+                    continue
+                depth, seen = self._dirs[dirPath]
+                if mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                    # Forget removed entries, so re-created files are detected
+                    seen.discard(name)
+                    continue
+                if name in seen or not self._match(name, depth):
+                    continue
+                seen.add(name)
+                path = self._path(dirPath, name)
+                if depth < self._last:
+                    if mask & self.IN_ISDIR:
+                        self._addDir(path, depth + 1, newFiles)
+                elif not mask & self.IN_ISDIR:
+                    newFiles.append(path)
+        return newFiles
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
@@ -0,0 +1,197 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import atexit
+import socket
+import subprocess
+from contextlib import contextmanager
+
+GPUS_VAR = 'EMWRAP_LEASE_GPUS'
+
+
+def list_gpus():
+    """ Ids of the GPUs in this host, from EMWRAP_LEASE_GPUS,
+    CUDA_VISIBLE_DEVICES or nvidia-smi. """
+    for var in [GPUS_VAR, 'CUDA_VISIBLE_DEVICES']:
+        if (devices := os.environ.get(var, None)) is not None:
+            return [int(d) for d in devices.replace(',', ' ').split()]
+    try:
+        result = subprocess.run(['nvidia-smi', '-L'], capture_output=True, text=True)
+        return list(range(sum(1 for line in result.stdout.splitlines()
+                              if line.startswith('GPU'))))
+    except OSError:
+        return []
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class GpuLeaseManager:
+    """ Lease GPUs of a host to the jobs of a project running on it.
+
+    The state is a JSON file per host in the project folder
+    (.emw_gpus/<host>.json), only modified while holding a file lock,
+    so no daemon is needed. Requests wait until enough GPUs are free,
+    and they are served by priority (higher first) and then by arrival,
+    so GPUs are reserved for earlier requests instead of being taken by
+    smaller ones. Leases of processes that are not alive are removed.
+    """
+    FOLDER = '.emw_gpus'
+
+    def __init__(self, path, gpus=None, host=None):
+        """
+        Args:
+            path: project folder
+            gpus: ids of the GPUs to lease, by default all GPUs of the host
+            host: host name, by default the current one
+        """
+        self.folder = os.path.join(path, self.FOLDER)
+        self.host = host or socket.gethostname()
+        self._gpus = gpus
+
+    @property
+    def gpus(self):
+        if self._gpus is None:
+            self._gpus = list_gpus()
+        return self._gpus
+
+    def _file(self, ext):
+        return os.path.join(self.folder, f'{self.host}.{ext}')
+
+    @staticmethod
+    def _read(fn):
+        try:
+            with open(fn) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'leases': {}, 'waiting': {}}
+
+    @contextmanager
+    def _state(self):
+        """ Load the state of this host, holding the lock until it is saved. """
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self._file('lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._read(self._file('json'))
+            # Forget requests of processes that finished without releasing
+            for section in state.values():
+                for leaseId in [k for k, v in section.items() if not _pid_alive(v['pid'])]:
+                    del section[leaseId]
+            yield state
+            tmp = self._file('json.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp, self._file('json'))
+
+    def _grant(self, state, leaseId):
+        """ Return the GPUs for a waiting request if it can be served now. """
+        used = {g for lease in state['leases'].values() for g in lease['gpus']}
+        free = [g for g in self.gpus if g not in used]
+        reserved = 0  # GPUs for requests before this one
+        waiting = sorted(state['waiting'].items(),
+                         key=lambda item: (-item[1]['priority'], item[1]['time']))
+        for wId, request in waiting:
+            if wId == leaseId:
+                if request['n'] > len(free) - reserved:
+                    return None
+                gpus = free[reserved:reserved + request['n']]
+                del state['waiting'][leaseId]
+                state['leases'][leaseId] = dict(request, gpus=gpus, start=time.time())
+                return gpus
+            reserved += request['n']
+        return None
+
+    def acquire(self, n, priority=0, owner='', timeout=None, wait=5):
+        """ Wait until n GPUs are leased.
+
+        Args:
+            n: number of GPUs
+            priority: requests with higher priority are served first
+            owner: description of the requester (e.g. job id)
+            timeout: maximum seconds to wait (None to wait forever)
+            wait: seconds between checks
+        Returns:
+            (leaseId, gpus) tuple, the lease id should be used to release it.
+        """
+        if n > len(self.gpus):
+            raise Exception(f"Can not lease {n} GPUs, there are only "
+                            f"{len(self.gpus)} in {self.host}.")
+        leaseId = uuid.uuid4().hex[:12]
+        request = {'owner': owner, 'pid': os.getpid(), 'n': n,
+                   'priority': priority, 'time': time.time()}
+        with self._state() as state:
+            state['waiting'][leaseId] = request
+
+        start = time.time()
+        while True:
+            with self._state() as state:
+                if leaseId not in state['waiting']:
+                    state['waiting'][leaseId] = request
+                gpus = self._grant(state, leaseId)
+                timedOut = (gpus is None and timeout is not None
+                            and time.time() - start > timeout)
+                if timedOut:
+                    del state['waiting'][leaseId]
+            if gpus is not None:
+                return leaseId, gpus
+            if timedOut:
+                raise Exception(f"Timeout waiting for {n} GPUs after {timeout} seconds.")
+            time.sleep(wait)
+
+    def release(self, leaseId):
+        """ Release a lease (or cancel a waiting request). """
+        with self._state() as state:
+            for section in state.values():
+                section.pop(leaseId, None)
+
+    def status(self):
+        """ Return a list of (host, state) for all hosts with leases. The
+        state of the current host is cleaned from finished processes. """
+        result = []
+        if not os.path.exists(self.folder):
+            return result
+        for fn in sorted(os.listdir(self.folder)):
+            if fn.endswith('.json'):
+                host = fn[:-5]
+                if host == self.host:
+                    with self._state() as state:
+                        pass
+                else:
+                    state = self._read(os.path.join(self.folder, fn))
+                if state['leases'] or state['waiting']:
+                    result.append((host, state))
+        return result
+
+
+def lease_gpus(path, n, priority=0, owner=''):
+    """ Lease n GPUs in the project path for the current process, and
+    release them when it exits. Return the list of GPU ids. """
+    manager = GpuLeaseManager(path)
+    leaseId, gpus = manager.acquire(n, priority=priority, owner=owner)
+    atexit.register(manager.release, leaseId)
+    return gpus
@@ -0,0 +1,159 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from emtools.image import Image
+
+
+class ImageDims:
+    """ Process-wide cache of image dimensions.
+
+    Entries are keyed by (path, size, mtime), so a file that is rewritten
+    will be read again. Only the headers of MRC, TIFF and EER files are
+    parsed; other formats are delegated to Image.get_dimensions.
+    Dimensions are always returned as a (x, y, n) tuple.
+    """
+    MRC_EXT = {'.mrc', '.mrcs', '.st', '.ali', '.rec', '.map'}
+    TIFF_EXT = {'.tif', '.tiff', '.eer'}
+    MAX_SIZE = 100000
+
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+    hits = misses = 0
+
+    @classmethod
+    def _key(cls, path):
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+    @classmethod
+    def get_dimensions(cls, path):
+        """ Return the (x, y, n) dimensions of the given image file. """
+        key = cls._key(path)
+        with cls._lock:
+            if (dims := cls._cache.get(key)) is not None:
+                cls._cache.move_to_end(key)
+                cls.hits += 1
+                return dims
+            cls.misses += 1
+
+        dims = cls.read_dimensions(path)
+        with cls._lock:
+            cls._cache[key] = dims
+            if len(cls._cache) > cls.MAX_SIZE:
+                cls._cache.popitem(last=False)
+        return dims
+
+    @classmethod
+    def get_dimensions_many(cls, paths, workers=8):
+        """ Return a dict with the dimensions of many files, stat'ing and
+        reading headers in parallel. Missing or unreadable files get None.
+        """
+        def _get(path):
+            try:
+                return cls.get_dimensions(path)
+            except Exception:
+                return None
+
+        paths = list(dict.fromkeys(paths))
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths)))) as executor:
+            return dict(zip(paths, executor.map(_get, paths)))
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._cache.clear()
+            cls.hits = cls.misses = 0
+
+    @classmethod
+    def read_dimensions(cls, path):
+        """ Read the dimensions from the file header (no caching). """
+        ext = os.path.splitext(path)[1].lower()
+        dims = None
+        try:
+            with open(path, 'rb') as f:
+                if ext in cls.MRC_EXT:
+                    dims = cls._read_mrc(f)
+                elif ext in cls.TIFF_EXT:
+                    dims = cls._read_tiff(f)
+        except (struct.error, ValueError, KeyError):
+            dims = None
+
+        if dims is None:
+            dims = tuple(Image.get_dimensions(path))
+            if len(dims) == 2:
+                dims = dims + (1,)
+        return dims
+
+    @staticmethod
+    def _read_mrc(f):
+        header = f.read(12)
+        for endian in '<>':
+            x, y, n = struct.unpack(endian + '3i', header)
+            if 0 < x < 2**20 and 0 < y < 2**20 and 0 < n < 2**24:
+                return x, y, n
+        return None
+
+    @staticmethod
+    def _read_tiff(f):
+        """ Parse classic and BigTIFF headers, the number of frames
+        is the number of IFDs (as in EER files). """
+        header = f.read(16)
+        endian = {b'II': '<', b'MM': '>'}.get(header[:2])
+        if endian is None:
+            return None
+        version = struct.unpack(endian + 'H', header[2:4])[0]
+        if version == 42:
+            offset = struct.unpack(endian + 'I', header[4:8])[0]
+            countFmt, entryFmt, entrySize, offsetFmt = 'H', 'HHI4s', 12, 'I'
+        elif version == 43:
+            offset = struct.unpack(endian + 'Q', header[8:16])[0]
+            countFmt, entryFmt, entrySize, offsetFmt = 'Q', 'HHQ8s', 20, 'Q'
+        else:
+            return None
+
+        countSize = struct.calcsize(countFmt)
+        offsetSize = struct.calcsize(offsetFmt)
+        x = y = None
+        n = 0
+        seen = set()
+        while offset and offset not in seen:
+            seen.add(offset)
+            f.seek(offset)
+            count = struct.unpack(endian + countFmt, f.read(countSize))[0]
+            if x is None:
+                data = f.read(count * entrySize)
+                for i in range(count):
+                    tag, typ, _, value = struct.unpack_from(endian + entryFmt, data, i * entrySize)
+                    if tag in (256, 257):
+                        # SHORT, LONG or LONG8 values are stored inline
+                        fmt = {3: 'H', 4: 'I', 16: 'Q'}[typ]
+                        v = struct.unpack_from(endian + fmt, value)[0]
+                        if tag == 256:
+                            x = v
+                        else:
+                            y = v
+            else:
+                f.seek(count * entrySize, os.SEEK_CUR)
+            offset = struct.unpack(endian + offsetFmt, f.read(offsetSize))[0]
+            n += 1
+
+        return (x, y, n) if x and y else None
@@ -19,14 +19,134 @@ import os
 import argparse
 import shutil
 import time
-from glob import glob
+import queue
 import threading
+from fnmatch import fnmatch
 from datetime import datetime
 
 from emtools.utils import Color, Pretty, Path, FolderManager
 from emtools.metadata import Acquisition, StarFile, RelionStar, Table
 
 from emwrap.base import ProcessingPipeline
+from emwrap.base.file_watcher import FileWatcher
+
+
+class EpuMetadataCopier:
+    """ Copy EPU metadata (movies XML and GridSquare files) from a pool of
+    background threads, so the movies registration never waits on a
+    slow share. Grid square folders are found through an in-memory index
+    of the input root, only re-listing folders that have been modified.
+    """
+    GS_PATTERN = 'GridSquare_*.???'
+
+    def __init__(self, patternRoot, xmlFolder, gsFolder, workers=4, maxQueue=10000):
+        self.patternRoot = patternRoot
+        self.xmlFolder = xmlFolder
+        self.gsFolder = gsFolder
+        self.stats = {'submitted': 0, 'copied': 0, 'missing': 0, 'failed': 0}
+        self._queue = queue.Queue(maxsize=maxQueue)
+        self._lock = threading.Lock()
+        self._indexLock = threading.Lock()
+        self._copiedGs = set()
+        self._gsIndex = {}  # grid square name -> list of folders
+        self._mtimes = {}  # input root sub-folder -> mtime when indexed
+        self._threads = [threading.Thread(target=self._worker, daemon=True)
+                         for _ in range(workers)]
+        for th in self._threads:
+            th.start()
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _submit(self, func, *args):
+        self._count('submitted')
+        self._queue.put((func, args))
+
+    def _worker(self):
+        while (task := self._queue.get()) is not None:
+            func, args = task
+            try:
+                func(*args)
+            except Exception as e:
+                self._count('failed')
+                print(Color.red(f"ERROR copying EPU metadata {args}: {e}"))
+            finally:
+                self._queue.task_done()
+        self._queue.task_done()
+
+    def copyXml(self, absXml, prefix):
+        self._submit(self._copyXml, absXml, prefix)
+
+    def _copyXml(self, absXml, prefix):
+        try:
+            shutil.copy(absXml, self.xmlFolder.join(f'{prefix}.xml'))
+            self._count('copied')
+        except FileNotFoundError:
+            self._count('missing')
+
+    def newBatch(self):
+        """ Grid square files are copied again for every new batch of
+        movies, in case EPU has updated them. """
+        with self._lock:
+            self._copiedGs.clear()
+
+    def copyGridSquare(self, gs):
+        """ Copy the files of this grid square, unless already done. """
+        with self._lock:
+            if gs in self._copiedGs:
+                return
+            self._copiedGs.add(gs)
+        self._submit(self._copyGridSquare, gs)
+
+    def _copyGridSquare(self, gs):
+        gsFiles = []
+        for gsDir in self._gridSquareDirs(gs):
+            gsFiles.extend(os.path.join(gsDir, fn) for fn in os.listdir(gsDir)
+                           if fnmatch(fn, self.GS_PATTERN))
+        if not gsFiles:
+            # Files might not be there yet, try again with the next movie
+            with self._lock:
+                self._copiedGs.discard(gs)
+            return
+        gsSubFolder = self.gsFolder.mkdir(gs)
+        for gsFn in gsFiles:
+            print(f"   Copying: {gsFn} to {gsSubFolder}")
+            shutil.copy(gsFn, gsSubFolder)
+        self._count('copied', len(gsFiles))
+
+    def _gridSquareDirs(self, gs):
+        """ Equivalent to glob(patternRoot/*/gs) but using the index. """
+        with self._indexLock:
+            if gs not in self._gsIndex:
+                self._updateIndex()
+            return list(self._gsIndex.get(gs, []))
+
+    def _updateIndex(self):
+        for entry in os.scandir(self.patternRoot):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            mtime = entry.stat().st_mtime_ns
+            if self._mtimes.get(entry.path) == mtime:
+                continue
+            self._mtimes[entry.path] = mtime
+            for sub in os.scandir(entry.path):
+                if sub.is_dir():
+                    dirs = self._gsIndex.setdefault(sub.name, [])
+                    if sub.path not in dirs:
+                        dirs.append(sub.path)
+
+    @property
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def wait(self):
+        """ Wait for all pending copies and stop the threads. """
+        self._queue.join()
+        for _ in self._threads:
+            self._queue.put(None)
+        for th in self._threads:
+            th.join()
 
 
 class ImportMoviesPipeline(ProcessingPipeline):
@@ -43,6 +163,8 @@ class ImportMoviesPipeline(ProcessingPipeline):
             'file_change': args.get('file_change', 60),  # 1 min
             'sleep': args.get('sleep', 60),
         }
+        # File discovery backend: auto, inotify or poll
+        self.watcherBackend = args.get('watcher', 'auto')
         self.outputStar = self.join('movies.star')
         self.pattern = args[self.input_name]
         rootParts = []
@@ -68,14 +190,21 @@ class ImportMoviesPipeline(ProcessingPipeline):
             self.mkdir('EPU', 'GridSquares')
             os.symlink(self.patternRoot, self.join('Movies', 'input'))
 
-        xmlFolder = FolderManager(self.join('EPU', 'XML'))
-        gsFolder = FolderManager(self.join('EPU', 'GridSquares'))
+        copier = EpuMetadataCopier(self.patternRoot,
+                                   FolderManager(self.join('EPU', 'XML')),
+                                   FolderManager(self.join('EPU', 'GridSquares')),
+                                   workers=int(self._args.get('copy_workers', 4)))
 
         self.log(f">>>> STARTING RUN: Monitoring movies with pattern: {Color.cyan(self.pattern)}")
         self.log(f"Existing movies: {Color.cyan(len(allMovies))}")
 
         self.log(f"Input root: {self.patternRoot}", flush=True)
 
+        # Only new files are reported by the watcher, avoiding a full
+        # glob of the input folder in every iteration
+        watcher = FileWatcher.create(self.pattern, backend=self.watcherBackend)
+        self.log(f"File watcher: {Color.cyan(watcher.name)}")
+
         now = lastUpdate = datetime.now()
 
         def _new_file(fn):
@@ -99,7 +228,7 @@ class ImportMoviesPipeline(ProcessingPipeline):
         while (now - lastUpdate).seconds < self.wait['timeout']:
             now = datetime.now()
             newFiles = [(fn, os.path.getmtime(fn))
-                        for fn in glob(self.pattern) if _new_file(fn)]
+                        for fn in watcher.newFiles() if _new_file(fn)]
             if newFiles:
                 self.log(f"Found {len(newFiles)} new files", flush=True)
 
@@ -117,7 +246,7 @@ class ImportMoviesPipeline(ProcessingPipeline):
                                              'GridSquare'])
                         sf.writeHeader('movies', moviesTable)
 
-                    copiedGs = set()
+                    copier.newBatch()
                     # Sort new files base on modification time
                     for fn, mt in sorted(newFiles, key=lambda x: x[1]):
                         nextId += 1
@@ -138,21 +267,20 @@ class ImportMoviesPipeline(ProcessingPipeline):
                             sf.flush()
                             unwritten = 0
                         allMovies.add(fn)
-                        absXml = absFn.replace(suffix, '.xml')
-
-                        if os.path.exists(absXml):
-                            shutil.copy(absXml, xmlFolder.join(f'{newPrefix}.xml'))
-                        if gs not in copiedGs:
-                            if gsFiles := glob(os.path.join(self.patternRoot, '*', gs, 'GridSquare_*.???')):
-                                gsSubFolder = gsFolder.mkdir(gs)
-                                for gsFn in gsFiles:
-                                    print(f"   Copying: {gsFn} to {gsSubFolder}")
-                                    shutil.copy(gsFn, gsSubFolder)
-                                copiedGs.add(gs)
+                        copier.copyXml(absFn.replace(suffix, '.xml'), newPrefix)
+                        copier.copyGridSquare(gs)
+
+                if copier.pending:
+                    self.log(f"Pending EPU metadata copies: {copier.pending}")
 
                 now = lastUpdate = datetime.now()
             time.sleep(self.wait['sleep'])
 
+        watcher.close()
+        copier.wait()
+        self.info['summary']['epu_copies'] = copier.stats
+        self.journalInfo('summary')
+        self.log(f"EPU metadata copies: {copier.stats}")
         self.log(f"Exiting, no new files detected in: "
                  f"{Color.warn(Pretty.delta(now - lastUpdate))}", flush=True)
 
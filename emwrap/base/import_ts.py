@@ -27,9 +27,8 @@ from datetime import datetime
 from emtools.utils import Color, Pretty, Path, FolderManager
 from emtools.metadata import Acquisition, StarFile, RelionStar, Table
 from emtools.jobs import MdocBatchManager
-from emtools.image import Image
 
-from emwrap.base import ProcessingPipeline
+from emwrap.base import ProcessingPipeline, ImageDims
 
 
 class ImportTsPipeline(ProcessingPipeline):
@@ -50,6 +49,25 @@ class ImportTsPipeline(ProcessingPipeline):
         self.mdocPattern = args['mdoc_files']
         self.tiltAxisAngle = args['tilt_axis_angle']
 
+    TS_COLUMNS = [
+        'rlnTomoName',
+        'rlnTomoTiltSeriesStarFile',
+        'rlnVoltage',
+        'rlnSphericalAberration',
+        'rlnAmplitudeContrast',
+        'rlnMicrographOriginalPixelSize',
+        'rlnTomoHand',
+        'rlnOpticsGroupName',
+        'rlnMdocFile'
+    ]
+
+    def _movieDims(self, framesPath):
+        """ All movies in a session are expected to have the same
+        dimensions, so only read them from the first one. """
+        if self.movieDims is None:
+            self.movieDims = ImageDims.get_dimensions(framesPath)
+        return self.movieDims
+
     def _output(self, batch):
         tsName = batch['tsName']
         mdoc = batch['mdoc']
@@ -69,7 +87,6 @@ class ImportTsPipeline(ProcessingPipeline):
         ])
 
         preExposure = 0
-        dims = None
         N = 0
         minAngle = 999
         maxAngle = -999
@@ -77,8 +94,7 @@ class ImportTsPipeline(ProcessingPipeline):
             N += 1
             movieName = mdoc.getSubFrameBase(s)
             framesPath = os.path.join(self.tsFolder, movieName)
-            if dims is None:
-                x, y, n = Image.get_dimensions(framesPath)
+            x, y, n = self._movieDims(framesPath)
             angle = float(s['TiltAngle'])
             minAngle = min(minAngle, angle)
             maxAngle = max(maxAngle, angle)
@@ -91,56 +107,43 @@ class ImportTsPipeline(ProcessingPipeline):
                 rlnTomoNominalDefocus=s['TargetDefocus'])
             preExposure += self.acq.total_dose
 
-        with StarFile(tsStarFile, 'w') as sfOut:
+        # Write to a temporary file first, readers never see a partial file
+        tmpStarFile = tsStarFile + '.tmp'
+        with StarFile(tmpStarFile, 'w') as sfOut:
             sfOut.writeTable(tsName, tsTable,
                              computeFormat="left",
                              timeStamp=True)
+        os.replace(tmpStarFile, tsStarFile)
 
-        if self.allTsTable is None:
-            self.allTsTable = Table([
-                'rlnTomoName',
-                'rlnTomoTiltSeriesStarFile',
-                'rlnVoltage',
-                'rlnSphericalAberration',
-                'rlnAmplitudeContrast',
-                'rlnMicrographOriginalPixelSize',
-                'rlnTomoHand',
-                'rlnOpticsGroupName',
-                'rlnMdocFile'
-            ])
-
+        # Append the new TS row, writing the header only the first time
         ps = self.acq.pixel_size
-        self.allTsTable.addRowValues(
-            rlnTomoName=tsName,
-            rlnTomoTiltSeriesStarFile=tsStarFile,
-            rlnVoltage=self.acq.voltage,
-            rlnSphericalAberration=self.acq.cs,
-            rlnAmplitudeContrast=self.acq.amplitude_contrast,
-            rlnMicrographOriginalPixelSize=ps,
-            rlnTomoHand=-1,
-            rlnOpticsGroupName='optics_group1',
-            rlnMdocFile=mdocFile
-        )
-
-        with StarFile(self.outputStar, 'w') as sfOut:
-            sfOut.writeTable('global', self.allTsTable,
-                             computeFormat="left",
-                             timeStamp=True)
-            self.outputs = {
-                'FrameSeries': {
-                    'label': 'Frame series',
-                    'type': 'FrameSeries',
-                    'info': f"{len(self.allTsTable)} items, {x} x {y} x {n} x {N}, {ps:0.3f} Å/px",
-                    'files': [
-                        [self.outputStar, 'TomogramGroupMetadata.star.relion.tomo.import']
-                    ]
-                }
+        newFile = not os.path.exists(self.outputStar)
+        with StarFile(self.outputStar, 'a') as sfOut:
+            if newFile:
+                sfOut.writeTimeStamp()
+                sfOut.writeHeader('global', Table(self.TS_COLUMNS))
+            sfOut.writeRowValues([
+                tsName, tsStarFile, self.acq.voltage, self.acq.cs,
+                self.acq.amplitude_contrast, ps, -1, 'optics_group1', mdocFile
+            ])
+        self.tsCount += 1
+
+        self.outputs = {
+            'FrameSeries': {
+                'label': 'Frame series',
+                'type': 'FrameSeries',
+                'info': f"{self.tsCount} items, {x} x {y} x {n} x {N}, {ps:0.3f} Å/px",
+                'files': [
+                    [self.outputStar, 'TomogramGroupMetadata.star.relion.tomo.import']
+                ]
             }
-            self.writeInfo()
+        }
+        self.journalInfo('outputs')
 
     def prerun(self):
         previousTs = set()
-        self.allTsTable = None
+        self.tsCount = 0
+        self.movieDims = None
 
         # FIXME We need to dump the acquisition.json now in the project directory
         # because some jobs needs to read from it
@@ -151,8 +154,9 @@ class ImportTsPipeline(ProcessingPipeline):
 
         # Load already seen movies if we are continuing the job
         if os.path.exists(self.outputStar):
-            self.allTsTable = StarFile.getTableFromFile('global', self.outputStar)
-            previousTs.update(row.rlnTomoName for row in self.allTsTable)
+            allTsTable = StarFile.getTableFromFile('global', self.outputStar)
+            previousTs.update(row.rlnTomoName for row in allTsTable)
+            self.tsCount = len(allTsTable)
         else:
             self.mkdir('tilt_series')
             self.mkdir('mdocs')
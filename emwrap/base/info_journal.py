@@ -0,0 +1,147 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import json
+import time
+import uuid
+import threading
+
+
+class InfoJournal:
+    """ Append-only journal of updates to a run's info.json file.
+
+    Instead of dumping the whole info dict after every batch, each update
+    is appended as a single JSON line to info.jsonl (next to info.json).
+    Every event sets the value at a given key path, so replaying the
+    journal over info.json is idempotent. From time to time, the journal
+    is compacted: the full info is written to info.json (atomically) and
+    the journal is truncated. Events appended by other writers (e.g. when
+    registering a subset of a running job) are merged into the info before
+    the journal is dropped.
+    """
+    def __init__(self, infoFile, compactEvery=100, compactInterval=300):
+        """
+        Args:
+            infoFile: path to the info.json file
+            compactEvery: number of appended events that triggers a compaction
+            compactInterval: seconds after which the next append will also
+                trigger a compaction, keeping info.json reasonably fresh for
+                readers that do not replay the journal.
+        """
+        self.infoFile = infoFile
+        self.journalFile = self.journal_path(infoFile)
+        self.compactEvery = compactEvery
+        self.compactInterval = compactInterval
+        self._pending = 0
+        self._lastCompact = time.time()
+        self._lock = threading.Lock()
+        # Used to tell our own events from the ones of other writers
+        self.writerId = uuid.uuid4().hex
+
+    @staticmethod
+    def journal_path(infoFile):
+        return os.path.splitext(infoFile)[0] + '.jsonl'
+
+    @staticmethod
+    def _set(info, keyPath, value):
+        """ Set the value in the nested info dict following keyPath.
+        Integer keys are used for list elements (e.g. 'runs'), where
+        the index equal to the list length means append.
+        """
+        container = info
+        for k in keyPath[:-1]:
+            container = container.setdefault(k, {})
+        last = keyPath[-1]
+        if isinstance(container, list):
+            if last == len(container):
+                container.append(value)
+            else:
+                container[last] = value
+        else:
+            container[last] = value
+
+    @classmethod
+    def read(cls, infoFile):
+        """ Load info.json and replay any journal events written after it.
+        Return None if neither info.json nor the journal exist.
+        """
+        info = None
+        if os.path.exists(infoFile):
+            with open(infoFile) as f:
+                info = json.load(f)
+
+        journalFile = cls.journal_path(infoFile)
+        if os.path.exists(journalFile):
+            info = info or {}
+            for event in cls._events(journalFile):
+                cls._set(info, event['key'], event['value'])
+        return info
+
+    @staticmethod
+    def _events(journalFile):
+        """ Iterate over the events written in the journal file. """
+        with open(journalFile) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line might be incomplete if the writer was killed
+                    break
+
+    def append(self, info, keyPath, value):
+        """ Append a new event to the journal. The in-memory info should
+        already contain the value, it is only used if a compaction is
+        triggered after this event.
+        """
+        line = json.dumps({'key': list(keyPath), 'value': value,
+                           'writer': self.writerId})
+        with self._lock:
+            with open(self.journalFile, 'a') as f:
+                f.write(line + '\n')
+            self._pending += 1
+            if (self._pending >= self.compactEvery or
+                    time.time() - self._lastCompact > self.compactInterval):
+                self._compact(info)
+
+    def compact(self, info):
+        """ Write the full info to info.json and truncate the journal.
+        Events from other writers found in the journal are also set in
+        the given info.
+        """
+        with self._lock:
+            self._compact(info)
+
+    def _compact(self, info):
+        # Move the journal away first, events appended from now on
+        # will go to a new journal that is replayed over info.json
+        compactFile = self.journalFile + '.compact'
+        if os.path.exists(self.journalFile):
+            os.replace(self.journalFile, compactFile)
+            for event in self._events(compactFile):
+                if event.get('writer') != self.writerId:
+                    self._set(info, event['key'], event['value'])
+        tmpFile = self.infoFile + '.tmp'
+        with open(tmpFile, 'w') as f:
+            json.dump(info, f, indent=4)
+        os.replace(tmpFile, self.infoFile)
+        if os.path.exists(compactFile):
+            os.remove(compactFile)
+        self._pending = 0
+        self._lastCompact = time.time()
@@ -0,0 +1,209 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import re
+import time
+import shlex
+import subprocess
+
+from .file_watcher import FileWatcher
+
+# Cluster job states (LSF and SLURM) where the job is still queued or running
+QUEUE_ALIVE_STATES = {
+    'PEND', 'RUN', 'PSUSP', 'USUSP', 'SSUSP', 'WAIT', 'PROV',
+    'PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING', 'SUSPENDED',
+    'REQUEUED', 'REQUEUE_HOLD', 'REQUEUE_FED', 'RESIZING', 'SIGNALING',
+    'STAGE_OUT'
+}
+
+# Errors of the status commands for jobs that are no longer known by the
+# queue, e.g. "Job <101> is not found" (LSF) or "Invalid job id specified"
+# (SLURM, after the job has been purged)
+QUEUE_NOT_FOUND = re.compile(r'is not found|Invalid job id specified')
+
+
+class JobStatusTracker:
+    """ Keep the status of the active jobs of a project in memory.
+
+    Status files (e.g. RELION_JOB_EXIT_SUCCESS) are watched with a
+    FileWatcher (inotify, or mtime polling on network filesystems), so
+    each refresh only checks the jobs whose folders had new status files.
+    Jobs submitted to a cluster (with a job.id file) are also checked
+    with a single status command per queue, so jobs that died without
+    writing any status file are detected. Jobs are only marked as failed
+    after being missing from the queue in several consecutive checks,
+    giving time for the exit status file to show up (e.g. on NFS).
+    """
+    def __init__(self, path, statusFiles, failedFile, getQueue=None,
+                 queueInterval=60, missingChecks=2, backend='auto', log=print):
+        """
+        Args:
+            path: project path
+            statusFiles: dict of status file name -> status
+            failedFile: status file written for jobs that are no
+                longer in the queue without any exit status file
+            getQueue: function that returns the queue config of a job
+                (or None if it was not submitted to a queue)
+            queueInterval: minimum seconds between queue queries
+            missingChecks: number of consecutive queue checks where a job
+                is missing (without exit status) before marking it as failed
+            backend: FileWatcher backend
+        """
+        self.path = path
+        self.statusFiles = statusFiles
+        self.failedFile = failedFile
+        self.getQueue = getQueue
+        self.queueInterval = queueInterval
+        self.missingChecks = missingChecks
+        self.log = log
+        self._watcher = FileWatcher.create(
+            os.path.join(path, '*', 'job*', 'RELION_JOB_*'), backend=backend)
+        self._exitStatuses = {s for f, s in statusFiles.items()
+                              if f.startswith('RELION_JOB_EXIT')}
+        self._statuses = {}  # job id -> status of tracked jobs
+        self._missing = {}  # job id -> consecutive checks missing from the queue
+        self._lastQueueCheck = 0
+
+    def _fileStatus(self, jobId):
+        """ Status given by the status files of the job folder, if any. """
+        status = None
+        for statusFile, s in self.statusFiles.items():
+            if os.path.exists(os.path.join(self.path, jobId, statusFile)):
+                status = s
+        return status
+
+    def _changedJobs(self):
+        """ Return the ids of jobs with new status files. """
+        changed = set()
+        for fn in self._watcher.newFiles():
+            changed.add(os.path.dirname(os.path.relpath(fn, self.path)))
+        return changed
+
+    def refresh(self, active):
+        """ Refresh the status of the given active jobs.
+
+        Args:
+            active: dict of job id -> current status of active jobs
+        Returns:
+            dict of job id -> new status for jobs whose status changed
+        """
+        changed = self._changedJobs()
+        # Forget jobs that are no longer active
+        self._statuses = {k: v for k, v in self._statuses.items() if k in active}
+        self._missing = {k: v for k, v in self._missing.items() if k in active}
+
+        updates = {}
+        for jobId, status in active.items():
+            # New tracked jobs are checked once, then only after changes
+            if jobId in changed or jobId not in self._statuses:
+                if (newStatus := self._fileStatus(jobId)) and newStatus != status:
+                    status = updates[jobId] = newStatus
+            self._statuses[jobId] = status
+
+        if time.time() - self._lastQueueCheck > self.queueInterval:
+            self._lastQueueCheck = time.time()
+            pending = {k: v for k, v in active.items() if k not in updates}
+            updates.update(self._checkQueues(pending))
+        return updates
+
+    def _readQueueJobId(self, jobId):
+        fn = os.path.join(self.path, jobId, 'job.id')
+        if os.path.exists(fn):
+            with open(fn) as f:
+                return f.readline().strip() or None
+        return None
+
+    def _queryQueue(self, queue, queueIds):
+        """ Run the queue status command once for all the given cluster ids.
+        The command is taken from the 'status' key of the queue config,
+        with {job_ids} (space separated) or {job_ids_csv} (comma separated),
+        and it should print lines with the job id and its state, or with
+        the job id, array index (0 if not an array) and state as LSF does.
+        Jobs reported as not found in the errors are just missing from
+        the result. Return a dict with the state of each job found or
+        None if the command failed. """
+        cmd = queue['status'].format(job_ids=' '.join(queueIds),
+                                     job_ids_csv=','.join(queueIds))
+        try:
+            result = subprocess.run(shlex.split(cmd), capture_output=True,
+                                    text=True, timeout=60)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            self.log(f"Queue status command failed: {cmd}: {e}")
+            return None
+        errors = [line for line in result.stderr.splitlines()
+                  if line.strip() and not QUEUE_NOT_FOUND.search(line)]
+        if result.returncode != 0 and not result.stdout.strip() and \
+                (errors or not result.stderr.strip()):
+            self.log(f"Queue status command failed: {cmd}: {result.stderr.strip()}")
+            return None
+        states = {}
+        for line in result.stdout.splitlines():
+            parts = line.split()
+            if len(parts) == 3:
+                queueId, index, state = parts
+                if index not in ['0', '-']:
+                    queueId = f"{queueId}[{index}]"
+                states[queueId] = state.upper()
+            elif len(parts) == 2:
+                states[parts[0]] = parts[1].upper()
+        return states
+
+    def _checkQueues(self, active):
+        """ Query each queue once for all its submitted jobs. Return the
+        jobs that are no longer queued or running, and have no exit
+        status file, as failed. """
+        if self.getQueue is None:
+            return {}
+        byQueue = {}
+        for jobId in active:
+            if (queueId := self._readQueueJobId(jobId)) and \
+                    (queue := self.getQueue(jobId)) and queue.get('status'):
+                byQueue.setdefault(queue['name'], (queue, {}))[1][queueId] = jobId
+
+        updates = {}
+        failed = self.statusFiles[self.failedFile]
+        for queue, jobs in byQueue.values():
+            if (states := self._queryQueue(queue, list(jobs))) is None:
+                continue
+            for queueId, jobId in jobs.items():
+                state = states.get(queueId, None)
+                if state in QUEUE_ALIVE_STATES:
+                    self._missing.pop(jobId, None)
+                    continue
+                # Check files after the query, the job might have just finished
+                status = self._fileStatus(jobId)
+                if status not in self._exitStatuses:
+                    self._missing[jobId] = self._missing.get(jobId, 0) + 1
+                    if self._missing[jobId] < self.missingChecks:
+                        continue
+                    self._markFailed(jobId, queueId, state)
+                    status = failed
+                self._missing.pop(jobId, None)
+                if status != active[jobId]:
+                    updates[jobId] = self._statuses[jobId] = status
+        return updates
+
+    def _markFailed(self, jobId, queueId, state):
+        msg = (f"Cluster job {queueId} is no longer in the queue "
+               f"(state: {state or 'not found'}) without exit status, marking as failed.")
+        self.log(f"{jobId}: {msg}")
+        with open(os.path.join(self.path, jobId, 'job.log'), 'a') as f:
+            f.write(f"\n{msg}\n")
+        open(os.path.join(self.path, jobId, self.failedFile), 'w').close()
+
+    def close(self):
+        self._watcher.close()
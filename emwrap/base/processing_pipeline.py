@@ -27,11 +27,17 @@ import re
 from collections import defaultdict
 
 from emtools.utils import Process, Color, Pretty, FolderManager, Timer
-from emtools.jobs import BatchManager, Args, Pipeline
-from emtools.metadata import (Table, Column, StarFile, StarMonitor, TextFile,
+from emtools.jobs import BatchManager, Args, Pipeline, Batch
+from emtools.metadata import (Table, Column, StarFile, TextFile,
                               Acquisition, RelionStar)
 
 from .config import ProcessingConfig
+from .info_journal import InfoJournal
+from .scratch import ScratchManager
+from .scheduler import GpuScheduler
+from .adaptive_batch import AdaptiveBatchManager
+from .star_tail import StarTailMonitor
+from .gpu_lease import lease_gpus
 
 class ProcessingPipeline(Pipeline, FolderManager):
     """ Subclass of Pipeline that is commonly used to run programs.
@@ -67,8 +73,21 @@ class ProcessingPipeline(Pipeline, FolderManager):
             'batches': {}
         }
         self.infoFile = self.join('info.json')
+        self.infoJournal = InfoJournal(self.infoFile,
+                                       compactEvery=int(args.get('info_compact', 100)))
+        # Last journaled value of the info sections, to avoid logging them
+        # again if they have not changed
+        self._journaled = {}
         # Lock used when requiring single thread running output generation code
         self.outputLock = threading.Lock()
+        self._scratch = None
+        self._scheduler = None
+        self._batchManager = None
+        # Counters of input items, kept in memory and updated by the movies
+        # generator (discovered) and when registering outputs
+        self.progress = {'previous': 0, 'discovered': 0,
+                         'processed': 0, 'failed': 0, 'pending': 0}
+        self._progressLock = threading.Lock()
 
     @property
     def inputs(self):
@@ -92,6 +111,33 @@ class ProcessingPipeline(Pipeline, FolderManager):
             raise ValueError("self.outputs should be a dict")
         self.info['outputs'] = value
 
+    @property
+    def scratch(self):
+        """ ScratchManager for batch folders, created on first use. """
+        if self._scratch is None:
+            roots = self._args.get('scratch_roots', self.scratchDir)
+            self._scratch = ScratchManager(roots,
+                                           timeout=int(self._args.get('scratch_timeout', 3600)))
+        return self._scratch
+
+    @property
+    def scheduler(self):
+        """ GpuScheduler for the pipeline's gpuList, created on first use.
+        All GPU processors of the pipeline share it, so slots per GPU
+        limit the concurrent tasks in each device. """
+        if self._scheduler is None:
+            gpus = getattr(self, 'gpuList', [])
+            args = self._args
+            self._scheduler = GpuScheduler(
+                gpus,
+                slots=GpuScheduler.parse_slots(args.get('gpu_slots', 1), gpus),
+                maxFailures=int(args.get('gpu_max_failures', 3)),
+                stragglerFactor=float(args.get('gpu_straggler_factor', 3.0)),
+                cooldown=float(args.get('gpu_cooldown', 600)),
+                probe=GpuScheduler.probe_nvidia_smi if int(args.get('gpu_probe', 1)) else None,
+                log=self.log)
+        return self._scheduler
+
     def __validate(self, path, key):
         if not path:
             raise Exception(f'Invalid {key} directory: {path}')
@@ -196,24 +242,44 @@ class ProcessingPipeline(Pipeline, FolderManager):
     def do_clean():
         return int(os.environ.get('EMWRAP_CLEAN', 1)) > 0
 
+    @property
+    def gpu_lease(self):
+        """ Options to lease GPUs in the project (see get_gpu_list),
+        or None if the 'gpu_lease' arg is not set. """
+        if str(self._args.get('gpu_lease', '')).lower() not in ['1', 'true', 'yes']:
+            return None
+        return {'path': self.workingDir,
+                'priority': int(self._args.get('gpu_priority', 0)),
+                'owner': self.outputPrefix}
+
     @staticmethod
-    def get_gpu_list(gpus, as_string=False):
+    def get_gpu_list(gpus, as_string=False, lease=None):
         """ Get the list of GPUs base on the following options:
         1. If a single number N
             List will be [0, 1..., N-1]
         2. If there is a space-separated list
             List will be gpus.split()
         3. Single specific gpu should be specified with "GPU_NUMBER"
+
+        If lease options are given (path, priority and owner), the same
+        number of GPUs is leased in the project (waiting until they are
+        free), and the leased GPUs are returned. They are released when
+        the process exits.
         """
         if not gpus:
             return '' if as_string else []
 
-        parts = gpus.split()
+        parts = str(gpus).split()
         if len(parts) > 1:
             gpu_list = [int(g) for g in parts]
         else:
             gpu_list = list(range(int(gpus)))
 
+        if lease and gpu_list:
+            gpu_list = lease_gpus(lease['path'], len(gpu_list),
+                                  priority=lease.get('priority', 0),
+                                  owner=lease.get('owner', ''))
+
         if as_string:
             return ' '.join(str(g) for g in gpu_list)
         else:
@@ -313,38 +379,156 @@ class ProcessingPipeline(Pipeline, FolderManager):
                     return ProcessingPipeline.micId(value)
 
         # Get the micrographs IDs to avoid processing again that movies
-        # and use it for the StarMonitor blacklist
+        # and use it for the monitor blacklist
         if os.path.exists(outputStar):
             with StarFile(outputStar) as sf:
                 blacklist = sf.getTable('micrographs')
         else:
             blacklist = []
 
-        monitor = StarMonitor(inputStar, 'movies', _movie_micrograph_key,
-                              timeout=inputTimeOut,
-                              blacklist=blacklist)
+        # Only the rows appended to the input are parsed after each change
+        monitor = StarTailMonitor(inputStar, 'movies', _movie_micrograph_key,
+                                  timeout=inputTimeOut,
+                                  blacklist=blacklist)
+        self.progress['previous'] = len(blacklist)
+
+        def _count_items(items):
+            for item in items:
+                with self._progressLock:
+                    self.progress['discovered'] += 1
+                yield item
+
+        items = _count_items(monitor.newItems())
+        if self._args.get('batch_adaptive', False):
+            # Batch sizes depend on the input rate, queued batches
+            # and processing times, see AdaptiveBatchManager
+            batchMgr = AdaptiveBatchManager(batchSize, items, self.tmpDir,
+                                            minSize=self._args.get('batch_min', None),
+                                            maxSize=self._args.get('batch_max', None),
+                                            maxLatency=int(self._args.get('batch_latency', 600)),
+                                            log=self.log,
+                                            itemFileNameFunc=_movie_fn,
+                                            createBatch=createBatch)
+        else:
+            batchMgr = BatchManager(batchSize, items, self.tmpDir,
+                                    itemFileNameFunc=_movie_fn,
+                                    createBatch=createBatch)
+        self._batchManager = batchMgr
+
+        g = self.addGenerator(batchMgr.generate,
+                              queueMaxSize=queueMaxSize)
+        if isinstance(batchMgr, AdaptiveBatchManager):
+            batchMgr.queueDepth = g.outputQueue.qsize
+        return g
+
+    def addGpuProcessors(self, inputQueue, procFunc, clone=None, failed=None,
+                         deviceError=None):
+        """ Add processors that run batches in the GPUs assigned by
+        the scheduler. One processor is added per GPU slot.
 
-        batchMgr = BatchManager(batchSize, monitor.newItems(), self.tmpDir,
-                                itemFileNameFunc=_movie_fn,
-                                createBatch=createBatch)
+        Args:
+            inputQueue: queue from where the batches are taken
+            procFunc: function that receives the GPU and returns the
+                function that will process the batch
+            clone: if not None, function to create a copy of a batch that
+                can be re-dispatched to another GPU when it is too slow.
+                Only used if 'gpu_redispatch' is enabled (default)
+            failed: function to check if a processed batch failed
+            deviceError: function to check if a failed batch failed
+                because of the GPU, only these failures can disable it
+        Return the output queue of the processors.
+        """
+        scheduler = self.scheduler
+        if not int(self._args.get('gpu_redispatch', 1)):
+            clone = None
+
+        def _discard(batch):
+            if isinstance(batch, Batch) and batch.path and os.path.exists(batch.path):
+                shutil.rmtree(batch.path, ignore_errors=True)
+
+        def _process(batch):
+            try:
+                return scheduler.run(batch, procFunc, clone=clone,
+                                     discard=_discard if clone else None,
+                                     failed=failed, deviceError=deviceError)
+            except Exception as e:
+                batch.log(Color.red(f"ERROR: {e}"), flush=True)
+                batch.error = str(e)
+                return batch
+
+        self.log(f"Creating {scheduler.totalSlots} processing threads "
+                 f"for GPUs: {Color.cyan(str(list(scheduler.devices)))}", flush=True)
+        outputQueue = None
+        for _ in range(scheduler.totalSlots):
+            p = self.addProcessor(inputQueue, _process, outputQueue=outputQueue)
+            outputQueue = p.outputQueue
+
+        return outputQueue
 
-        return self.addGenerator(batchMgr.generate,
-                                 queueMaxSize=queueMaxSize)
+    @staticmethod
+    def cloneBatch(batch, suffix='_retry'):
+        """ Copy of a batch with its own folder, to be used when
+        re-dispatching it to another GPU. """
+        clone = Batch(batch)
+        clone.path = batch.path.rstrip('/') + suffix
+        return clone
+
+    def updateProgress(self, batch, processed=0, failed=0):
+        """ Update the processed and failed counters after a batch is done,
+        store them in the info summary and log the overall progress.
+        The batch processing time is also used for adaptive batch sizes. """
+        with self._progressLock:
+            p = self.progress
+            p['processed'] += processed
+            p['failed'] += failed
+            p['pending'] = p['discovered'] - p['processed'] - p['failed']
+            self.info['summary']['progress'] = dict(p)
+            done = p['previous'] + p['processed'] + p['failed']
+            total = p['previous'] + p['discovered']
+        if isinstance(self._batchManager, AdaptiveBatchManager):
+            self._batchManager.batchDone(batch)
+        self.journalInfo('summary', 'progress')
+        percent = done * 100 / total if total else 0
+        batch.log(f">>> Processed {Color.green(str(done))} out of "
+                  f"{Color.red(str(total))} "
+                  f"({Color.bold('%0.2f' % percent)} %)", flush=True)
 
     def updateBatchInfo(self, batch):
-        """ Update general info with this batch and write json file. """
+        """ Update general info with this batch and append the
+        changes to the info journal. """
         self.info['batches'][batch.id] = batch.info
-        self.writeInfo()
+        self.infoJournal.append(self.info, ['batches', batch.id], batch.info)
+        # Inputs and outputs are usually updated before registering the batch
+        for section in ['inputs', 'outputs']:
+            self.journalInfo(section)
+        if self._scratch is not None:
+            self.info['summary']['scratch'] = self._scratch.stats()
+            self.journalInfo('summary', 'scratch')
+        if self._scheduler is not None:
+            self.info['summary']['gpus'] = self._scheduler.stats()
+            self.journalInfo('summary', 'gpus')
+
+    def journalInfo(self, *keyPath):
+        """ Append the current value of the given info section (or nested key)
+        to the journal, only if it has changed since it was last written. """
+        value = self.info
+        for k in keyPath:
+            value = value[k]
+        dumped = json.dumps(value, sort_keys=True)
+        if self._journaled.get(keyPath) != dumped:
+            self._journaled[keyPath] = dumped
+            self.infoJournal.append(self.info, keyPath, value)
 
     def readInfo(self):
-        if os.path.exists(self.infoFile):
-            with open(self.infoFile) as f:
-                self.info = json.load(f)
+        """ Load info.json, replaying any journaled update. """
+        if info := InfoJournal.read(self.infoFile):
+            self.info = info
+            self._journaled = {}
 
     def writeInfo(self):
-        """ Write file with internal information to info.json. """
-        with open(self.infoFile, 'w') as f:
-            json.dump(self.info, f, indent=4)
+        """ Write file with internal information to info.json,
+        compacting the info journal. """
+        self.infoJournal.compact(self.info)
 
     def fixOutputPath(self, path):
         """ Add the output prefix to a path that is relative to
@@ -0,0 +1,153 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import json
+import sqlite3
+
+
+class ProjectIndex:
+    """ SQLite index with the metadata of a project's jobs.
+
+    It stores the jobs of default_pipeline.star (id, type, status and
+    registered outputs), the parsed content of some files of each job
+    (e.g. params from job.star or info.json), and the input edges
+    between jobs. Every entry keeps the signature (mtime and size) of the
+    files it was read from, and it is only used while the files do not
+    change, so the index is always safe to delete.
+    """
+    FILE_NAME = '.emw_index.db'
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sources (
+        path TEXT PRIMARY KEY, signature TEXT);
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY, pos INTEGER, jobtype TEXT, status TEXT,
+        outputs TEXT);
+    CREATE TABLE IF NOT EXISTS entries (
+        kind TEXT, job TEXT, signature TEXT, value TEXT,
+        PRIMARY KEY (kind, job));
+    CREATE TABLE IF NOT EXISTS edges (
+        job TEXT, key TEXT, value TEXT, source TEXT,
+        PRIMARY KEY (job, key));
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: project folder, where the index file is created
+        """
+        self.path = path
+        self.dbFile = os.path.join(path, self.FILE_NAME)
+        self._conn = sqlite3.connect(self.dbFile, timeout=30)
+        self._conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    @staticmethod
+    def signature(*files):
+        """ Return the signature (mtime and size) of the given files,
+        with None for missing files. """
+        sig = []
+        for fn in files:
+            try:
+                st = os.stat(fn)
+                sig.append([st.st_mtime_ns, st.st_size])
+            except FileNotFoundError:
+                sig.append(None)
+        return json.dumps(sig)
+
+    # ---------------------- Pipeline jobs --------------------------------
+    def _sourceSignature(self, path):
+        row = self._conn.execute("SELECT signature FROM sources WHERE path=?",
+                                 (path,)).fetchone()
+        return row[0] if row else None
+
+    def jobs(self, pipelineStar):
+        """ Return the list of job dicts (id, jobtype, status, outputs)
+        if the index is up to date with the pipeline file, else None. """
+        if self._sourceSignature(pipelineStar) != self.signature(pipelineStar):
+            return None
+        return [{'id': jobId, 'jobtype': jobType, 'status': status,
+                 'outputs': json.loads(outputs)}
+                for jobId, jobType, status, outputs in self._conn.execute(
+                    "SELECT id, jobtype, status, outputs FROM jobs ORDER BY pos")]
+
+    @staticmethod
+    def jobDict(job):
+        """ Dict with the indexed values of a workflow job. """
+        return {'id': job.id, 'jobtype': job['jobtype'], 'status': job['status'],
+                'outputs': [o.id for o in job.outputs]}
+
+    def setJobs(self, pipelineStar, workflow, clearEdges=False):
+        """ Store the jobs of the workflow, as written in the pipeline file.
+        If clearEdges, the known input edges are removed (e.g. the pipeline
+        was modified outside the ProjectManager). """
+        with self._conn:
+            self._conn.execute("DELETE FROM jobs")
+            rows = [self.jobDict(job) for job in workflow.jobs()]
+            self._conn.executemany(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?)",
+                [(r['id'], i, r['jobtype'], r['status'], json.dumps(r['outputs']))
+                 for i, r in enumerate(rows)])
+            if clearEdges:
+                self._conn.execute("DELETE FROM edges")
+            self._conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)",
+                               (pipelineStar, self.signature(pipelineStar)))
+
+    # ---------------------- Job files --------------------------------
+    def cached(self, kind, jobId, files, loader):
+        """ Return the value of a given kind (e.g. 'params') for a job.
+        It is taken from the index if the files did not change since it
+        was stored, otherwise loader() is called and its result stored.
+        Values should be JSON-serializable. """
+        sig = self.signature(*files)
+        row = self._conn.execute("SELECT signature, value FROM entries "
+                                 "WHERE kind=? AND job=?", (kind, jobId)).fetchone()
+        if row and row[0] == sig:
+            return json.loads(row[1])
+
+        value = loader()
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                               (kind, jobId, sig, json.dumps(value)))
+        return value
+
+    def deleteJob(self, jobId):
+        with self._conn:
+            self._conn.execute("DELETE FROM entries WHERE job=?", (jobId,))
+            self._conn.execute("DELETE FROM edges WHERE job=? OR source=?", (jobId, jobId))
+
+    # ---------------------- Input edges --------------------------------
+    def setInputs(self, jobId, edges):
+        """ Replace the input edges of a job, given as
+        (key, value, sourceJobId) tuples. """
+        with self._conn:
+            self._conn.execute("DELETE FROM edges WHERE job=?", (jobId,))
+            self._conn.executemany("INSERT OR REPLACE INTO edges VALUES (?, ?, ?, ?)",
+                                   [(jobId, k, v, s) for k, v, s in edges])
+
+    def addInput(self, jobId, key, value, source):
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO edges VALUES (?, ?, ?, ?)",
+                               (jobId, key, value, source))
+
+    def inputs(self, jobId=None):
+        """ Return the input edges as (job, key, value, source) tuples. """
+        if jobId is None:
+            return self._conn.execute("SELECT * FROM edges").fetchall()
+        return self._conn.execute("SELECT * FROM edges WHERE job=?", (jobId,)).fetchall()
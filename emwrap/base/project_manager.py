@@ -21,6 +21,8 @@ import json
 import subprocess
 import argparse
 import shutil
+from contextlib import contextmanager
+from collections import OrderedDict
 from datetime import datetime
 
 from emtools.utils import FolderManager, Process, Color, Path, Timer, Pretty
@@ -29,6 +31,10 @@ from emtools.metadata import Table, StarFile, RelionStar
 
 from .config import ProcessingConfig
 from .processing_pipeline import ProcessingPipeline
+from .info_journal import InfoJournal
+from .project_index import ProjectIndex
+from .job_tracker import JobStatusTracker
+from .gpu_lease import GpuLeaseManager
 
 
 STATUS_LAUNCHED = 'Launched'
@@ -55,6 +61,53 @@ def _param_references_job(param_value, job_id):
 JOB_STATUS_ACTIVE = [STATUS_LAUNCHED, STATUS_RUNNING]
 
 
+def _queue_type(queue):
+    """ Return the scheduler of a queue ('lsf' or 'slurm'), from its 'type'
+    or guessed from the submit command. """
+    if qtype := queue.get('type', None):
+        return qtype.lower()
+    return 'slurm' if any(k in queue['submit'] for k in ['slurm', 'sbatch']) else 'lsf'
+
+
+def _queue_directives(queue, dependencies=None, arraySize=0, name='emw'):
+    """ Return the scheduler directives for a job that should only start
+    after dependencies (cluster job ids) finish successfully, and to
+    submit it as an array job of arraySize elements. """
+    lines = []
+    if _queue_type(queue) == 'slurm':
+        if dependencies:
+            lines.append(f"#SBATCH --dependency=afterok:{':'.join(dependencies)}")
+            lines.append("#SBATCH --kill-on-invalid-dep=yes")
+        if arraySize:
+            lines.append(f"#SBATCH --array=1-{arraySize}")
+    else:
+        if dependencies:
+            deps = ' && '.join(f'done({d})' for d in dependencies)
+            lines.append(f'#BSUB -w "{deps}"')
+        if arraySize:
+            lines.append(f'#BSUB -J "{name}[1-{arraySize}]"')
+    return lines
+
+
+def _queue_array_var(queue):
+    """ Environment variable with the index of array job elements. """
+    return 'SLURM_ARRAY_TASK_ID' if _queue_type(queue) == 'slurm' else 'LSB_JOBINDEX'
+
+
+def _queue_array_element(queue, arrayId, index):
+    """ Cluster id of an element of an array job. """
+    return f"{arrayId}_{index}" if _queue_type(queue) == 'slurm' else f"{arrayId}[{index}]"
+
+
+def _add_directives(script, directives):
+    """ Insert directives in a job script, after the shebang line. """
+    if not directives:
+        return script
+    lines = script.split('\n')
+    i = 1 if lines and lines[0].startswith('#!') else 0
+    return '\n'.join(lines[:i] + directives + lines[i:])
+
+
 class ProjectManager(FolderManager):
     """ Class to manipulate information about a Relion project. """
 
@@ -65,19 +118,78 @@ class ProjectManager(FolderManager):
         if not self.exists():
             raise Exception(f"Project path '{apath}' does not exist")
 
+        self._workflow = None
+        self._txDepth = 0  # Nested transaction() calls
+        self._txDirty = False  # Pipeline write deferred until commit
+        self._txCreated = []  # Jobs created in the current transaction
+        self._tracker = None  # Created on the first update()
         if self.exists(self.pipeline_star):
             self.log(f"Loading project from: {apath}")
-            self._wf = RelionStar.pipeline_to_workflow(self.pipeline_star)
         elif create:
             # Create a new project
-            self._wf = Workflow()
+            self._workflow = Workflow()
             self._create()
         else:
             raise Exception(f"'{self.pipeline_star} does not exist")
+        self._index = ProjectIndex(self.path)
+
+    @property
+    def _wf(self):
+        """ Workflow built from default_pipeline.star, only loaded when needed,
+        since many operations can be resolved from the project index. """
+        if self._workflow is None:
+            self._workflow = RelionStar.pipeline_to_workflow(self.pipeline_star)
+            if self._index.jobs(self.pipeline_star) is None:
+                # Pipeline modified outside of this class, known inputs may be outdated
+                self._index.setJobs(self.pipeline_star, self._workflow, clearEdges=True)
+        return self._workflow
+
+    def _jobRows(self):
+        """ Return the list of jobs (dicts with id, jobtype, status and outputs)
+        from the index, or from the workflow if it is loaded or the index
+        is outdated. """
+        if self._workflow is None:
+            if (rows := self._index.jobs(self.pipeline_star)) is not None:
+                return rows
+        return [ProjectIndex.jobDict(job) for job in self._wf.jobs()]
 
     def get_workflow(self):
         return self._wf
 
+    @contextmanager
+    def transaction(self):
+        """ Group several changes to the project (e.g. creating many jobs).
+        The status of jobs is refreshed once at the beginning, and
+        default_pipeline.star is written once at the end. If there is
+        an error, changes are discarded and folders of created jobs
+        are moved to the trash.
+        """
+        if self._txDepth == 0:
+            self.update()
+            self._txDirty = False
+            self._txCreated = []
+        self._txDepth += 1
+        try:
+            yield self
+        except BaseException:
+            self._txDepth -= 1
+            if self._txDepth == 0:
+                self._rollback()
+            raise
+        self._txDepth -= 1
+        if self._txDepth == 0 and self._txDirty:
+            self._txDirty = False
+            self._txCreated = []
+            self._update_pipeline_star()
+
+    def _rollback(self):
+        self.log(f"Discarding changes, {len(self._txCreated)} created jobs.")
+        for job in self._txCreated:
+            self._deleteJobFolder(job, validate=False)
+        self._txDirty = False
+        self._txCreated = []
+        self._workflow = None  # Load again from the pipeline file
+
     @property
     def pipeline_star(self):
         return self.join('default_pipeline.star')
@@ -89,7 +201,7 @@ class ProjectManager(FolderManager):
     def clean(self):
         """ Remove all project files. """
         for name in ['.gui_projectdir', '.TMP_runfiles', '.relion_lock',
-                     'default_pipeline.star',
+                     'default_pipeline.star', ProjectIndex.FILE_NAME,
                      'Import', 'External']:
             if self.exists(name):
                 Process.system(f"rm -rf '{self.join(name)}'", print=self.log)
@@ -110,8 +222,26 @@ class ProjectManager(FolderManager):
         format = u'{:<25}{:<35}{:<25}'
         print(format.format(*header))
 
-        for job in self._wf.jobs():
-            print(format.format(job.id, job['jobtype'], job['status']))
+        for row in self._jobRows():
+            print(format.format(row['id'], row['jobtype'], row['status']))
+
+        self.listGpuLeases()
+
+    def listGpuLeases(self):
+        """ Print the GPUs leased by running jobs and the waiting requests. """
+        if not (hosts := GpuLeaseManager(self.path).status()):
+            return
+        format = u'{:<20}{:<10}{:<35}{:<10}{:<10}{:<20}'
+        print(f"\n{Color.bold('GPU LEASES')}")
+        print(format.format("HOST", "STATE", "OWNER", "PID", "PRIORITY", "GPUS"))
+        for host, state in hosts:
+            for lease in state['leases'].values():
+                print(format.format(host, 'leased', lease['owner'], lease['pid'],
+                                    lease['priority'], ' '.join(map(str, lease['gpus']))))
+            for request in sorted(state['waiting'].values(),
+                                  key=lambda r: (-r['priority'], r['time'])):
+                print(format.format(host, 'waiting', request['owner'], request['pid'],
+                                    request['priority'], f"({request['n']} requested)"))
 
     def listOutputs(self):
         """ List current jobs. """
@@ -121,82 +251,114 @@ class ProjectManager(FolderManager):
         format = u'{:<20}{:<55}{:<45}{:<45}'
         print(format.format(*header))
 
-        for job in self._wf.jobs():
-            filesDict = self.loadJobOutputs(job)
-            for o in job.outputs:
-                if oInfo := filesDict.get(o.id, None):
+        for row in self._jobRows():
+            filesDict = self._loadJobOutputs(row['id'])
+            for oid in row['outputs']:
+                if oInfo := filesDict.get(oid, None):
                     datatype = oInfo['type']
                     info = oInfo['info']
                 else:
                     datatype = 'No-type'
                     info = 'No-info'
 
-                print(format.format(job.id, o.id, datatype, info))
+                print(format.format(row['id'], oid, datatype, info))
 
     def listInputs(self):
         header = ["JOB_ID", "KEY", "INPUT", "DATATYPE", "INFO"]
         format = u'{:<20}{:25}{:<45}{:<35}{:<45}'
 
         # Build the list of outputs for all jobs
+        rows = self._jobRows()
         filesDict = {}
-        for job in self._wf.jobs():
-            jobFilesDict = self.loadJobOutputs(job)
+        sources = {}  # output file -> job id
+        for row in rows:
+            jobFilesDict = self._loadJobOutputs(row['id'])
             filesDict.update(jobFilesDict)
+            sources.update({fn: row['id'] for fn in jobFilesDict})
             # for k, v in jobFilesDict.items():
             #     if not job.hasOutput(k):
             #         job.registerOutput(k, )
 
-        for job in self._wf.jobs():
-            params = self._readJobParams(job)
+        # Inputs already registered in the workflow are known by the index
+        knownInputs = {(jobId, v) for jobId, _, v, _ in self._index.inputs()}
+        update = False
+        for row in rows:
+            jobId = row['id']
+            params = self._readJobParams(jobId)
             for k, v in params.items():
                 if v in filesDict:
                     info = filesDict[v]
-                    print(format.format(job.id, k, v, info['type'], info['info']))
-                    if not job.hasInput(v):
-                        job.addInputs([self._wf.getData(v)])
+                    print(format.format(jobId, k, v, info['type'], info['info']))
+                    if (jobId, v) not in knownInputs:
+                        job = self._wf.getJob(jobId)
+                        if not job.hasInput(v):
+                            job.addInputs([self._wf.getData(v)])
+                            update = True
+                        self._index.addInput(jobId, k, v, sources[v])
 
-        self._update_pipeline_star()
+        if update:
+            self._update_pipeline_star()
 
 
     def update(self):
         """ Update status of the running jobs. """
+        if self._txDepth:
+            return  # Already done when the transaction started
         self.log("Updating project.")
         t = Timer()
         update = False
-        for job in self._wf.jobs():
-            if self._isActiveJob(job):
-                for statusFile, status in JOB_STATUS_FILES.items():
-                    if self.exists(job.id, statusFile):
-                        job['status'] = status
-                        update = True
-
-                if jobInfo := self.loadJobInfo(job):
-                    for k, o in jobInfo['outputs'].items():
-                        for fn, datatype in o['files']:
+        # Only active jobs are checked, taken from the index if
+        # the pipeline did not change
+        active = [row for row in self._jobRows() if row['status'] in JOB_STATUS_ACTIVE]
+        statuses = self._getTracker().refresh({row['id']: row['status'] for row in active})
+        for row in active:
+            jobId = row['id']
+            if status := statuses.get(jobId, None):
+                self._wf.getJob(jobId)['status'] = row['status'] = status
+                update = True
+
+            if jobInfo := self._loadJobInfo(jobId):
+                for k, o in jobInfo['outputs'].items():
+                    for fn, datatype in o['files']:
+                        if fn not in row['outputs']:
+                            job = self._wf.getJob(jobId)
                             if not job.hasOutput(fn):
                                 job.registerOutput(fn, datatype=datatype)
                                 update = True
 
-                # # FIXME: this is a quick and dirty to define some known
-                # # output star files for tomography
-                # jobPath = self.join(job.id)
-                #
-                # def _is_output(fn):
-                #     return (fn.endswith('.star') and
-                #             (fn.startswith('tomograms') or
-                #              fn.startswith('tilt_series')))
-                #
-                # for fn in os.listdir(jobPath):
-                #     if _is_output(fn):
-                #         dataId = os.path.join(job.id, fn)
-                #         if not job.hasOutput(dataId):
-                #             job.registerOutput(dataId, datatype='File')
+            # # FIXME: this is a quick and dirty to define some known
+            # # output star files for tomography
+            # jobPath = self.join(job.id)
+            #
+            # def _is_output(fn):
+            #     return (fn.endswith('.star') and
+            #             (fn.startswith('tomograms') or
+            #              fn.startswith('tilt_series')))
+            #
+            # for fn in os.listdir(jobPath):
+            #     if _is_output(fn):
+            #         dataId = os.path.join(job.id, fn)
+            #         if not job.hasOutput(dataId):
+            #             job.registerOutput(dataId, datatype='File')
 
         if update:
             self._update_pipeline_star()
 
         self.log(t.getToc("Update took"))
 
+    def _getTracker(self):
+        """ Tracker of the status of active jobs, through status files
+        and the queue status command of submitted jobs. """
+        if self._tracker is None:
+            def _getQueue(jobId):
+                params = self._readJobParams(jobId)
+                return ProcessingConfig.get_queue(params.get('queue.name', 'None'))
+
+            self._tracker = JobStatusTracker(self.path, JOB_STATUS_FILES,
+                                             'RELION_JOB_EXIT_FAILURE',
+                                             getQueue=_getQueue, log=self.log)
+        return self._tracker
+
     def _validateJobInputs(self, jobDef, params):
         """ Validate that provide values match with the job definition.
         For example, format values or that PathParam exists.
@@ -206,14 +368,25 @@ class ProjectManager(FolderManager):
     def _updateJobInputs(self, job, params):
         # Clear jobs inputs and add new ones
         job.clearInputs()
+        jobIds = {row['id'] for row in self._jobRows()}
+        edges = []
         for k, v in params.items():
-            for job2 in self._wf.jobs():
-                if _param_references_job(v, job2.id):
+            if not isinstance(v, str):
+                continue
+            # Look up the job ids that the value may reference (the value
+            # itself or any of its parent folders), instead of all jobs
+            parts = v.split('/')
+            for i in range(len(parts), 0, -1):
+                jobId2 = '/'.join(parts[:i])
+                if jobId2 in jobIds and _param_references_job(v, jobId2):
                     # In this case the saved job is taking an input from this job
+                    job2 = self._wf.getJob(jobId2)
                     data = job2.getOutput(v)
                     if data is None:
                         data = job2.registerOutput(v, datatype="File")
                     job.addInputs([data])
+                    edges.append((k, v, jobId2))
+        self._index.setInputs(job.id, edges)
 
     def saveJob(self, jobTypeOrId, params, update=True):
         """ Save a job. If jobId = None, a new job is created
@@ -249,9 +422,10 @@ class ProjectManager(FolderManager):
 
     def copyJob(self, jobId, params=None):
         """ Make a copy of an existing job and optionally update some params. """
-        job = self._getJob(jobId)
-        job_params = self._readJobParams(job, extraParams=params)
-        self.saveJob(job['jobtype'], job_params)
+        with self.transaction():
+            job = self._getJob(jobId)
+            job_params = self._readJobParams(job, extraParams=params)
+            return self.saveJob(job['jobtype'], job_params)
 
     def _instanciateJobs(self, jobDict):
         """
@@ -277,24 +451,26 @@ class ProjectManager(FolderManager):
                     return v.replace(p, newIdsDict[p], 1) if p in newIdsDict else ''
             return v
 
-        while remaining:
-            ready = [
-                jobId for jobId in remaining
-                if jobDict[jobId]['parents'].issubset(newIdsDict)
-            ]
-            if not ready:
-                raise Exception(
-                    "Workflow job dependency cycle or missing parent references."
-                )
-
-            for jobId in ready:
-                jobInfo = jobDict[jobId]
-                params = jobInfo['params']
-                new_params = {k: _new_value(v, jobInfo['parents'])
-                              for k, v in params.items()}
-                newJob = self.saveJob(jobInfo['jobtype'], new_params)
-                newIdsDict[jobId] = newJob.id
-                remaining.remove(jobId)
+        # All jobs are created in a single transaction
+        with self.transaction():
+            while remaining:
+                ready = [
+                    jobId for jobId in remaining
+                    if jobDict[jobId]['parents'].issubset(newIdsDict)
+                ]
+                if not ready:
+                    raise Exception(
+                        "Workflow job dependency cycle or missing parent references."
+                    )
+
+                for jobId in ready:
+                    jobInfo = jobDict[jobId]
+                    params = jobInfo['params']
+                    new_params = {k: _new_value(v, jobInfo['parents'])
+                                  for k, v in params.items()}
+                    newJob = self.saveJob(jobInfo['jobtype'], new_params)
+                    newIdsDict[jobId] = newJob.id
+                    remaining.remove(jobId)
 
         return newIdsDict
 
@@ -409,6 +585,171 @@ class ProjectManager(FolderManager):
 
         return job
 
+    def runJobs(self, jobIds, clean=False):
+        """ Run a group of jobs (e.g. the jobs of a loaded workflow) at once.
+
+        Jobs that go to a cluster queue are all submitted now, each one
+        depending on the jobs it takes inputs from (afterok in SLURM,
+        done() in LSF), so the scheduler starts them when their parents
+        succeed. Jobs of the same type, queue settings and parents are
+        submitted as a single array job. Jobs running locally are started
+        directly, so they can not depend on other jobs of the group.
+        """
+        self.update()
+        jobs = OrderedDict()
+        for jobId in map(Path.rmslash, jobIds):
+            job = self._getJob(jobId)
+            if self._isActiveJob(job):
+                raise Exception(f"Can not re-run running or launched job {jobId}.")
+            jobs[jobId] = job
+
+        params = {jobId: self._readJobParams(job) for jobId, job in jobs.items()}
+        queues = {jobId: self._jobQueue(params[jobId]) for jobId in jobs}
+        parents = self._jobParents(params)
+
+        for jobId, jobParents in parents.items():
+            schedulers = {_queue_type(queues[j]) if queues[j] else None
+                          for j in jobParents | {jobId}}
+            if jobParents and (None in schedulers or len(schedulers) > 1):
+                raise Exception(f"Job {jobId} and its parents {', '.join(sorted(jobParents))} "
+                                f"should be submitted to queues of the same cluster.")
+
+        # Not a transaction: jobs already started or submitted can not be
+        # rolled back, so their status is saved as soon as they are launched
+        queueIds = {}  # job id -> cluster id used for dependencies
+        for level in self._jobLevels(parents):
+            groups = OrderedDict()
+            for jobId in level:
+                job = jobs[jobId]
+                cmd = self._prepareRun(job, params[jobId], clean=clean)
+                if queues[jobId] is None:
+                    self._runLocalCmd(cmd, self.join(jobId))
+                    job['status'] = STATUS_LAUNCHED
+                    self._update_pipeline_star()
+                else:
+                    # Jobs with the same submission script, except the command
+                    qparams = {k: v for k, v in params[jobId].items()
+                               if k.startswith('queue.') or k in ['cpus', 'gpus']}
+                    key = (job['jobtype'], json.dumps(qparams, sort_keys=True),
+                           tuple(sorted(parents[jobId])))
+                    groups.setdefault(key, []).append((jobId, cmd))
+
+            for group in groups.values():
+                self._submitGroup(group, params, parents, queueIds)
+                self._update_pipeline_star()
+
+        return queueIds
+
+    def runWorkflow(self, jobIds=None, clean=False, cpus=None, gpus=None):
+        """ Run a group of jobs locally, in dependency order, and wait
+        until all of them finish. By default, all saved jobs are run.
+        See WorkflowRunner for details. """
+        from .workflow_runner import WorkflowRunner
+
+        self.update()
+        if not jobIds:
+            jobIds = [row['id'] for row in self._jobRows() if row['status'] == STATUS_SAVED]
+        runner = WorkflowRunner(self, [Path.rmslash(j) for j in jobIds],
+                                cpus=cpus, gpus=gpus)
+        return runner.run(clean=clean)
+
+    def _jobParents(self, params):
+        """ Return the parents of each job (the jobs it takes inputs from)
+        within the given dict of job id -> params. """
+        return {jobId: {p for p in params if p != jobId and
+                        any(_param_references_job(v, p) for v in jobParams.values())}
+                for jobId, jobParams in params.items()}
+
+    @staticmethod
+    def _jobLevels(parents):
+        """ Group the jobs by levels, where jobs only depend on previous levels. """
+        levels = []
+        done = set()
+        while len(done) < len(parents):
+            if not (level := [j for j in parents if j not in done and parents[j] <= done]):
+                raise Exception("Job dependency cycle among the given jobs.")
+            levels.append(level)
+            done.update(level)
+        return levels
+
+    def _prepareRun(self, job, params, clean=False):
+        """ Write the params and command of a job before running it.
+        Return the command. """
+        if clean:
+            self._deleteJobFolder(job)
+            self.mkdir(job.id)
+        self._updateJobInputs(job, params)
+        self._writeJobParams(job, params)
+        launcher = ProcessingConfig.get_job_launcher(job['jobtype'])
+        if not launcher:
+            raise Exception(f"Invalid launcher for job type: {job['jobtype']}")
+        cmd = f"{launcher} -i {os.path.join(job.id, 'job.star')} -o {job.id}"
+        self._saveCmd(cmd, job.id)
+        return cmd
+
+    def _finishLocalJob(self, jobId, returnCode):
+        """ Set the status of a local job after its process finished.
+        If the process did not write any exit status file, it is written
+        from the return code. """
+        job = self._getJob(jobId)
+        if not any(self.exists(jobId, f) for f in JOB_STATUS_FILES
+                   if f.startswith('RELION_JOB_EXIT')):
+            statusFile = 'RELION_JOB_EXIT_SUCCESS' if returnCode == 0 else 'RELION_JOB_EXIT_FAILURE'
+            self._log(f"Process finished with code {returnCode}, writing {statusFile}",
+                      jobFile=self.join(jobId, 'job.log'))
+            open(self.join(jobId, statusFile), 'w').close()
+
+        for statusFile, status in JOB_STATUS_FILES.items():
+            if self.exists(jobId, statusFile):
+                job['status'] = status
+        self._update_pipeline_star()
+        return job['status']
+
+    def _submitGroup(self, group, params, parents, queueIds):
+        """ Submit a list of (jobId, cmd) with the same queue settings and
+        parents, as an array job if there is more than one. """
+        firstId = group[0][0]
+        queue = self._jobQueue(params[firstId])
+        if missing := sorted(p for p in parents[firstId] if p not in queueIds):
+            for jobId, _ in group:
+                self._log(f"Job {jobId} not submitted, parent jobs were not "
+                          f"submitted: {', '.join(missing)}",
+                          jobFile=self.join(jobId, 'job.log'))
+            return
+
+        dependencies = [queueIds[p] for p in sorted(parents[firstId])]
+        if len(group) == 1:
+            jobId, cmd = group[0]
+            submission = self._prepareQueueSubmission(
+                cmd, params[jobId], self.join(jobId), job_id=jobId,
+                directives=_queue_directives(queue, dependencies))
+            clusterIds = [self._executeQueueSubmission(submission)]
+        else:
+            # Each element runs the command of one job, with its own logs
+            var = _queue_array_var(queue)
+            cases = ''.join(f"    {i}) {cmd} >> {jobId}/run.out 2>> {jobId}/run.err ;;\n"
+                            for i, (jobId, cmd) in enumerate(group, 1))
+            directives = _queue_directives(queue, dependencies, arraySize=len(group),
+                                           name=f"emw_{firstId.replace('/', '_')}")
+            submission = self._prepareQueueSubmission(
+                f'case "${var}" in\n{cases}esac', params[firstId], self.join(firstId),
+                job_id=firstId, directives=directives, script_name='job_array.script')
+            if arrayId := self._executeQueueSubmission(submission):
+                clusterIds = [_queue_array_element(queue, arrayId, i)
+                              for i in range(1, len(group) + 1)]
+            else:
+                clusterIds = [None] * len(group)
+
+        for (jobId, _), clusterId in zip(group, clusterIds):
+            if clusterId:
+                if len(group) > 1:
+                    self._log(f"Submitted as element of array job: {clusterId}",
+                              jobFile=self.join(jobId, 'job.log'), flush=True)
+                    with open(self.join(jobId, 'job.id'), 'w') as f:
+                        f.write(clusterId)
+                queueIds[jobId] = clusterId
+                self._getJob(jobId)['status'] = STATUS_LAUNCHED
+
     def stopJob(self, jobId):
         """ Stop a job. """
         job = self._getJob(jobId)
@@ -464,6 +805,7 @@ class ProjectManager(FolderManager):
             if job := self._getJob(jobId, validateExists=False):
                 self._deleteJobFolder(job)
                 self._wf.deleteJob(job)
+                self._index.deleteJob(jobId)
                 deleted.append(jobId)
             else:
                 raise Exception(f"{jobTypeOrId} is not an existing jobId or job type.")
@@ -488,8 +830,16 @@ class ProjectManager(FolderManager):
         RelionStar.write_pipeline(self.pipeline_star)
 
     def _update_pipeline_star(self):
+        if self._txDepth:
+            self._txDirty = True  # Written when the transaction is committed
+            return
         self.log(f"Updating {self.pipeline_star}")
-        RelionStar.workflow_to_pipeline(self._wf, self.pipeline_star)
+        # Write to a temporary file and rename, so readers never
+        # see a partially written pipeline
+        tmpStar = self.pipeline_star.replace('.star', f'.{os.getpid()}.tmp.star')
+        RelionStar.workflow_to_pipeline(self._wf, tmpStar)
+        os.replace(tmpStar, self.pipeline_star)
+        self._index.setJobs(self.pipeline_star, self._wf)
 
     def _saveCmd(self, cmd, jobId):
         """ Write command.txt file to be used for restart. """
@@ -531,8 +881,15 @@ class ProjectManager(FolderManager):
         RelionStar.write_jobstar(job_type, values, job_star,
                                  isTomo=is_tomo, isContinue=is_continue)
 
-    def _prepareQueueSubmission(self, cmd, job_params, folder_path, job_id=None):
-        """Build cluster submission script content and command for a job folder."""
+    def _jobQueue(self, job_params):
+        """ Return the queue config where the job will be submitted, or None. """
+        qname = (job_params or {}).get('queue.name', 'None')
+        return None if qname == 'None' else ProcessingConfig.get_queue(qname)
+
+    def _prepareQueueSubmission(self, cmd, job_params, folder_path, job_id=None,
+                                directives=None, script_name='job.script'):
+        """Build cluster submission script content and command for a job folder.
+        Optional directives (e.g. dependencies) are added to the script."""
         qname = job_params.get('queue.name', 'NO-NAME')
         if qname == 'None':
             return None
@@ -546,7 +903,7 @@ class ProjectManager(FolderManager):
         qparams = {k.replace(qprefix, ''): v for k, v in job_params.items()
                    if k.startswith(qprefix)}
 
-        script_file = os.path.join(folder_path, 'job.script')
+        script_file = os.path.join(folder_path, script_name)
         script_log = os.path.join(folder_path, 'job.log')
         gpus = int(job_params.get('gpus', 0))   # FIXME Get gpu list and take the length
 
@@ -589,7 +946,7 @@ class ProjectManager(FolderManager):
         with open(queue['template'], 'r') as f:
             template = f.read()
 
-        script_content = template.format(**qparams)
+        script_content = _add_directives(template.format(**qparams), directives)
         mapped_script = self.__fixMapping(queue, script_file)
         submit_cmd = queue['submit'].format(job_script=mapped_script)
 
@@ -641,6 +998,7 @@ class ProjectManager(FolderManager):
                              stdout=stdout, stderr=stderr, close_fds=True)
         if wait:
             p.wait()
+        return p
 
     def submitJob(self, job_type, params, output_folder, dry=False):
         """Submit a job outside the project workflow.
@@ -713,9 +1071,12 @@ class ProjectManager(FolderManager):
 
     def _readJobParams(self, job, extraParams=None):
         """ Read params from job.star and optionally update
-        some of the params.
+        some of the params. Job can be the job or its id.
         """
-        job_params = RelionStar.read_jobstar(self.join(job.id, 'job.star'))
+        jobId = getattr(job, 'id', job)
+        jobStar = self.join(jobId, 'job.star')
+        job_params = self._index.cached('params', jobId, [jobStar],
+                                        lambda: RelionStar.read_jobstar(jobStar))
         if extraParams:
             job_params.update(extraParams)
         return job_params
@@ -742,6 +1103,9 @@ class ProjectManager(FolderManager):
                                    alias='None',    
                                    jobtype=jobType)
 
+        if self._txDepth:
+            self._txCreated.append(job)
+
         # Write job.star file
         self._writeJobParams(job, params)
 
@@ -766,15 +1130,20 @@ class ProjectManager(FolderManager):
 
     def loadJobInfo(self, job):
         """ Load the info.json file for a given run. """
-        jobInfoFn = self.join(job.id, 'info.json')
-        if os.path.exists(jobInfoFn):
-            with open(jobInfoFn) as f:
-                return json.load(f)
-        return None
+        return self._loadJobInfo(job.id)
+
+    def _loadJobInfo(self, jobId):
+        infoFile = self.join(jobId, 'info.json')
+        return self._index.cached('info', jobId,
+                                  [infoFile, InfoJournal.journal_path(infoFile)],
+                                  lambda: InfoJournal.read(infoFile))
 
     def loadJobOutputs(self, job):
+        return self._loadJobOutputs(job.id)
+
+    def _loadJobOutputs(self, jobId):
         filesDict = {}
-        if jobInfo := self.loadJobInfo(job):
+        if jobInfo := self._loadJobInfo(jobId):
             filesDict = {o['files'][0][0]: o for o in jobInfo['outputs'].values()}
         return filesDict
 
@@ -809,14 +1178,13 @@ class ProjectManager(FolderManager):
         orig_basename = os.path.basename(orig_path)
 
         info_path = os.path.join(job_folder, 'info.json')
-        if not os.path.isfile(info_path):
+        info = InfoJournal.read(info_path)
+        if info is None:
             raise FileNotFoundError(
                 f"No info.json in job folder {job_folder}. "
                 "Subset registration requires an existing job with info.json."
             )
 
-        with open(info_path) as f:
-            info = json.load(f)
         outputs = info.get('outputs') or {}
 
         # Find output whose file matches original_set (by basename; paths in info are relative to job folder)
@@ -851,8 +1219,9 @@ class ProjectManager(FolderManager):
         outputs[subset_key] = subset_entry
         info['outputs'] = outputs
 
-        with open(info_path, 'w') as f:
-            json.dump(info, f, indent=4)
+        # Append to the journal, the job might still be running and
+        # writing to it, its next compaction will merge this event
+        InfoJournal(info_path).append(info, ['outputs', subset_key], subset_entry)
         self.log(f"Registered subset: {subset_key} -> {subset_stored} in {info_path}")
 
         # Register the subset in the job's outputs (workflow) and update pipeline star
@@ -889,6 +1258,16 @@ class ProjectManager(FolderManager):
                             "or re-run an existing one passing job_id."
                             "If --clean is added, the output folder will "
                             "be cleaned before running the job. ")
+        g.add_argument('--run-jobs', nargs='+', metavar='JOB_IDS',
+                       help="Run several saved jobs at once. Jobs submitted to "
+                            "a cluster queue wait for their parent jobs in the "
+                            "scheduler, and similar jobs are submitted as "
+                            "array jobs.")
+        g.add_argument('--run-workflow', nargs='*', metavar='JOB_IDS',
+                       help="Run saved jobs locally (all of them if no ids are "
+                            "given) following their dependencies, and wait "
+                            "until they finish. Independent jobs run at the same "
+                            "time within --max-cpus and --max-gpus.")
         g.add_argument('--save', '-s', nargs=2,
                        metavar=('JOB_TYPE_OR_ID', 'PARAMS'),
                        help="Save an existing job or create a new one, "
@@ -931,6 +1310,13 @@ class ProjectManager(FolderManager):
                        help="With --submit, print the run or queue submission "
                             "commands without writing files or executing.")
 
+        p.add_argument('--max-cpus', type=int, default=None,
+                       help="With --run-workflow, maximum number of CPUs used "
+                            "by running jobs (default: all CPUs).")
+        p.add_argument('--max-gpus', type=int, default=None,
+                       help="With --run-workflow, maximum number of GPUs used "
+                            "by running jobs (default: all GPUs).")
+
         p.add_argument('--wait', '-w', action='store_true',
                        help="Works with --run and make the project waits for "
                             "the sub-process to complete. Useful for scripting "
@@ -977,6 +1363,13 @@ class ProjectManager(FolderManager):
                       clean=args.clean,
                       wait=args.wait)
 
+        elif args.run_jobs:
+            pm.runJobs(args.run_jobs, clean=args.clean)
+
+        elif args.run_workflow is not None:
+            pm.runWorkflow(args.run_workflow, clean=args.clean,
+                           cpus=args.max_cpus, gpus=args.max_gpus)
+
         elif args.copy:
             jobId = args.copy[0]
             pm.copyJob(jobId,  _params(args.copy, 1))
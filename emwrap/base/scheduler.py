@@ -0,0 +1,339 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import re
+import time
+import signal
+import queue
+import threading
+import statistics
+import subprocess
+from collections import deque
+
+from emtools.utils import Color
+
+
+class GpuDevice:
+    """ State of a single GPU in the scheduler. """
+    def __init__(self, gpu, slots):
+        self.gpu = gpu
+        self.slots = slots
+        self.active = 0
+        self.tasks = 0
+        self.failures = 0  # consecutive device failures
+        self.totalFailures = 0
+        self.errors = 0  # task failures not related to the device
+        self.disabled = False
+        self.disabledAt = None
+        self.busy = 0.0  # seconds, summed over slots
+
+    def stats(self, wall):
+        return {
+            'slots': self.slots,
+            'active': self.active,
+            'tasks': self.tasks,
+            'failures': self.totalFailures,
+            'errors': self.errors,
+            'disabled': self.disabled,
+            'busy': round(self.busy, 1),
+            'idle': round(max(0.0, wall * self.slots - self.busy), 1)
+        }
+
+
+class GpuScheduler:
+    """ Assign GPUs to the tasks of pipeline processors.
+
+    Each GPU has a number of slots (concurrent tasks). A task gets the
+    healthy GPU with the fewest active tasks. Only failures pointing to the
+    device (CUDA/driver errors, GPU programs that crashed) count against a
+    GPU, after maxFailures consecutive ones it is taken out of rotation.
+    A disabled GPU is tried again after a cool-down, if the optional probe
+    succeeds, and one more device failure disables it again. Failures of
+    the task itself (e.g. bad inputs) are only counted as errors.
+    If a clone function is given,
+    a task running much longer than usual (stragglerFactor times the median
+    duration) is speculatively re-dispatched to another GPU with a free
+    slot; the first attempt to finish successfully is used.
+    """
+    # CUDA and driver error signatures, that point to a GPU problem
+    # and not to the task inputs
+    DEVICE_ERRORS = re.compile(r'CUDA error|CUDA driver|cudaError\w+|CUDA_ERROR_\w+|'
+                               r'CUBLAS_STATUS_|CUFFT_\w*(?:ERROR|FAILED)|CUDNN_STATUS_|'
+                               r'out of memory.{0,40}CUDA|'
+                               r'CUDA.{0,40}out of memory|no CUDA-capable device|'
+                               r'\bXid\b|\bECC\b')
+    # Signals of crashed programs, not of programs killed by the user
+    # or by the system (e.g. the OOM killer)
+    DEVICE_SIGNALS = {signal.SIGSEGV, signal.SIGBUS, signal.SIGABRT}
+
+    def __init__(self, gpus, slots=1, maxFailures=3, stragglerFactor=3.0,
+                 minSamples=5, checkInterval=10, cooldown=600, probe=None,
+                 log=print):
+        """
+        Args:
+            gpus: list of GPU ids
+            slots: number of slots per GPU, either an int or a dict gpu -> slots
+            maxFailures: consecutive failures before disabling a GPU
+            stragglerFactor: tasks slower than this factor times the median
+                task duration are considered stragglers
+            minSamples: number of finished tasks before detecting stragglers
+            checkInterval: seconds between straggler checks
+            cooldown: seconds before a disabled GPU is tried again,
+                None to never re-enable it
+            probe: optional function called with the GPU id when the
+                cool-down ends, the GPU is only re-enabled if it returns
+                True (e.g. see probe_nvidia_smi)
+        """
+        if not isinstance(slots, dict):
+            slots = {gpu: int(slots) for gpu in gpus}
+        self.devices = {gpu: GpuDevice(gpu, slots.get(gpu, 1)) for gpu in gpus}
+        self.maxFailures = maxFailures
+        self.stragglerFactor = stragglerFactor
+        self.minSamples = minSamples
+        self.checkInterval = checkInterval
+        self.cooldown = cooldown
+        self.probe = probe
+        self.log = log
+        self.speculative = 0
+        self._durations = deque(maxlen=100)
+        self._start = time.time()
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def parse_slots(value, gpus):
+        """ Parse slots from an int or a string like '0:2 1:1' (gpu:slots). """
+        if isinstance(value, int) or ':' not in str(value):
+            return {gpu: int(value) for gpu in gpus}
+        slots = {gpu: 1 for gpu in gpus}
+        for pair in str(value).split():
+            gpu, n = pair.split(':')
+            slots[type(gpus[0])(gpu) if gpus else gpu] = int(n)
+        return slots
+
+    @classmethod
+    def is_device_error(cls, error):
+        """ Return True if an error (exception or message) points to the
+        GPU: CUDA/driver errors in the message, or a process that crashed
+        (SIGSEGV, SIGBUS or SIGABRT). For process errors only the error
+        output is checked, never the command line. """
+        if not error:
+            return False
+        returnCode = getattr(error, 'returncode', None)
+        if returnCode is not None:
+            sig = -returnCode if returnCode < 0 else returnCode - 128
+            if sig in cls.DEVICE_SIGNALS:
+                return True
+        if isinstance(error, subprocess.CalledProcessError):
+            # The exception message is the command line
+            text = error.stderr or ''
+        else:
+            text = getattr(error, 'stderr', None) or str(error)
+        if isinstance(text, bytes):
+            text = text.decode(errors='replace')
+        return bool(cls.DEVICE_ERRORS.search(text))
+
+    @staticmethod
+    def probe_nvidia_smi(gpu):
+        """ Probe function that checks nvidia-smi can query the GPU.
+        If nvidia-smi is not available, GPUs are not probed. """
+        try:
+            result = subprocess.run(['nvidia-smi', '-i', str(gpu), '--query-gpu=name',
+                                     '--format=csv,noheader'],
+                                    capture_output=True, text=True, timeout=60)
+            return result.returncode == 0
+        except OSError:
+            return True
+        except subprocess.TimeoutExpired:
+            return False
+
+    @property
+    def totalSlots(self):
+        return sum(d.slots for d in self.devices.values())
+
+    def _available(self, exclude=()):
+        """ Return the healthy device with free slots and fewest active tasks. """
+        candidates = [d for d in self.devices.values()
+                      if not d.disabled and d.active < d.slots and d.gpu not in exclude]
+        return min(candidates, key=lambda d: d.active, default=None)
+
+    def _reenable(self):
+        """ Try again the disabled GPUs whose cool-down has ended.
+        Return the seconds until the next cool-down ends, or None. """
+        if self.cooldown is None:
+            return None
+        now = time.time()
+        nextWait = None
+        for d in self.devices.values():
+            if not d.disabled:
+                continue
+            wait = d.disabledAt + self.cooldown - now
+            if wait <= 0:
+                if self.probe is None or self.probe(d.gpu):
+                    d.disabled = False
+                    # One more device failure disables it again
+                    d.failures = self.maxFailures - 1
+                    self.log(Color.warn(f"GPU {d.gpu} enabled again after "
+                                        f"{self.cooldown} seconds."))
+                    continue
+                self.log(Color.red(f"GPU {d.gpu} probe failed, still disabled."))
+                d.disabledAt = now
+                wait = self.cooldown
+            nextWait = wait if nextWait is None else min(wait, nextWait)
+        return nextWait
+
+    def acquire(self, exclude=(), block=True):
+        """ Get a GPU with a free slot, waiting if none is free. """
+        with self._condition:
+            while True:
+                nextWait = self._reenable()
+                if d := self._available(exclude):
+                    d.active += 1
+                    d.tasks += 1
+                    return d.gpu
+                if not block:
+                    return None
+                if nextWait is None and all(d.disabled for d in self.devices.values()):
+                    raise Exception("No healthy GPUs left.")
+                self._condition.wait(nextWait)
+
+    def release(self, gpu, elapsed, ok, deviceError=False):
+        """ Free the slot of a task in the GPU.
+
+        Args:
+            gpu: GPU where the task ran
+            elapsed: seconds it took
+            ok: True if the task succeeded
+            deviceError: True if the task failed because of the GPU,
+                only these failures can disable it
+        """
+        with self._condition:
+            d = self.devices[gpu]
+            d.active -= 1
+            d.busy += elapsed
+            if ok:
+                d.failures = 0
+                self._durations.append(elapsed)
+            elif not deviceError:
+                d.errors += 1
+            else:
+                d.failures += 1
+                d.totalFailures += 1
+                if d.failures >= self.maxFailures and not d.disabled:
+                    d.disabled = True
+                    d.disabledAt = time.time()
+                    self.log(Color.red(f"GPU {gpu} disabled after {d.failures} "
+                                       f"consecutive device failures."))
+            self._condition.notify_all()
+
+    def _isStraggler(self, elapsed):
+        with self._condition:
+            if len(self._durations) < self.minSamples:
+                return False
+            return elapsed > self.stragglerFactor * statistics.median(self._durations)
+
+    @staticmethod
+    def _failed(result):
+        return bool(getattr(result, 'error', None))
+
+    @classmethod
+    def _deviceError(cls, result):
+        return cls.is_device_error(getattr(result, 'error', None))
+
+    def run(self, task, func, clone=None, discard=None, failed=None,
+            deviceError=None):
+        """ Run func(gpu)(task) in a scheduled GPU and return its result.
+
+        Args:
+            task: task to process (usually a batch)
+            func: function that receives the GPU and returns the
+                function that will process the task
+            clone: if not None, function to create a copy of the task that
+                can be processed in parallel, used for stragglers
+            discard: function called with the results of attempts that
+                are not used (e.g. to clean up their folders)
+            failed: function to check if a result is a failure, by
+                default the result's 'error' attribute is used
+            deviceError: function to check if a failed result points to
+                a GPU problem, by default is_device_error is used on the
+                result's 'error' attribute. Exceptions are always checked
+                with is_device_error.
+        """
+        results = queue.Queue()
+        failed = failed or self._failed
+        deviceError = deviceError or self._deviceError
+
+        def _attempt(gpu, t):
+            start = time.time()
+            ok = devError = False
+            try:
+                r = func(gpu)(t)
+                ok = not failed(r)
+                devError = not ok and deviceError(r)
+                results.put((ok, r, None))
+            except Exception as e:
+                devError = self.is_device_error(e)
+                results.put((False, t, e))
+            finally:
+                self.release(gpu, time.time() - start, ok, deviceError=devError)
+
+        def _start(gpu, t):
+            th = threading.Thread(target=_attempt, args=(gpu, t), daemon=True)
+            th.start()
+
+        gpu = self.acquire()
+        start = time.time()
+        _start(gpu, task)
+        pending = 1
+        speculated = False
+
+        while True:
+            checkStragglers = clone is not None and not speculated
+            try:
+                ok, r, exc = results.get(timeout=self.checkInterval if checkStragglers else None)
+            except queue.Empty:
+                if self._isStraggler(time.time() - start):
+                    if (gpu2 := self.acquire(exclude=[gpu], block=False)) is not None:
+                        self.log(Color.warn(f"Task running for {time.time() - start:0.1f} "
+                                            f"seconds on GPU {gpu}, re-dispatching to GPU {gpu2}"))
+                        speculated = True
+                        self.speculative += 1
+                        pending += 1
+                        _start(gpu2, clone(task))
+                continue
+
+            pending -= 1
+            if ok or pending == 0:
+                if pending and discard is not None:
+                    # Discard the other attempt when it finishes
+                    def _discard():
+                        _, other, _ = results.get()
+                        discard(other)
+                    threading.Thread(target=_discard, daemon=True).start()
+                if exc is not None:
+                    raise exc
+                return r
+            elif discard is not None:
+                discard(r)
+
+    def stats(self):
+        """ Return a JSON-friendly dict with the per-device stats. """
+        with self._condition:
+            wall = time.time() - self._start
+            return {
+                'devices': {str(d.gpu): d.stats(wall) for d in self.devices.values()},
+                'speculative': self.speculative,
+                'median_task': round(statistics.median(self._durations), 1) if self._durations else None
+            }
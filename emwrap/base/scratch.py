@@ -0,0 +1,127 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+SCRATCH_VAR = 'EMWRAP_SCRATCH'
+DEFAULT_ROOTS = ['/scr', '/scratch', '/local/scratch', '/tmp']
+
+
+class ScratchManager:
+    """ Manage batch folders in local scratch space.
+
+    Candidate roots are taken from the given roots, the EMWRAP_SCRATCH
+    variable (colon separated) and some usual locations. Before creating
+    a batch folder, the estimated size is reserved in the first root with
+    enough free space (free space minus the active reservations). If none
+    has enough space, it waits until other batches release theirs.
+    """
+    def __init__(self, roots=None, minFree=10 * 1024 ** 3, timeout=3600, sleep=30):
+        """
+        Args:
+            roots: list (or colon separated string) of preferred scratch roots
+            minFree: bytes that should always be left free in a root
+            timeout: seconds to wait for space before failing
+            sleep: seconds between free space checks while waiting
+        """
+        self.roots = self.discover(roots)
+        if not self.roots:
+            raise Exception("No writable scratch folder found.")
+        self.minFree = minFree
+        self.timeout = timeout
+        self.sleep = sleep
+        self._reservations = {}  # key -> (root, size, path)
+        self._reserved = {root: 0 for root in self.roots}
+        self._highWater = {root: 0 for root in self.roots}
+        self._waits = 0
+        self._fallbacks = 0
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def discover(roots=None):
+        """ Return existing and writable scratch roots, in order of preference. """
+        if isinstance(roots, str):
+            roots = roots.split(':')
+        candidates = list(roots or [])
+        candidates += os.environ.get(SCRATCH_VAR, '').split(':')
+        candidates += DEFAULT_ROOTS
+
+        result, seen = [], set()
+        for root in candidates:
+            if not root or not os.path.isdir(root) or not os.access(root, os.W_OK):
+                continue
+            real = os.path.realpath(root)
+            if real not in seen:
+                seen.add(real)
+                result.append(root)
+        return result
+
+    def _available(self, root):
+        return shutil.disk_usage(root).free - self._reserved[root] - self.minFree
+
+    def reserve(self, key, size, prefix='emwrap_'):
+        """ Reserve size bytes and create a temporary folder for key.
+        Return the path of the new folder.
+        """
+        start = time.time()
+        with self._condition:
+            waited = False
+            while True:
+                for i, root in enumerate(self.roots):
+                    if self._available(root) >= size:
+                        path = tempfile.mkdtemp(prefix=prefix, dir=root)
+                        self._reservations[key] = (root, size, path)
+                        self._reserved[root] += size
+                        self._highWater[root] = max(self._highWater[root],
+                                                    self._reserved[root])
+                        if i > 0:
+                            self._fallbacks += 1
+                        return path
+                if time.time() - start > self.timeout:
+                    raise Exception(f"Not enough scratch space for {key} "
+                                    f"({size} bytes) after {self.timeout} seconds.")
+                if not waited:
+                    self._waits += 1
+                    waited = True
+                self._condition.wait(self.sleep)
+
+    def release(self, key, remove=True):
+        """ Release the reservation of key, removing its folder. """
+        with self._condition:
+            if key not in self._reservations:
+                return
+            root, size, path = self._reservations.pop(key)
+            self._reserved[root] -= size
+            if remove and os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+            self._condition.notify_all()
+
+    def stats(self):
+        """ Return a JSON-friendly dict with the current usage. """
+        with self._condition:
+            return {
+                'roots': {root: {'reserved': self._reserved[root],
+                                 'high_water': self._highWater[root],
+                                 'free': shutil.disk_usage(root).free}
+                          for root in self.roots},
+                'active': len(self._reservations),
+                'waits': self._waits,
+                'fallbacks': self._fallbacks
+            }
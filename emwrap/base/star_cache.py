@@ -0,0 +1,203 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import json
+import shutil
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+from emtools.utils import Color, Pretty
+from emtools.metadata import StarFile
+
+from .star_columns import ColumnTable
+
+CACHE_VAR = 'EMWRAP_STAR_CACHE'
+
+
+class StarCache:
+    """ Binary sidecar with the parsed tables of a STAR file.
+
+    The sidecar is a hidden folder next to the file (.<name>.cache) with
+    the columns of each table (values, and codes of dictionary-encoded
+    columns, as used by ColumnTable) stored as .npy files, that are
+    memory-mapped when loaded. It is only used if the size and
+    modification time of the STAR file did not change since it was
+    written, so it is safe for files that are still growing.
+
+    The cache is opt-in: set EMWRAP_STAR_CACHE=1 to use it when reading
+    STAR files from emwrap, or pre-warm files with emw-star-cache.
+    """
+    VERSION = 2
+    SUFFIX = '.cache'
+
+    @staticmethod
+    def enabled(value=None):
+        """ Return value if not None, otherwise if the cache
+        is enabled through the environment variable. """
+        if value is not None:
+            return bool(value)
+        return os.environ.get(CACHE_VAR, '0').lower() in ['1', 'true', 'yes']
+
+    @classmethod
+    def path(cls, fileName):
+        """ Path of the sidecar folder for a STAR file. """
+        folder, base = os.path.split(os.path.abspath(fileName))
+        return os.path.join(folder, f'.{base}{cls.SUFFIX}')
+
+    @staticmethod
+    def _key(fileName):
+        st = os.stat(fileName)
+        return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+    def load(self, fileName):
+        """ Load the tables from the sidecar, or return None
+        if it does not exist or it is outdated. """
+        cachePath = self.path(fileName)
+        try:
+            with open(os.path.join(cachePath, 'meta.json')) as f:
+                meta = json.load(f)
+            if meta['version'] != self.VERSION or meta['key'] != self._key(fileName):
+                return None
+
+            def _load(fn):
+                return np.load(os.path.join(cachePath, fn), mmap_mode='r')
+
+            tables = OrderedDict()
+            for t, tableInfo in enumerate(meta['tables']):
+                tables[tableInfo['name']] = ColumnTable(
+                    OrderedDict((name, (_load(f't{t}_c{c}_values.npy'),
+                                        _load(f't{t}_c{c}_codes.npy') if encoded else None))
+                                for c, (name, encoded) in enumerate(zip(tableInfo['columns'],
+                                                                        tableInfo['encoded']))),
+                    singleRow=tableInfo['singleRow'])
+            return tables
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, fileName, tables, key):
+        """ Write the sidecar for the parsed tables of the file.
+
+        Args:
+            key: key of the file taken before parsing it. If the file
+                changed since then (e.g. new rows were appended while
+                parsing), the sidecar is not written.
+        Return False if it was not written (e.g. read-only folder).
+        """
+        cachePath = self.path(fileName)
+        tmpPath = f'{cachePath}.{os.getpid()}.tmp'
+        meta = {'version': self.VERSION, 'key': key, 'tables': []}
+        try:
+            os.makedirs(tmpPath, exist_ok=True)
+            for t, (name, table) in enumerate(tables.items()):
+                columns = list(table._columns.items())
+                meta['tables'].append({'name': name, 'singleRow': table.singleRow,
+                                       'columns': [colName for colName, _ in columns],
+                                       'encoded': [codes is not None for _, (_, codes) in columns]})
+                for c, (colName, (values, codes)) in enumerate(columns):
+                    np.save(os.path.join(tmpPath, f't{t}_c{c}_values.npy'), values)
+                    if codes is not None:
+                        np.save(os.path.join(tmpPath, f't{t}_c{c}_codes.npy'), codes)
+            with open(os.path.join(tmpPath, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            if self._key(fileName) != key:
+                shutil.rmtree(tmpPath, ignore_errors=True)
+                return False
+            self.purge(fileName)
+            os.rename(tmpPath, cachePath)
+            return True
+        except OSError:
+            shutil.rmtree(tmpPath, ignore_errors=True)
+            return False
+
+    def purge(self, fileName):
+        """ Remove the sidecar of the file, if any. """
+        cachePath = self.path(fileName)
+        if os.path.exists(cachePath):
+            shutil.rmtree(cachePath)
+            return True
+        return False
+
+    def getTables(self, fileName):
+        """ Return the tables of the file as ColumnTables, from the sidecar
+        if it is up to date, otherwise parsing the file and writing it. """
+        if (tables := self.load(fileName)) is None:
+            key = self._key(fileName)
+            tables = ColumnTable.parseFile(fileName)
+            self.save(fileName, tables, key)
+        return tables
+
+    def warm(self, fileName):
+        """ Write the sidecar if missing or outdated.
+        Return True if it was written. """
+        if self.load(fileName) is not None:
+            return False
+        key = self._key(fileName)
+        return self.save(fileName, ColumnTable.parseFile(fileName), key)
+
+
+def getTableFromFile(tableName, fileName, **kwargs):
+    """ Same as StarFile.getTableFromFile, but the table is loaded
+    from the StarCache sidecar when the cache is enabled. """
+    if not StarCache.enabled():
+        return StarFile.getTableFromFile(tableName, fileName, **kwargs)
+    table = ColumnTable.read(fileName, tableName, cache=True)
+    return table.toTable(guessType=kwargs.get('guessType', True),
+                         types=kwargs.get('types', None))
+
+
+def _starFiles(paths):
+    """ Iterate over STAR files in paths (files or folders). """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = [d for d in dirs if not d.endswith(StarCache.SUFFIX)]
+                for fn in sorted(files):
+                    if fn.endswith('.star'):
+                        yield os.path.join(root, fn)
+        else:
+            yield path
+
+
+def main():
+    p = argparse.ArgumentParser(prog='emw-star-cache',
+                                description="Manage binary sidecars of STAR files.")
+    p.add_argument('action', choices=['warm', 'purge', 'status'])
+    p.add_argument('paths', nargs='+', metavar='PATH',
+                   help="STAR files or folders (searched recursively).")
+    args = p.parse_args()
+
+    cache = StarCache()
+    for fn in _starFiles(args.paths):
+        if args.action == 'warm':
+            status = Color.green('written') if cache.warm(fn) else 'up to date'
+        elif args.action == 'purge':
+            status = Color.red('removed') if cache.purge(fn) else 'no cache'
+        else:
+            cachePath = cache.path(fn)
+            if not os.path.exists(cachePath):
+                status = 'no cache'
+            elif cache.load(fn) is None:
+                status = Color.red('outdated')
+            else:
+                size = sum(e.stat().st_size for e in os.scandir(cachePath))
+                status = Color.green(f'cached ({Pretty.size(size)})')
+        print(f"{fn}: {status}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import re
+from collections import OrderedDict
+
+import numpy as np
+from emtools.metadata import Table
+
+
+class ColumnTable:
+    """ Columnar table for large STAR files (e.g. millions of particles).
+
+    Values are kept as read from the file, as byte strings, so written
+    files keep the same values, and numeric() converts a column only
+    when needed. Columns with numbers or many different values are stored
+    as one array with a value per row. Other columns (e.g. micrograph or
+    optics group names) are dictionary-encoded: an array with the unique
+    values and an array of codes (one per row), so filtering only selects
+    codes and rewriting them only processes the unique values.
+
+    Files are parsed in chunks, splitting each chunk straight into the
+    column arrays, so the peak memory is close to the size of the values.
+    """
+    _splitRegex = re.compile(rb'"[^"]*"|[^"\s]+')
+    CHUNK_SIZE = 256 * 1024  # bytes of text parsed at once
+    SAMPLE_SIZE = 10000  # values checked before dictionary-encoding a column
+
+    def __init__(self, columns=None, singleRow=False):
+        """
+        Args:
+            columns: optional dict of column name -> (values, codes),
+                codes is None if values has one value per row
+            singleRow: if True, the table is written as label/value pairs
+        """
+        self._columns = OrderedDict(columns or {})
+        self.singleRow = singleRow
+
+    # ---------------------- Reading --------------------------------
+    @classmethod
+    def fromValues(cls, names, rows, singleRow=False):
+        """ Create a table from the column names and rows of string values. """
+        table = cls(singleRow=singleRow)
+        cols = list(zip(*rows)) if rows else [()] * len(names)
+        for name, values in zip(names, cols):
+            table.setColumn(name, np.asarray(values))
+        return table
+
+    @classmethod
+    def readAll(cls, fileName, cache=None):
+        """ Read all tables in the file, return an OrderedDict name -> table.
+
+        Args:
+            cache: if True, load the tables from the StarCache sidecar
+                (created if missing or outdated). By default, the sidecar
+                is used if enabled through EMWRAP_STAR_CACHE.
+        """
+        from .star_cache import StarCache
+        if StarCache.enabled(cache):
+            return StarCache().getTables(fileName)
+        return cls.parseFile(fileName)
+
+    @classmethod
+    def parseFile(cls, fileName, chunkSize=None):
+        """ Parse all tables in the file (without using the cache). """
+        tables = OrderedDict()
+        with open(fileName, 'rb') as f:
+            while line := f.readline():
+                if line.startswith(b'data_'):
+                    name = line.strip()[5:].decode()
+                    tables[name] = cls._parseBlock(f, chunkSize or cls.CHUNK_SIZE)
+        return tables
+
+    @classmethod
+    def read(cls, fileName, tableName, cache=None):
+        """ Read a single table from the file. """
+        tables = cls.readAll(fileName, cache=cache)
+        if tableName not in tables:
+            raise Exception(f"'data_{tableName}' block was not found")
+        return tables[tableName]
+
+    @classmethod
+    def _split(cls, line):
+        return cls._splitRegex.findall(line) if b'"' in line else line.split()
+
+    @classmethod
+    def _parseBlock(cls, f, chunkSize):
+        """ Parse the block that starts at the current position of f,
+        leaving f at the start of the next block. """
+        names = []
+        values = []
+        loop = False
+        first = b''
+        while True:
+            pos = f.tell()
+            line = f.readline()
+            if not line or line.startswith(b'data_'):
+                f.seek(pos)
+                break
+            line = line.strip()
+            if line.startswith(b'loop_'):
+                loop = True
+            elif line.startswith(b'_'):
+                parts = cls._split(line)
+                names.append(parts[0][1:].decode())
+                if not loop:
+                    values.append(parts[1] if len(parts) > 1 else b'')
+            elif line and names:
+                first = line + b'\n'
+                break
+
+        if not loop:
+            return cls.fromValues(names, [values] if names else [], singleRow=True)
+
+        columns = [[] for _ in names]
+        data = first
+        done = not names
+        while not done:
+            chunk = f.read(chunkSize)
+            # Complete the last line of the chunk
+            data += (chunk + f.readline()) if chunk else b''
+            done = not chunk
+            if (i := (b'\n' + data).find(b'\ndata_')) >= 0:
+                # Leave the next block for the caller
+                f.seek(f.tell() - len(data) + i)
+                data, done = data[:i], True
+            cls._splitChunk(data, columns)
+            data = b''
+
+        table = cls()
+        for c, name in enumerate(names):
+            values = np.concatenate(columns[c]) if columns[c] else np.array([], dtype=np.bytes_)
+            columns[c] = None  # free the chunks of each column once joined
+            table._columns[name] = cls._encode(values)
+        return table
+
+    @classmethod
+    def _splitChunk(cls, data, columns):
+        """ Split the rows in data and append each column values to columns. """
+        n = len(columns)
+        if b'"' in data or b'#' in data:
+            tokens = [v for line in map(bytes.strip, data.split(b'\n'))
+                      if line and not line.startswith(b'#') for v in cls._split(line)]
+        else:
+            tokens = data.split()
+        if len(tokens) % n:
+            raise Exception(f"Invalid number of values for {n} columns.")
+        if tokens:
+            for c, col in enumerate(columns):
+                col.append(np.array(tokens[c::n], dtype=np.bytes_))
+
+    # ---------------------- Encoding --------------------------------
+    @staticmethod
+    def _isNumber(value):
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+
+    @staticmethod
+    def _codes(codes, n):
+        """ Codes as small as possible for n unique values. """
+        return codes.reshape(-1).astype(np.int32 if n < 2 ** 31 else np.int64)
+
+    @classmethod
+    def _encode(cls, values):
+        """ Return (values, codes) for a column with one value per row.
+        Only columns without numbers and with few unique values are
+        dictionary-encoded, otherwise codes is None. """
+        if len(values) and not cls._isNumber(values[0]):
+            # Estimate the number of unique values from a sample,
+            # to avoid sorting columns with a different value per row
+            sample = values[::max(1, len(values) // cls.SAMPLE_SIZE)]
+            if len(np.unique(sample)) <= len(sample) // 2:
+                unique = np.unique(values)
+                return unique, cls._codes(np.searchsorted(unique, values), len(unique))
+        return values, None
+
+    @staticmethod
+    def _bytes(values):
+        """ Encode values (strings or numbers) as a byte strings array. """
+        values = np.asarray(values)
+        if values.dtype.kind == 'S':
+            return values
+        return np.char.encode(values.astype(str), 'utf-8')
+
+    @staticmethod
+    def _str(values):
+        """ Decode a byte strings array (or a single value) as strings. """
+        if isinstance(values, bytes):
+            return values.decode('utf-8')
+        return np.char.decode(values, 'utf-8') if values.dtype.kind == 'S' else values
+
+    # ---------------------- Columns --------------------------------
+    def __len__(self):
+        for values, codes in self._columns.values():
+            return len(values if codes is None else codes)
+        return 0
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def getColumnNames(self):
+        return list(self._columns.keys())
+
+    def _rows(self, name):
+        """ Values of a column with one value per row, still encoded. """
+        values, codes = self._columns[name]
+        return values if codes is None else values[codes]
+
+    def __getitem__(self, name):
+        """ Return the decoded (string) values of a column. """
+        return self._str(self._rows(name))
+
+    def unique(self, name):
+        """ Unique values of a column. """
+        values, codes = self._columns[name]
+        if codes is not None:
+            values = values[np.unique(codes)]
+        return self._str(np.unique(values))
+
+    def numeric(self, name, dtype=float):
+        """ Return a column converted to numbers. """
+        values, codes = self._columns[name]
+        values = values.astype(dtype)
+        return values if codes is None else values[codes]
+
+    def setColumn(self, name, values):
+        """ Set (or add) a column from an array of values or a single value. """
+        if np.isscalar(values):
+            self._columns[name] = (self._bytes([str(values)]),
+                                   np.zeros(len(self), dtype=np.int32))
+        else:
+            self._columns[name] = self._encode(self._bytes(values))
+
+    def removeColumn(self, name):
+        del self._columns[name]
+
+    def renameColumn(self, name, newName):
+        """ Rename a column, keeping its position. """
+        self._columns = OrderedDict((newName if k == name else k, v)
+                                    for k, v in self._columns.items())
+
+    def _uniqueCodes(self, name):
+        """ Return (values, codes) of a column, with the unique values
+        of columns that are not dictionary-encoded. """
+        values, codes = self._columns[name]
+        if codes is None:
+            values, codes = np.unique(values, return_inverse=True)
+            codes = codes.reshape(-1)
+        return values, codes
+
+    def mapValues(self, name, func, vectorized=False):
+        """ Rewrite the values of a column, applying func only
+        to its unique values.
+
+        Args:
+            func: function that receives a value and returns the new one,
+                or the array of unique values if vectorized is True
+        """
+        encoded = self._columns[name][1] is not None
+        values, codes = self._uniqueCodes(name)
+        values = self._str(values)
+        if vectorized:
+            newValues = self._bytes(func(values))
+        else:
+            newValues = self._bytes(np.asarray([str(func(v)) for v in values], dtype=str))
+        self._columns[name] = (newValues, codes) if encoded else (newValues[codes], None)
+
+    # ---------------------- Rows --------------------------------
+    def select(self, mask):
+        """ Return a new table with the rows in mask (boolean or indexes). """
+        return ColumnTable({k: (values[mask], None) if codes is None else (values, codes[mask])
+                            for k, (values, codes) in self._columns.items()},
+                           singleRow=self.singleRow)
+
+    def where(self, name, func):
+        """ Boolean mask of rows where func(value) is True, evaluated
+        only once for each unique value of the column. """
+        values, codes = self._uniqueCodes(name)
+        return np.array([bool(func(v)) for v in self._str(values)], dtype=bool)[codes]
+
+    def isin(self, name, values):
+        """ Boolean mask of rows whose column value is in values. """
+        columnValues, codes = self._columns[name]
+        mask = np.isin(columnValues, self._bytes(np.asarray(list(values), dtype=str)))
+        return mask if codes is None else mask[codes]
+
+    def concat(self, other):
+        """ Return a new table with the rows of this one followed by
+        the rows of other, which must have the same columns. """
+        if set(other.getColumnNames()) != set(self.getColumnNames()):
+            raise Exception("Can not concatenate tables with different columns.")
+        table = ColumnTable(singleRow=False)
+        for name in self.getColumnNames():
+            v1, c1 = self._columns[name]
+            v2, c2 = other._columns[name]
+            if c1 is None or c2 is None:
+                table._columns[name] = (np.concatenate([self._rows(name),
+                                                        other._rows(name)]), None)
+                continue
+            unique, inverse = np.unique(np.concatenate([v1, v2]), return_inverse=True)
+            inverse = inverse.reshape(-1)
+            codes = np.concatenate([inverse[:len(v1)][c1], inverse[len(v1):][c2]])
+            table._columns[name] = (unique, self._codes(codes, len(unique)))
+        return table
+
+    def row(self, index):
+        """ Return a dict with the values of the given row. """
+        return {k: self._str(values[index if codes is None else codes[index]])
+                for k, (values, codes) in self._columns.items()}
+
+    def toTable(self, guessType=True, types=None):
+        """ Return an emtools Table with the same rows, with column types
+        as given by StarFile.getTable. Values of dictionary-encoded
+        columns are converted only once for each unique value. """
+        names = self.getColumnNames()
+        first = list(self.row(0).values()) if len(self) else None
+        table = Table(Table.createColumns(names, first, guessType=guessType, types=types))
+        cols = []
+        for col in table.getColumns():
+            values, codes = self._columns[col.getName()]
+            converted = list(map(col.getType(), self._str(values).tolist()))
+            if codes is not None:
+                converted = np.array(converted, dtype=object)[codes].tolist()
+            cols.append(converted)
+        addRow = table.addRow
+        for row in map(table.Row._make, zip(*cols)):
+            addRow(row)
+        return table
+
+    # ---------------------- Writing --------------------------------
+    def write(self, f, tableName, header=True, align='right', chunkSize=100000):
+        """ Write the table in STAR format.
+
+        Args:
+            f: StarFile opened for writing or text file object
+            tableName: name of the data block
+            header: if False, only rows are written (e.g. appending rows
+                after the header written for a previous table)
+            align: 'right' or 'left' alignment of the values
+        """
+        writeLine = getattr(f, 'writeLine', None) or (lambda line: f.write(f"{line}\n"))
+        names = self.getColumnNames()
+
+        if self.singleRow:
+            writeLine(f"\ndata_{tableName}\n")
+            if len(self):
+                m = max(len(n) for n in names) + 5
+                for name, value in self.row(0).items():
+                    writeLine(f"_{name:<{m}} {value:>10}")
+            writeLine("\n")
+            return
+
+        if header:
+            writeLine(f"\ndata_{tableName}\n\nloop_")
+            for name in names:
+                writeLine(f"_{name} ")
+
+        if not len(self):
+            return
+
+        # Pad the unique values of dictionary-encoded columns only once,
+        # other columns are padded for each chunk of rows
+        pad = np.char.rjust if align == 'right' else np.char.ljust
+        padded = []
+        for name in names:
+            values, codes = self._columns[name]
+            width = int(np.char.str_len(values).max()) + 1 if len(values) else 1
+            padded.append((values if codes is None else pad(values, width), codes, width))
+
+        for start in range(0, len(self), chunkSize):
+            end = start + chunkSize
+            cols = [pad(values[start:end], width).tolist() if codes is None
+                    else values[codes[start:end]].tolist()
+                    for values, codes, width in padded]
+            writeLine(b'\n'.join(b' '.join(r) for r in zip(*cols)).decode('utf-8'))
+        writeLine("")
@@ -0,0 +1,254 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import time
+import json
+import hashlib
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+from emtools.metadata import StarFile
+
+
+class StarTail:
+    """ Read the rows appended to a table of a growing STAR file.
+
+    It remembers the byte offset after the last row read, so each call
+    to read() only parses the new rows. The table should be the last one
+    in the file (e.g. particles or movies), where rows are appended.
+    If the file is replaced (e.g. written again and renamed), reading
+    continues from the same offset if the content before it has not
+    changed. Otherwise, the whole table is read again.
+
+    The state can be saved to a checkpoint file with commit(), so a
+    restarted job can resume from there.
+    """
+    FINGERPRINT_SIZE = 4096
+
+    def __init__(self, fileName, tableName, checkpoint=None, guessType=True):
+        """
+        Args:
+            fileName: STAR file to read
+            tableName: name of the table where rows are appended
+            checkpoint: optional JSON file to store the state
+            guessType: passed to StarFile to guess column types
+        """
+        self.fileName = fileName
+        self.tableName = tableName
+        self.checkpoint = checkpoint
+        self.guessType = guessType
+        self.table = None  # Table with the columns, without rows
+        self.resets = 0  # times the table was read again from the start
+        self.extra = {}  # other values to store in the checkpoint
+        self._types = None
+        self._state = self._emptyState()
+        self._ends = deque()  # (count, offset) after rows not committed
+        self._lock = threading.Lock()
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                saved = json.load(f)
+            self.extra = saved.pop('extra', {})
+            self._state.update(saved)
+
+    @staticmethod
+    def _emptyState():
+        return {'inode': None, 'dataStart': None, 'offset': None,
+                'fingerprint': None, 'count': 0}
+
+    @property
+    def count(self):
+        """ Number of rows read so far. """
+        return self._state['count']
+
+    def _fingerprint(self, f, offset):
+        start = max(self._state['dataStart'], offset - self.FINGERPRINT_SIZE)
+        f.seek(start)
+        return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+    def _findDataStart(self, f):
+        """ Return the offset of the first row of the table, or None if
+        the header or the first row are not written yet. """
+        f.seek(0)
+        dataLine = f"data_{self.tableName}".encode()
+        found = labels = False
+        while line := f.readline():
+            if not line.endswith(b'\n'):
+                return None
+            s = line.strip()
+            if not found:
+                found = s == dataLine
+            elif s.startswith(b'_'):
+                labels = True
+            elif labels and s:
+                return f.tell() - len(line)
+        return None
+
+    def _loadTable(self):
+        with StarFile(self.fileName) as sf:
+            self.table = sf.getTableInfo(self.tableName, guessType=self.guessType)
+        self._types = [c.getType() for c in self.table.getColumns()]
+
+    def _row(self, line):
+        if '"' in line:
+            values = StarFile._splitRegex.findall(line)
+        else:
+            values = line.split()
+        return self.table.Row(*[t(v) for t, v in zip(self._types, values)])
+
+    def _sync(self, f, st):
+        """ Check that the file still contains the rows read until the
+        current offset, or go back to the start of the table. """
+        state = self._state
+        if state['offset'] is not None:
+            same = st.st_ino == state['inode'] and st.st_size >= state['offset']
+            if not same and st.st_size >= state['offset']:
+                # File replaced, check that the content is the same
+                same = self._fingerprint(f, state['offset']) == state['fingerprint']
+            if same:
+                state['inode'] = st.st_ino
+                return True
+            self.resets += 1
+            self._state = state = self._emptyState()
+
+        if (dataStart := self._findDataStart(f)) is None:
+            return False
+        state.update(inode=st.st_ino, dataStart=dataStart, offset=dataStart)
+        self._ends.clear()
+        return True
+
+    def read(self):
+        """ Return the list of rows appended since the last call. """
+        with self._lock:
+            return self._read()
+
+    def _read(self):
+        if not os.path.exists(self.fileName):
+            return []
+
+        st = os.stat(self.fileName)
+        state = self._state
+        if (st.st_ino == state['inode'] and st.st_size == state['offset']
+                and self.table is not None):
+            return []  # Nothing new
+
+        rows = []
+        with open(self.fileName, 'rb') as f:
+            if not self._sync(f, st):
+                return []
+            if self.table is None or state is not self._state:
+                self._loadTable()
+            state = self._state
+            f.seek(state['offset'])
+            offset = state['offset']
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Last line is still being written
+                s = line.decode().strip()
+                if s.startswith('data_'):
+                    break
+                offset += len(line)
+                if s and not s.startswith('#'):
+                    rows.append(self._row(s))
+                    state['count'] += 1
+                    self._ends.append((state['count'], offset))
+            state['offset'] = offset
+            state['fingerprint'] = self._fingerprint(f, offset)
+
+        return rows
+
+    def commit(self, count=None):
+        """ Save the checkpoint, so a new StarTail with the same checkpoint
+        file will start reading after the given number of rows
+        (by default all rows read). """
+        if self.checkpoint:
+            with self._lock:
+                self._commit(count)
+
+    def _commit(self, count):
+        state = dict(self._state)
+        if count is not None and count < state['count']:
+            while self._ends and self._ends[0][0] < count:
+                self._ends.popleft()
+            if self._ends and self._ends[0][0] == count:
+                state['offset'] = self._ends[0][1]
+            elif count == 0:
+                state['offset'] = state['dataStart']
+            else:
+                raise Exception(f"Can not commit at row {count}, it is not "
+                                f"in the uncommitted rows.")
+            state['count'] = count
+            with open(self.fileName, 'rb') as f:
+                state['fingerprint'] = self._fingerprint(f, state['offset'])
+        else:
+            self._ends.clear()
+
+        state['extra'] = self.extra
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint)
+
+
+class StarTailMonitor:
+    """ Same as emtools StarMonitor (newItems, blacklist and timeout),
+    but only new rows are parsed after each change of the file. """
+    def __init__(self, fileName, tableName, rowKeyFunc, **kwargs):
+        self.fileName = fileName
+        self._tail = StarTail(fileName, tableName,
+                              checkpoint=kwargs.get('checkpoint', None),
+                              guessType=kwargs.get('guessType', True))
+        self._rowKeyFunc = rowKeyFunc
+        self._wait = kwargs.get('wait', 10)
+        self._timeout = timedelta(seconds=kwargs.get('timeout', 300))
+        self._seenItems = set()
+        self.lastCheck = None  # Last timestamp when input was checked
+        self.lastUpdate = None  # Last timestamp when new items were found
+        self.inputCount = 0  # Count all input elements
+
+        # Black list some items to not be monitored again
+        for row in kwargs.get('blacklist', None) or []:
+            self._seenItems.add(self._rowKeyFunc(row))
+
+    def update(self):
+        now = datetime.now()
+        newRows = []
+        for row in self._tail.read():
+            rowKey = self._rowKeyFunc(row)
+            if rowKey not in self._seenItems:
+                self.inputCount += 1
+                self._seenItems.add(rowKey)
+                newRows.append(row)
+
+        self.lastCheck = now
+        if newRows:
+            self.lastUpdate = now
+        return newRows
+
+    def timedOut(self):
+        """ Return True when there has been timeout seconds
+        since last new items were found. """
+        if self.lastCheck is None or self.lastUpdate is None:
+            return False
+        return self.lastCheck - self.lastUpdate > self._timeout
+
+    def newItems(self):
+        """ Yield new items since last update until the stream is closed. """
+        while not self.timedOut():
+            for row in self.update():
+                yield row
+            time.sleep(self._wait)
@@ -0,0 +1,165 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def copy_file(src, dst):
+    """ Copy src to dst in kernel space when possible: copy_file_range,
+    then sendfile, and finally a regular buffered copy. """
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        size = os.fstat(fin.fileno()).st_size
+        offset = 0
+        for func in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, func):
+                continue
+            try:
+                while offset < size:
+                    if func == 'copy_file_range':
+                        n = os.copy_file_range(fin.fileno(), fout.fileno(), CHUNK_SIZE)
+                    else:
+                        n = os.sendfile(fout.fileno(), fin.fileno(), offset, CHUNK_SIZE)
+                    if n == 0:  # Premature end, try the next method
+                        raise OSError(f"{func} copied 0 bytes")
+                    offset += n
+                return offset
+            except OSError:
+                # Not supported between these filesystems, restart with the next method
+                offset = 0
+                fin.seek(0)
+                fout.seek(0)
+                fout.truncate()
+        shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+        return fout.tell()
+
+
+class TransferGroup:
+    """ Set of file transfers submitted together (e.g. the outputs of a batch). """
+    def __init__(self, futures):
+        self._futures = futures
+        self._start = time.time()
+        self._end = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._pending = len(futures)
+        if not futures:
+            self._end = self._start
+        for f in futures:
+            f.add_done_callback(self._futureDone)
+
+    def _futureDone(self, future):
+        with self._lock:
+            self._pending -= 1
+            done = self._pending == 0
+            if done:
+                self._end = time.time()
+                callbacks = list(self._callbacks)
+        if done:
+            for cb in callbacks:
+                cb(self)
+
+    def add_done_callback(self, callback):
+        """ Call callback(group) when all transfers are done (or now if
+        they are already done). """
+        with self._lock:
+            if self._pending:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return all(f.done() for f in self._futures)
+
+    def wait(self):
+        """ Wait for all transfers and return a list of errors (empty if ok). """
+        errors = []
+        for f in self._futures:
+            if e := f.exception():
+                errors.append(str(e))
+        return errors
+
+    @property
+    def elapsed(self):
+        return (self._end or time.time()) - self._start
+
+    @property
+    def bytes(self):
+        return sum(f.result() for f in self._futures if f.done() and not f.exception())
+
+
+class TransferEngine:
+    """ Move files to their final destination from a pool of threads.
+
+    Files in the same filesystem are just renamed. Otherwise, they are
+    copied to a temporary '.part' file, the size is verified and the file
+    is renamed and the source removed. Failed transfers are retried.
+    """
+    def __init__(self, streams=4, retries=3, retryDelay=5):
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self._executor = ThreadPoolExecutor(max_workers=streams)
+        self._lock = threading.Lock()
+        self.stats = {'files': 0, 'bytes': 0, 'retries': 0, 'failed': 0}
+
+    def _count(self, **kwargs):
+        with self._lock:
+            for k, v in kwargs.items():
+                self.stats[k] += v
+
+    def move(self, src, dst):
+        """ Move src to dst (full destination path), return bytes moved. """
+        for attempt in range(self.retries + 1):
+            try:
+                st = os.stat(src)
+                size = st.st_size
+                if st.st_dev == os.stat(os.path.dirname(dst) or '.').st_dev:
+                    os.replace(src, dst)
+                else:
+                    partFile = dst + '.part'
+                    copied = copy_file(src, partFile)
+                    if copied != size or os.stat(partFile).st_size != size:
+                        raise OSError(f"Size mismatch copying {src}: "
+                                      f"{copied} bytes copied, expected {size}")
+                    os.replace(partFile, dst)
+                    os.remove(src)
+                self._count(files=1, bytes=size)
+                return size
+            except OSError:
+                if attempt == self.retries:
+                    self._count(failed=1)
+                    raise
+                self._count(retries=1)
+                time.sleep(self.retryDelay)
+
+    def submit(self, pairs):
+        """ Submit (src, dst) moves, return a TransferGroup. """
+        return TransferGroup([self._executor.submit(self.move, src, dst)
+                              for src, dst in pairs])
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
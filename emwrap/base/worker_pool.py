@@ -0,0 +1,219 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import time
+import json
+import socket
+import subprocess
+import threading
+import traceback
+from uuid import uuid4
+
+
+def _write_json(path, data):
+    """ Write a JSON file atomically (other processes never see it half written). """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+class WorkerPool:
+    """ Queue folder shared by a pipeline and long-lived worker processes.
+
+    Workers can run locally or on other nodes (e.g. started through a
+    launcher), as long as they see the same folder. The layout is:
+        workers/<worker_id>.json: registration and heartbeat of each worker
+        queue/<gpu>/<task_id>.json: tasks waiting for a worker of that GPU
+        running/<worker_id>/<task_id>.json: tasks claimed by a worker
+        done/<task_id>.json: result of each task
+        STOP: when present, workers exit
+    """
+    def __init__(self, folder, heartbeatTimeout=120, startTimeout=600, sleep=1):
+        """
+        Args:
+            folder: queue folder, created if it does not exist
+            heartbeatTimeout: seconds without heartbeat before a
+                worker is considered dead
+            startTimeout: seconds that a task can wait when no worker
+                for its GPU is alive
+            sleep: seconds between checks
+        """
+        self.folder = folder
+        self.heartbeatTimeout = heartbeatTimeout
+        self.startTimeout = startTimeout
+        self.sleep = sleep
+        self._procs = []  # (gpu, process, log file) of local workers
+        for d in ['workers', 'queue', 'running', 'done']:
+            os.makedirs(self.join(d), exist_ok=True)
+
+    def join(self, *paths):
+        return os.path.join(self.folder, *paths)
+
+    def start(self, cmd, gpu, count=1, logfile=None):
+        """ Start count local workers for a GPU. The worker arguments
+        (--worker FOLDER --gpu GPU) are appended to the cmd list. """
+        args = list(cmd) + ['--worker', os.path.abspath(self.folder), '--gpu', str(gpu)]
+        # Remove the STOP file from a previous run
+        if os.path.exists(self.join('STOP')):
+            os.remove(self.join('STOP'))
+        for _ in range(count):
+            out = open(logfile, 'a') if logfile else None
+            p = subprocess.Popen(args, stdout=out or subprocess.DEVNULL,
+                                 stderr=subprocess.STDOUT)
+            self._procs.append((str(gpu), p, out))
+
+    def workers(self, gpu=None):
+        """ Return the registration info of alive workers (for a GPU). """
+        alive = []
+        now = time.time()
+        for fn in os.listdir(self.join('workers')):
+            if fn.endswith('.json') and (w := _read_json(self.join('workers', fn))):
+                if now - w['heartbeat'] < self.heartbeatTimeout and \
+                        (gpu is None or w['gpu'] == str(gpu)):
+                    alive.append(w)
+        return alive
+
+    def submit(self, taskId, gpu, payload):
+        """ Add a task for a worker of the given GPU. """
+        queueDir = self.join('queue', str(gpu))
+        os.makedirs(queueDir, exist_ok=True)
+        doneFile = self.join('done', f'{taskId}.json')
+        if os.path.exists(doneFile):
+            os.remove(doneFile)
+        _write_json(os.path.join(queueDir, f'{taskId}.json'),
+                    {'id': taskId, 'gpu': str(gpu), 'submitted': time.time(),
+                     'payload': payload})
+
+    def _claimedBy(self, taskId):
+        for wid in os.listdir(self.join('running')):
+            if os.path.exists(self.join('running', wid, f'{taskId}.json')):
+                return wid
+        return None
+
+    def wait(self, taskId, gpu):
+        """ Wait for a task and return its result dict, with the
+        'error' key if the task failed. """
+        doneFile = self.join('done', f'{taskId}.json')
+        start = time.time()
+        while True:
+            if (result := _read_json(doneFile)) is not None:
+                os.remove(doneFile)
+                return result
+
+            if wid := self._claimedBy(taskId):
+                w = _read_json(self.join('workers', f'{wid}.json'))
+                if w is None or time.time() - w['heartbeat'] > self.heartbeatTimeout:
+                    return {'id': taskId, 'error': f"Worker {wid} died processing the task."}
+            elif not self.workers(gpu) and time.time() - start > self.startTimeout:
+                return {'id': taskId, 'error': f"No worker for GPU {gpu} after "
+                                               f"{self.startTimeout} seconds."}
+            time.sleep(self.sleep)
+
+    def stop(self, timeout=60):
+        """ Ask the workers to exit and wait for the local ones. """
+        open(self.join('STOP'), 'w').close()
+        for _, p, out in self._procs:
+            try:
+                p.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                p.terminate()
+            if out:
+                out.close()
+        self._procs = []
+
+
+class Worker:
+    """ Long-lived process that runs tasks from a WorkerPool folder.
+
+    The handler function receives the task payload and returns a
+    JSON-serializable result. Since the process is reused, any state
+    (imported modules, caches, loaded models) stays warm between tasks.
+    """
+    def __init__(self, folder, gpu, handler, maxIdle=None, sleep=1):
+        self.pool = WorkerPool(folder) if not isinstance(folder, WorkerPool) else folder
+        self.gpu = str(gpu)
+        self.handler = handler
+        self.maxIdle = maxIdle
+        self.sleep = sleep
+        self.id = f"{socket.gethostname()}_{os.getpid()}_{str(uuid4()).split('-')[0]}"
+        self.tasks = 0
+        self._stop = threading.Event()
+        self._runningDir = self.pool.join('running', self.id)
+        self._infoFile = self.pool.join('workers', f'{self.id}.json')
+
+    def _heartbeat(self):
+        _write_json(self._infoFile, {'id': self.id, 'gpu': self.gpu,
+                                     'host': socket.gethostname(), 'pid': os.getpid(),
+                                     'tasks': self.tasks, 'heartbeat': time.time()})
+
+    def _heartbeatLoop(self):
+        while not self._stop.wait(self.pool.heartbeatTimeout / 4):
+            self._heartbeat()
+
+    def _claim(self):
+        """ Move the oldest queued task for our GPU to our running folder. """
+        queueDir = self.pool.join('queue', self.gpu)
+        if not os.path.exists(queueDir):
+            return None
+        for fn in sorted(os.listdir(queueDir)):
+            if fn.endswith('.json'):
+                dst = os.path.join(self._runningDir, fn)
+                try:
+                    os.rename(os.path.join(queueDir, fn), dst)
+                    return dst
+                except FileNotFoundError:
+                    continue  # claimed by another worker
+        return None
+
+    def run(self):
+        os.makedirs(self._runningDir, exist_ok=True)
+        # Write the first heartbeat before starting, to be seen as alive
+        self._heartbeat()
+        threading.Thread(target=self._heartbeatLoop, daemon=True).start()
+        lastTask = time.time()
+        try:
+            while not os.path.exists(self.pool.join('STOP')):
+                if taskFile := self._claim():
+                    task = _read_json(taskFile)
+                    result = {'id': task['id'], 'worker': self.id}
+                    try:
+                        result['result'] = self.handler(task['payload'])
+                    except Exception as e:
+                        traceback.print_exc()
+                        result['error'] = str(e)
+                    _write_json(self.pool.join('done', f"{task['id']}.json"), result)
+                    os.remove(taskFile)
+                    self.tasks += 1
+                    lastTask = time.time()
+                elif self.maxIdle and time.time() - lastTask > self.maxIdle:
+                    break
+                else:
+                    time.sleep(self.sleep)
+        finally:
+            self._stop.set()
+            os.remove(self._infoFile)
+            if not os.listdir(self._runningDir):
+                os.rmdir(self._runningDir)
@@ -0,0 +1,150 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import time
+
+from .config import ProcessingConfig
+from .processing_pipeline import ProcessingPipeline
+from .gpu_lease import list_gpus
+from .project_manager import (_param_references_job, STATUS_LAUNCHED,
+                              STATUS_SUCCEEDED)
+
+
+def job_resources(params):
+    """ Return the number of (cpus, gpus) used by a job, from its
+    'cpus' (N or MPIxTHREADS) and 'gpus' params. """
+    gpus = len(ProcessingPipeline.get_gpu_list(str(params.get('gpus', '') or '')))
+    cpus = str(params.get('cpus', '') or '')
+    if 'x' in cpus:
+        mpi, threads = cpus.split('x')
+        cpus = int(mpi) * int(threads)
+    else:
+        cpus = int(cpus) if cpus else 1
+    return cpus, gpus
+
+
+class WorkflowRunner:
+    """ Run a group of jobs of a project locally, following their dependencies.
+
+    Jobs start when their parents (the jobs they take inputs from) have
+    succeeded, so independent branches run at the same time, as long as
+    the CPUs and GPUs of running jobs (from their cpus/gpus params) fit
+    in the given budget. Streaming jobs ('streaming' in the job config)
+    start as soon as their parents have produced a first output, since
+    they keep processing new inputs until their input timeout. Jobs are
+    always run locally, even if a queue was selected for them.
+    """
+    def __init__(self, project, jobIds, cpus=None, gpus=None, interval=10):
+        """
+        Args:
+            project: ProjectManager with the jobs
+            jobIds: ids of the jobs to run, their parents outside this
+                list are considered finished
+            cpus: CPUs budget, by default the number of CPUs
+            gpus: GPUs budget, by default the number of GPUs
+            interval: seconds between checks of running jobs
+        """
+        self.project = project
+        self.cpus = cpus or os.cpu_count()
+        self.gpus = len(list_gpus()) if gpus is None else gpus
+        self.interval = interval
+        self.jobs = {jobId: project._getJob(jobId) for jobId in jobIds}
+        self.params = {jobId: project._readJobParams(job) for jobId, job in self.jobs.items()}
+        self.parents = project._jobParents(self.params)
+        # Sort jobs in dependency order, it also validates there are no cycles
+        self.order = [j for level in project._jobLevels(self.parents) for j in level]
+        self.resources = {jobId: job_resources(p) for jobId, p in self.params.items()}
+
+        for jobId, (c, g) in self.resources.items():
+            if c > self.cpus or g > self.gpus:
+                raise Exception(f"Job {jobId} uses {c} CPUs and {g} GPUs, more than "
+                                f"the budget of {self.cpus} CPUs and {self.gpus} GPUs.")
+            if project._isActiveJob(self.jobs[jobId]):
+                raise Exception(f"Can not re-run running or launched job {jobId}.")
+
+        self._running = {}  # job id -> process
+        self._status = {}  # job id -> final status
+
+    def _isStreaming(self, jobId):
+        jobConf = ProcessingConfig.get_job_conf(self.jobs[jobId]['jobtype']) or {}
+        return jobConf.get('streaming', False)
+
+    def _hasOutput(self, parentId, jobId):
+        """ Return True if the parent already produced the inputs of the job:
+        the files it takes from the parent exist, or the parent has
+        registered some output if it only references the job folder. """
+        files = [v for v in self.params[jobId].values()
+                 if _param_references_job(v, parentId) and v != parentId]
+        if files:
+            return all(self.project.exists(fn) for fn in files)
+        info = self.project._loadJobInfo(parentId)
+        return bool(info and any(o['files'] for o in info['outputs'].values()))
+
+    def _isReady(self, jobId):
+        for parentId in self.parents[jobId]:
+            if self._status.get(parentId, None) == STATUS_SUCCEEDED:
+                continue
+            if (parentId in self._running and self._isStreaming(jobId)
+                    and self._hasOutput(parentId, jobId)):
+                continue
+            return False
+        return True
+
+    def _fits(self, jobId):
+        usedCpus = sum(self.resources[j][0] for j in self._running)
+        usedGpus = sum(self.resources[j][1] for j in self._running)
+        cpus, gpus = self.resources[jobId]
+        return usedCpus + cpus <= self.cpus and usedGpus + gpus <= self.gpus
+
+    def _start(self, jobId, clean):
+        job = self.jobs[jobId]
+        cpus, gpus = self.resources[jobId]
+        self.project.log(f"Starting job {jobId} ({cpus} CPUs, {gpus} GPUs)")
+        cmd = self.project._prepareRun(job, self.params[jobId], clean=clean)
+        self._running[jobId] = self.project._runLocalCmd(cmd, self.project.join(jobId))
+        job['status'] = STATUS_LAUNCHED
+        self.project._update_pipeline_star()
+
+    def _poll(self):
+        for jobId, p in list(self._running.items()):
+            if (returnCode := p.poll()) is not None:
+                del self._running[jobId]
+                status = self.project._finishLocalJob(jobId, returnCode)
+                self._status[jobId] = status
+                self.project.log(f"Job {jobId} finished: {status}")
+
+    def run(self, clean=False):
+        """ Run all jobs and wait until they finish.
+        Return a dict with the final status of each job, or None for
+        jobs not run because some of their parents failed. """
+        pending = list(self.order)
+        while pending or self._running:
+            self._poll()
+            for jobId in list(pending):
+                failed = [p for p in self.parents[jobId]
+                          if p in self._status and self._status[p] != STATUS_SUCCEEDED]
+                if failed:
+                    self.project.log(f"Job {jobId} will not run, parent jobs did not "
+                                     f"succeed: {', '.join(sorted(failed))}")
+                    self._status[jobId] = None
+                    pending.remove(jobId)
+                elif self._isReady(jobId) and self._fits(jobId):
+                    self._start(jobId, clean)
+                    pending.remove(jobId)
+            if pending or self._running:
+                time.sleep(self.interval)
+        return self._status
@@ -97,13 +97,7 @@ class CryoCareDenoise(CryoCarePipeline):
 
         g = self.addGenerator(_generate)
 
-        self.log(f"Creating {len(self.gpuList)} processing threads.", flush=True)
-        outputQueue = None
-        for gpu in self.gpuList:
-            p = self.addProcessor(g.outputQueue,
-                                  self.get_denoise(gpu),
-                                  outputQueue=outputQueue)
-            outputQueue = p.outputQueue
+        outputQueue = self.addGpuProcessors(g.outputQueue, self.get_denoise)
 
         self.addProcessor(outputQueue, self._output)
 
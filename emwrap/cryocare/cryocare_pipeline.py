@@ -36,6 +36,9 @@ class CryoCarePipeline(ProcessingPipeline):
     def __init__(self, input_args):
         ProcessingPipeline.__init__(self, input_args)
         self.gpuList = [int(g) for g in self._args['gpu'].split()]
+        if self.gpu_lease:
+            # Lease the same number of GPUs instead of using the given ones
+            self.gpuList = self.get_gpu_list(len(self.gpuList), lease=self.gpu_lease)
         self.inputVolPattern = self._args['in_movies']
 
     def getInputVols(self):
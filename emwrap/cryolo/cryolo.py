@@ -39,13 +39,54 @@ import numpy as np
 import shutil
 import sys
 import json
+import atexit
+import tempfile
 import argparse
+import threading
 from pprint import pprint
 
 from emtools.utils import Color, Timer, Path, Process
 from emtools.jobs import Args
 from emtools.metadata import Table, Column, StarFile, StarMonitor, TextFile
 
+from emwrap.base.worker_pool import WorkerPool
+
+
+class CryoloService:
+    """ Process-wide registry of resident crYOLO predictors (see
+    cryolo_service.py), one process per GPU, started on first use. """
+    _pool = None
+    _gpus = set()
+    _tmpFolder = None  # pool folder created here, removed on stop
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, python, gpu, folder=None):
+        """ Return the WorkerPool with a running predictor for the gpu. """
+        with cls._lock:
+            if cls._pool is None:
+                if folder is None:
+                    folder = cls._tmpFolder = tempfile.mkdtemp(prefix='emwrap_cryolo_')
+                cls._pool = WorkerPool(folder)
+                atexit.register(cls.stop)
+            if str(gpu) not in cls._gpus:
+                script = os.path.join(os.path.dirname(__file__), 'cryolo_service.py')
+                cls._pool.start([python, script], gpu,
+                                logfile=cls._pool.join(f'cryolo_gpu{gpu}.log'))
+                cls._gpus.add(str(gpu))
+            return cls._pool
+
+    @classmethod
+    def stop(cls):
+        with cls._lock:
+            if cls._pool is not None:
+                cls._pool.stop()
+                cls._pool = None
+                cls._gpus = set()
+            if cls._tmpFolder is not None:
+                shutil.rmtree(cls._tmpFolder, ignore_errors=True)
+                cls._tmpFolder = None
+
 
 class CryoloPredict:
     def __init__(self, **kwargs):
@@ -90,7 +131,10 @@ class CryoloPredict:
             '-o': 'cryolo_boxfiles/'
         }
 
-        batch.call(self.path, kwargs)
+        if self.args.get('resident', False):
+            self._predict_resident(batch, gpu, kwargs)
+        else:
+            batch.call(self.path, kwargs)
 
         batch.info.update({
             'cryolo_elapsed': str(t.getElapsedTime())
@@ -98,6 +142,20 @@ class CryoloPredict:
 
         return batch
 
+    def _predict_resident(self, batch, gpu, kwargs):
+        """ Run the prediction in the resident crYOLO process of the
+        gpu, where the crYOLO and JANNI models are already loaded. """
+        python = os.path.join(os.path.dirname(self.path), 'python')
+        pool = CryoloService.get(python, gpu, self.args.get('service_folder', None))
+        # The service only sees its GPU
+        kwargs = dict(kwargs, **{'-g': 0})
+        args = [str(a) for kv in kwargs.items() for a in kv]
+        taskId = f"{os.path.basename(batch.path)}_cryolo"
+        pool.submit(taskId, gpu, {'cwd': os.path.abspath(batch.path), 'args': args})
+        result = pool.wait(taskId, gpu)
+        if error := result.get('error', None):
+            raise Exception(f"crYOLO service failed: {error}")
+
     def __distr_file(self, batch, percentile, prefix):
         distr = batch.join('cryolo_boxfiles', 'DISTR')
         for fn in os.listdir(distr):
@@ -45,7 +45,6 @@ class CryoloPipeline(ProcessingPipeline):
         self.batchSize = args.get('batch_size', 32)
         self.inputTimeOut = args.get('timeout', 3600)
         self.acq = self.loadAcquisition()
-        self._totalInput = self._totalOutput = 0
 
     def prerun(self):
         self.log(f"Batch size: {Color.cyan(str(self.batchSize))}")
@@ -61,14 +60,10 @@ class CryoloPipeline(ProcessingPipeline):
 
         # Define the current pipeline with generator and processors
         outputMicStar = self.join('coordinates.star')
-        if os.path.exists(outputMicStar):
-            with StarFile(outputMicStar) as sf:
-                self._totalOutput = sf.getTableSize('coordinate_files')
-                self.log(f"Already processed {self._totalOutput} micrographs")
-
         g = self.addMoviesGenerator(self.inputStar, outputMicStar, self.batchSize,
                                     inputTimeOut=self.inputTimeOut,
                                     queueMaxSize=4)
+        self.log(f"Already processed {self.progress['previous']} micrographs")
         outputQueue = None
         self.log(f"Creating {len(self.gpuList)} processing threads.", flush=True)
         for gpu in self.gpuList:
@@ -195,13 +190,7 @@ class CryoloPipeline(ProcessingPipeline):
                 batch.log(f"No call: Updating batchInfo", flush=True)
                 self.updateBatchInfo(Batch(batch))
 
-                with StarFile(self.inputStar) as sf:
-                    self._totalInput = sf.getTableSize('movies')
-                self._totalOutput += len(batch['items'])
-                percent = self._totalOutput * 100 / self._totalInput
-                batch.log(f">>> Processed {Color.green(str(self._totalOutput))} out of "
-                          f"{Color.red(str(self._totalInput))} "
-                          f"({Color.bold('%0.2f' % percent)} %)", flush=True)
+                self.updateProgress(batch, processed=len(batch['items']))
 
         except Exception as e:
             batch.log(Color.red('ERROR: ' + str(e)))
@@ -0,0 +1,210 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+"""
+Resident crYOLO predictor, one process per GPU.
+
+This script runs with the Python of the crYOLO environment, where emwrap
+and emtools are usually not installed, so it only uses the standard
+library and loads the WorkerPool module from its file.
+
+The TensorFlow session is created once, and the PhosaurusNet model and
+the JANNI denoising model (the 'filter' of config.json) are loaded on the
+first request and reused for the following ones (see ModelCache). Each
+request runs the 2D picking steps of cryolo_predict.py through
+cryolo.predict.do_prediction, with the same outputs in the batch folder.
+"""
+
+import os
+import json
+import argparse
+import multiprocessing
+import importlib.util
+
+
+def _load_worker_pool():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'base', 'worker_pool.py')
+    spec = importlib.util.spec_from_file_location('worker_pool', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class ModelCache:
+    """ Models loaded once by the service and used by crYOLO.
+
+    crYOLO's do_prediction builds the model with cryolo.frontend.YOLO and
+    filters the micrographs with cryolo.utils.filter_images_noise2noise_dir,
+    which loads the JANNI model. Both are replaced by functions that keep
+    the loaded models, keyed by the model arguments and the JANNI model
+    path, and the service fails at start if crYOLO does not provide them.
+    """
+    def __init__(self):
+        from cryolo import frontend, utils
+
+        for module, name in [(frontend, 'YOLO'), (utils, 'filter_images_noise2noise_dir')]:
+            if not hasattr(module, name):
+                raise Exception(f"{module.__name__}.{name} not found, this crYOLO "
+                                f"version can not be used by the service.")
+        self._YOLO = frontend.YOLO
+        self._yolo = {}
+        self._janni = {}
+        frontend.YOLO = self.yolo
+        utils.filter_images_noise2noise_dir = self.filter_janni
+
+    def yolo(self, **kwargs):
+        """ Return the YOLO model built with these arguments. """
+        key = repr(sorted(kwargs.items()))
+        if key not in self._yolo:
+            print(f"Loading crYOLO model: {kwargs.get('pretrained_weights', '')}", flush=True)
+            self._yolo[key] = self._YOLO(**kwargs)
+        return self._yolo[key]
+
+    def janni(self, modelPath):
+        """ Return the (model, patch_size) of a JANNI model file. """
+        if modelPath not in self._janni:
+            import h5py
+            import numpy as np
+            from janni import models as janni_models
+
+            print(f"Loading JANNI model: {modelPath}", flush=True)
+            with h5py.File(modelPath, mode='r') as f:
+                modelName = str(np.array(f['model_name']))
+                patchSize = tuple(f['patch_size'])
+            if modelName != 'unet':
+                raise Exception(f"Not supported JANNI model {modelName}")
+            model = janni_models.get_model_unet(input_size=patchSize)
+            model.load_weights(modelPath)
+            self._janni[modelPath] = (model, patchSize)
+        return self._janni[modelPath]
+
+    def filter_janni(self, img_paths, output_dir_filtered_imgs, model_path,
+                     padding=15, batch_size=4, resize_to=None):
+        """ Same as cryolo.utils.filter_images_noise2noise_dir,
+        with the loaded JANNI model. """
+        from janni import predict as janni_predict
+
+        model, patchSize = self.janni(model_path)
+        return janni_predict.predict_list(
+            image_paths=img_paths, output_path=output_dir_filtered_imgs,
+            model=model, patch_size=patchSize, padding=padding,
+            batch_size=batch_size, output_resize_to=resize_to, sliceswise=True)
+
+
+def _start_session():
+    """ TensorFlow session used by all requests, as cryolo_predict.py
+    creates it (allocating GPU memory as needed). """
+    import tensorflow as tf
+    from keras.backend.tensorflow_backend import set_session
+
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    set_session(tf.Session(config=config))
+
+
+def _run_prediction(predict, args):
+    """ Run the steps of cryolo.predict.main for 2D particle picking,
+    without creating a new TensorFlow session (models built in the
+    previous one could not be used). """
+    from cryolo import config_tools
+
+    if args.filament or args.tomogram:
+        raise Exception("Only 2D particle picking is supported by the service.")
+
+    with open(args.conf) as f:
+        config = json.load(f)
+    config['model']['input_size'] = config_tools.get_adjusted_input_size(config)
+    os.makedirs(config.get('other', {}).get('log_path', 'logs/'), exist_ok=True)
+
+    if args.patch is not None and args.patch > 0:
+        numPatches = int(args.patch)
+    else:
+        numPatches = config_tools.get_number_patches(config)
+
+    overlap = 0
+    if 'overlap_patches' in config['model']:
+        overlap = int(config['model']['overlap_patches'])
+    elif 'anchors' in config['model'] and not len(config['model']['anchors']) > 2:
+        overlap = config['model']['anchors'][0]
+
+    numCpus = args.num_cpu if args.num_cpu != -1 else int(multiprocessing.cpu_count() / 2)
+    outdir = str(args.output)
+    results = predict.do_prediction(
+        config_path=args.conf,
+        config_pre=config,
+        weights_path=args.weights,
+        input_path=[os.path.realpath(p) for p in args.input],
+        obj_threshold=args.threshold,
+        num_patches=numPatches,
+        filament_mode=False,
+        write_empty=args.write_empty,
+        overlap=overlap,
+        num_images_batch_prediction=args.prediction_batch_size,
+        num_gpus=1,
+        num_cpus=numCpus,
+        otf=args.otf,
+        normalization=config['model'].get('norm', 'STANDARD'),
+        normalization_margin=args.norm_margin,
+        write_direct=True,
+        min_distance=args.distance,
+        outdir=outdir,
+        monitor=False,
+        min_size=args.minsize,
+        max_size=args.maxsize,
+        skip_picked=args.skip)
+
+    if results:
+        predict.write_size_distribution_to_disk(results, os.path.join(outdir, 'DISTR'))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--worker', metavar='FOLDER', required=True,
+                   help="WorkerPool folder where requests are received.")
+    p.add_argument('--gpu', required=True)
+    args = p.parse_args()
+
+    # Only the assigned GPU is visible, it is always GPU 0 for crYOLO
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
+    multiprocessing.set_start_method(os.environ.get('CRYOLO_MP_START', 'fork'))
+    from cryolo import predict
+    _start_session()
+    ModelCache()
+
+    def _predict(payload):
+        """ Run crYOLO in the batch folder, with the same
+        arguments as cryolo_predict.py. """
+        cwd = os.getcwd()
+        try:
+            os.chdir(payload['cwd'])
+            predictArgs = predict.get_parser().parse_args([str(a) for a in payload['args']])
+            _run_prediction(predict, predictArgs)
+        except SystemExit as e:
+            # Do not let crYOLO exit the service
+            if e.code:
+                raise Exception(f"crYOLO exited with code {e.code}")
+        finally:
+            os.chdir(cwd)
+        return payload['cwd']
+
+    worker = _load_worker_pool().Worker(args.worker, args.gpu, _predict)
+    print(f"crYOLO service {worker.id} started, GPU = {args.gpu}", flush=True)
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()
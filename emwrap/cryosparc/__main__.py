@@ -30,6 +30,8 @@ from emtools.utils import Process, Color, System, Path, FolderManager
 from emtools.metadata import EPU, SqliteFile, StarFile, Table
 from emtools.jobs import Pipeline
 
+from emwrap.base.star_cache import getTableFromFile
+
 
 class CryoSparc:
     STATUS_FAILED = "failed"
@@ -146,8 +148,8 @@ def cryosparc_prepare(sessionFile, particlesStar):
 
     logger.system(f"ln -s {csFolder.relpath(epuFolder)} {csFolder.join('XML')}")
 
-    movTable = StarFile.getTableFromFile('movies', movStar)
-    micTable = StarFile.getTableFromFile('micrographs', micStar)
+    movTable = getTableFromFile('movies', movStar)
+    micTable = getTableFromFile('micrographs', micStar)
 
     r = re.compile('(movie|micrograph)-(\d{6})')
 
@@ -23,8 +23,10 @@ import subprocess
 import shutil
 import sys
 import json
+import time
 import argparse
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
 
 from emtools.utils import Color, Timer, Path, Process
 from emtools.metadata import Table, Acquisition
@@ -47,6 +49,8 @@ class Ctffind:
                      'no', 'no', 'no', 'no', 'no']
         if self.version > 4:
             self.args.extend(['no', 'no'])
+        # Number of ctffind processes running concurrently in a batch
+        self.workers = int(_get('workers', 1))
 
     def process(self, micrograph, **kwargs):
         verbose = kwargs.get('verbose', False)
@@ -69,30 +73,49 @@ class Ctffind:
             print(ctf_values)
         return ctf_values, ctf_files
 
+    def _process_item(self, mic, verbose):
+        """ Process a single micrograph, errors are reported in the result. """
+        t = time.time()
+        ctf_files = []
+        result = {'error': 'Empty input micrograph'}
+        if mic is not None:
+            try:
+                ctf_values, ctf_files = self.process(mic, verbose=verbose)
+                du, dv, da, score, res = ctf_values
+                astig = abs(float(du) - float(dv))
+                result = {'values': [mic, 1, ctf_files[0], du, dv, astig, da, score, res]}
+            except Exception as e:
+                result = {'error': str(e)}
+                ctf_files = []
+                print(Color.red(f"ERROR: {result['error']}"))
+        result['elapsed'] = round(time.time() - t, 3)
+        return result, ctf_files
+
     def process_batch(self, batch, **kwargs):
+        """ Run ctffind for all items in the batch. Several ctffind
+        processes can run at the same time (workers), results are kept
+        in the same order as the input items.
+        """
         t = Timer()
         batch['results'] = []
         batch['outputs'] = []
+        verbose = kwargs.get('verbose', False)
+        items = batch['items']
+        workers = max(1, min(int(kwargs.get('workers', self.workers)), len(items)))
 
-        for mic in batch['items']:
-            ctf_files = []
-            result = {'error': 'Empty input micrograph'}
-            if mic is not None:
-                try:
-                    ctf_values, ctf_files = self.process(mic, verbose=kwargs.get('verbose', False))
-                    du, dv, da, score, res = ctf_values
-                    astig = abs(float(du) - float(dv))
-                    result = {'values': [mic, 1, ctf_files[0], du, dv, astig, da, score, res]}
-                except Exception as e:
-                    result = {'error': str(e)}
-                    ctf_files = []
-                    print(Color.red(f"ERROR: {result['error']}"))
-
-            batch['results'].append(result)
-            batch['outputs'].extend(ctf_files)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for result, ctf_files in executor.map(lambda mic: self._process_item(mic, verbose), items):
+                batch['results'].append(result)
+                batch['outputs'].extend(ctf_files)
 
+        elapsed = [r['elapsed'] for r in batch['results']]
         batch.info.update({
-            'ctf_elapsed': str(t.getElapsedTime())
+            'ctf_elapsed': str(t.getElapsedTime()),
+            'ctf_workers': workers,
+            'ctf_item_elapsed': {
+                'mean': round(sum(elapsed) / len(elapsed), 3) if elapsed else 0,
+                'max': max(elapsed, default=0)
+            }
         })
 
         return batch
@@ -25,9 +25,8 @@ from glob import glob
 
 from emtools.utils import Color, Timer, Path, Process, FolderManager, Pretty
 from emtools.metadata import Table, StarFile, Acquisition, EPU
-from emtools.image import Image
 
-from emwrap.base import ProjectManager
+from emwrap.base import ProjectManager, ImageDims
 
 
 class OTF(FolderManager):
@@ -71,7 +70,7 @@ class OTF(FolderManager):
         print("raw: ", raw['path'])
         if movies := glob(input_movies):
             first = movies[0]
-            dims = Image.get_dimensions(first)
+            dims = ImageDims.get_dimensions(first)
             print(f"Dimensions from: {first}: {dims}")
         else:
             dims = None
@@ -19,16 +19,22 @@ import subprocess
 import shutil
 import sys
 import json
+import time
+import copy
 import argparse
+import threading
 from pprint import pprint
 import tempfile
+from datetime import timedelta
 
-from emtools.utils import (Pretty, Timer, Path, FolderManager, Color,
-                           Process, System)
+from emtools.utils import Pretty, Path, FolderManager, Color, System
 from emtools.jobs import Batch
 from emtools.metadata import Acquisition, StarFile, RelionStar
 
-from emwrap.base import ProcessingPipeline
+from emwrap.base import ProcessingPipeline, ImageDims
+from emwrap.base.scratch import ScratchManager
+from emwrap.base.transfer import TransferEngine
+from emwrap.base.worker_pool import Worker
 from emwrap.motioncor import Motioncor
 from emwrap.ctffind import Ctffind
 from emwrap.cryolo import CryoloPredict
@@ -44,6 +50,8 @@ class Preprocessing:
     def __init__(self, args):
         self.acq = Acquisition(args['acquisition'])
         self.args = args
+        # Stages of different batches run in concurrent threads
+        self._extractLock = threading.Lock()
 
     @property
     def particle_size(self):
@@ -57,12 +65,15 @@ class Preprocessing:
     def picking(self):
         return 'picking' in self.args
 
-    def process_batch(self, batch, **kwargs):
+    def process_batch(self, batch, pool=None, **kwargs):
         # Launcher can be used in the case that we want to launch
         # processing of a batch to the cluster
         # the launcher should load the proper environment
-        # and launch this main in the project folder
-        if launcher := self.args.get('launcher', None):
+        # and launch this main in the project folder.
+        # If a WorkerPool is given, the batch is sent to one of its
+        # workers instead of starting a new process
+        launcher = self.args.get('launcher', None)
+        if launcher or pool is not None:
             outputFolder = FolderManager(kwargs['outputFolder'])
             logsPrefix = outputFolder.join('Logs', batch.id)
             batchJson = os.path.abspath(logsPrefix + '.json')
@@ -72,8 +83,16 @@ class Preprocessing:
             # the keys are the relion labels from the row
             batch.dump_all(batchJson)  # Write batch json to be used in sub-process
 
-            batch.call(launcher, [os.getcwd(), batchJson], cwd=False,
-                       logfile=logsPrefix + '.log', verbose=True)
+            if pool is not None:
+                pool.submit(batch.id, kwargs['gpu'], {'batch_json': batchJson,
+                                                      'logfile': logsPrefix + '.log'})
+                result = pool.wait(batch.id, kwargs['gpu'])
+                if error := result.get('error', None):
+                    raise Exception(f"Worker failed: {error}")
+                batch.log(f"Processed by worker {result['worker']}", flush=True)
+            else:
+                batch.call(launcher, [os.getcwd(), batchJson], cwd=False,
+                           logfile=logsPrefix + '.log', verbose=True)
             batch.load_all(batchJson)
             # Reload any args that was set by the subprocesses
             self.args = batch['Preprocessing.args']
@@ -89,22 +108,57 @@ class Preprocessing:
         """ Real processing work is done here. This function is called either
         directly from the Pipeline process or through an external 'launcher'
         script. The launcher script is the way to submit this job to a cluster.
+
+        The work is split in stages (see stages()) that are run here one after
+        the other, but that can also be run by separated workers of the
+        pipeline. The state passed between stages is stored in the batch.
+        Only some stages can be run with kwargs['stages'] (e.g. up to
+        picking to estimate the particle size).
         """
-        # Folder where intermediate result from the batch will be copied
-        # the outputFolder should be a location that is visible by the
-        # main process running the pipeline and the worker process running
-        # the batch
-        outputFolder = FolderManager(kwargs['outputFolder'])
+        stages = kwargs.get('stages', None) or self.stages()
+        batch = self.stage_prepare(batch, kwargs)
+        for stage in stages:
+            batch = getattr(self, f'stage_{stage}')(batch, kwargs)
+        if 'extract' not in stages:
+            # Otherwise written by the extract stage
+            batch['Preprocessing.args'] = self.args
+            batch.dump_all()
+        return batch
+
+    def stages(self):
+        """ Processing stages after the batch is prepared. """
+        stages = ['motioncor', 'ctf']
+        if self.picking:
+            stages.append('picking')
+        stages.append('extract')
+        return stages
+
+    def _acquisition(self, batch):
+        """ Acquisition with the pixel size after motioncor binning. """
+        acq = Acquisition(self.acq)
+        acq.pixel_size = self.acq.pixel_size * batch['pp.ft_bin']
+        return acq
 
-        # Where the temporary batch folder will be created
-        # This is a local, fast storage in the worker process
-        tmpFolder = '/scr/'  # FIXME
-        tmpPrefix = os.path.join(tmpFolder, f'emwrap_{batch.id}')
+    def scratch_size(self, batch):
+        """ Estimated scratch space (in bytes) needed by the batch, based on
+        the movies dimensions and the 'scratch_factor' (number of float
+        images written per movie, e.g. micrographs, halves and particles).
+        """
+        factor = float(self.args.get('scratch_factor', 4))
+        x, y, _ = ImageDims.get_dimensions(batch['items'][0]['rlnMicrographMovieName'])
+        return int(len(batch['items']) * x * y * 4 * factor)
 
+    def stage_prepare(self, batch, kwargs):
         # The batch will be created in the temporary local storage for
         # intermediate results and only the relevant ones will be copied
-        # to the outputFolder
-        batch.path = tempfile.mkdtemp(prefix=tmpPrefix)
+        # to the outputFolder. If there is a scratch manager, the space
+        # is reserved there, otherwise the preferred scratch root is used
+        tmpPrefix = f'emwrap_{batch.id}_'
+        if scratch := kwargs.get('scratch', None):
+            batch.path = scratch.reserve(batch.id, self.scratch_size(batch), prefix=tmpPrefix)
+        else:
+            roots = ScratchManager.discover(self.args.get('scratch_roots', None))
+            batch.path = tempfile.mkdtemp(prefix=tmpPrefix, dir=roots[0])
         batch.log(f"batch.path (from mkdtemp): {batch.path}", flush=True)
 
         # Let's create symbolic links to the input movies
@@ -115,19 +169,21 @@ class Preprocessing:
             allBase.append(baseName)
             os.symlink(os.path.abspath(movFn), batch.join(baseName))
 
-        t = Timer()
-        start = Pretty.now()
-        v = kwargs.get('verbose', False)
-        gpu = kwargs['gpu']
-        cpu = kwargs.get('cpu', 4)
+        batch['pp.start'] = Pretty.now()
+        batch['pp.start_time'] = time.time()
+        return batch
 
-        # Motion correction
+    def stage_motioncor(self, batch, kwargs):
         msg = f"Running Motioncor in Host: {System.hostname()}"
         batch.log(msg, flush=True)
         print(msg, flush=True)
         mc = Motioncor(self.acq, **self.args['motioncor'])
-        mc.process_batch(batch, gpu=gpu)
+        mc.process_batch(batch, gpu=kwargs['gpu'])
+        # New pixel size is calculated based on the motioncor binning option
+        batch['pp.ft_bin'] = mc.args['-FtBin']
+        return batch
 
+    def stage_ctf(self, batch, kwargs):
         old_batch = batch
         batch = Batch(old_batch)
         batch.path = old_batch.path  # FIXME bath.path is not copied as dict key
@@ -138,14 +194,10 @@ class Preprocessing:
         # Change input items as expected by CTF job
         batch['items'] = [_item(r) for r in old_batch['results']]
 
-        # Calculate new pixel size based on the motioncor binning option
-        acq = Acquisition(self.acq)
-        origPs = self.acq.pixel_size
-        acq.pixel_size = origPs * mc.args['-FtBin']
-
         batch.log("Running Ctffind", flush=True)
-        ctf = Ctffind(acq, **self.args['ctf'])
-        ctf.process_batch(batch, verbose=True)
+        ctf = Ctffind(self._acquisition(batch), **self.args['ctf'])
+        ctf.process_batch(batch, verbose=True,
+                          workers=self.args['ctf'].get('workers', kwargs.get('cpu', 4)))
         # Restore items
         batch['items'] = old_batch['items']
 
@@ -158,25 +210,34 @@ class Preprocessing:
         _move(batch['outputs'], 'CTFs')
         del old_batch['outputs']
         del batch['outputs']
+        return batch
 
-        extra_cols = []
-        if self.picking:
-            batch.mkdir('Coordinates')
+    def stage_picking(self, batch, kwargs):
+        acq = self._acquisition(batch)
+        batch.mkdir('Coordinates')
+
+        pickingArgs = dict(self.args['picking'])
+        if self.particle_size is not None:
+            a = round(self.particle_size / acq.pixel_size)
+            pickingArgs['anchors'] = [a, a]
 
-            pickingArgs = dict(self.args['picking'])
-            if self.particle_size is not None:
-                a = round(self.particle_size / acq.pixel_size)
-                pickingArgs['anchors'] = [a, a]
+        batch.log(f"Running Cryolo, args: {pickingArgs}", flush=True)
+        cryolo = CryoloPredict(**pickingArgs)
+        cryolo.process_batch(batch, gpu=kwargs['gpu'], cpu=kwargs.get('cpu', 4))
+        if self.particle_size is None:
+            size = cryolo.get_size(batch, 75)
 
-            batch.log(f"Running Cryolo, args: {pickingArgs}", flush=True)
-            cryolo = CryoloPredict(**pickingArgs)
-            cryolo.process_batch(batch, gpu=gpu, cpu=cpu)
-            if self.particle_size is None:
-                size = cryolo.get_size(batch, 75)
+            self.particle_size = round(size * acq.pixel_size)
+            print(f">>> Size for percentile 75: {size}, particle_size (A): {self.particle_size}")
+        return batch
 
-                self.particle_size = round(size * acq.pixel_size)
-                print(f">>> Size for percentile 75: {size}, particle_size (A): {self.particle_size}")
+    def stage_extract(self, batch, kwargs):
+        outputFolder = FolderManager(kwargs['outputFolder'])
+        acq = self._acquisition(batch)
+        origPs = self.acq.pixel_size
 
+        extra_cols = []
+        if self.picking:
             tCoords = RelionStar.coordinates_table()
             extra_cols = ['rlnMicrographCoordinates', 'rlnCoordinatesNumber']
         tOptics = RelionStar.optics_table(acq, originalPixelSize=origPs)
@@ -192,7 +253,7 @@ class Preprocessing:
         for i, row in enumerate(batch['items']):
             r = batch['results'][i]
             values = r.get('values', None)
-            micName = os.path.basename(values[0])
+            micName = os.path.basename(values[0] if values else row['rlnMicrographMovieName'])
             if values and 'error' not in r:
                 micPath = os.path.join('Micrographs', micName)
                 kvalues = {
@@ -218,13 +279,13 @@ class Preprocessing:
                 tMics.addRowValues(**kvalues)
                 if self.picking:
                     tCoords.addRowValues(micPath, dstCoords)
+                # Update results for each item
+                batch['results'][i] = kvalues
 
             else:
                 if values is None and 'error' not in r:
                     r['error'] = 'Values not produces and not ERROR logged!'
                 batch.log(f"ERROR: For micrograph {micName}, {r['error']}")
-            # Update results for each item
-            batch['results'][i] = kvalues
 
         # Write output STAR files, as outputs needed by extraction
         batchMicStar = batch.join('micrographs.star')
@@ -244,52 +305,75 @@ class Preprocessing:
             shutil.copy(batchCoordStar, outputFolder.join(f"{batch.id}_coordinates.star"))
 
             batch.log("Running Particle Extraction", flush=True)
-            extract = RelionExtract(acq, **self.args['extract'])
-            if '--extract_size' not in extract.args:
-                extract.update_args(self.particle_size)
-                self.args['extract']['extra_args'].update(extract.args)
-
+            with self._extractLock:
+                # The extraction size is estimated once, by the first batch
+                extractArgs = self.args['extract']
+                extraArgs = extractArgs.setdefault('extra_args', {})
+                if '--extract_size' not in extraArgs:
+                    extract = RelionExtract(acq, **extractArgs)
+                    extract.update_args(self.particle_size)
+                    extraArgs.update(extract.args)
+                extractArgs = copy.deepcopy(extractArgs)
+
+            extract = RelionExtract(acq, **extractArgs)
             extract.process_batch(batch)
             # Copy batch's coordinates star file to the outputFolder
             shutil.copy(batch.join('particles.star'),
                         outputFolder.join(f"{batch.id}_particles.star"))
 
         batch.info.update({
-            'preprocessing_start': start,
+            'preprocessing_start': batch['pp.start'],
             'preprocessing_end': Pretty.now(),
-            'preprocessing_elapsed': str(t.getElapsedTime())
+            'preprocessing_elapsed': str(timedelta(seconds=time.time() - batch['pp.start_time']))
         })
 
-        self._move(batch, outputFolder)
+        self._move(batch, outputFolder, kwargs.get('transfer', None))
         batch['Preprocessing.args'] = self.args
         batch.log(f"Batch path is: {batch.path}", flush=True)
         batch.dump_all()
 
         return batch
 
-    def _move(self, batch, outputFolder):
-        """ Move processing results to output folder. """
+    def _move_pairs(self, batch, outputFolder):
+        """ List (source, destination) of the output files to be moved. """
+        pairs = []
+        for d in ['Micrographs', 'CTFs', 'Coordinates']:
+            if batch.exists(d):
+                for entry in os.scandir(batch.join(d)):
+                    pairs.append((entry.path, outputFolder.join(d, entry.name)))
+
+        if batch.exists('Particles'):
+            for root, dirs, files in os.walk(batch.join('Particles')):
+                for name in files:
+                    if name.endswith('.mrcs'):
+                        pairs.append((os.path.join(root, name),
+                                      outputFolder.join('Particles', name)))
+        return pairs
+
+    def _move(self, batch, outputFolder, transfer=None):
+        """ Move processing results to output folder.
+
+        If a TransferEngine is given, the files are moved asynchronously
+        and the TransferGroup is returned (and stored as batch.transfer),
+        the caller should wait for it before registering the outputs.
+        """
+        pairs = self._move_pairs(batch, outputFolder)
+        batch.log(f"Moving results: {len(pairs)} files.")
+        if transfer is not None:
+            batch.transfer = transfer.submit(pairs)
+            return batch.transfer
+
         try:
             """ Move output files from the batch to the final destination. """
-            batch.log("Moving results.")
-            t = Timer()
-            # Move output files
-            for d in ['Micrographs', 'CTFs', 'Coordinates']:
-                if batch.exists(d):
-                    Process.system(f"mv {batch.join(d, '*')} {outputFolder.join(d)}",
-                                   print=batch.log, color=Color.bold)
-
-            if batch.exists('Particles'):
-                for root, dirs, files in os.walk(batch.join('Particles')):
-                    for name in files:
-                        if name.endswith('.mrcs'):
-                            shutil.move(os.path.join(root, name),
-                                        outputFolder.join('Particles'))
+            with TransferEngine() as engine:
+                group = engine.submit(pairs)
+                if errors := group.wait():
+                    raise Exception(f"{len(errors)} files could not be moved, first error: {errors[0]}")
 
             batch.info.update({
-                'move_elapsed': str(t.getElapsedTime())
+                'move_elapsed': str(timedelta(seconds=group.elapsed))
             })
-            return batch
+            return group
         except Exception as e:
             print(Color.red('ERROR: ' + str(e)))
             import traceback
@@ -297,15 +381,10 @@ class Preprocessing:
             sys.exit(1)
 
 
-def main():
-    p = argparse.ArgumentParser()
-    p.add_argument('project_folder',
-                   help="Project folder where to run the preprocessing")
-    p.add_argument('batch_json',
-                   help="Json file with batch info")
-    args = p.parse_args()
-    os.chdir(args.project_folder)
-    with open(args.batch_json) as f:
+def process_batch_json(batchJson):
+    """ Process a batch dumped by Preprocessing.process_batch and
+    write back the results to the same JSON file. """
+    with open(batchJson) as f:
         batch = Batch(json.load(f))
 
     # Restore path value that might be corrupted after load_all
@@ -313,12 +392,46 @@ def main():
     pp._process_batch(batch, batch['Preprocessing.process_batch.kwargs'])
 
     # Copy back the resulting .json file to the input one
-    shutil.copy(batch.join('batch.json'), args.batch_json)
+    shutil.copy(batch.join('batch.json'), batchJson)
 
     if ProcessingPipeline.do_clean():
         shutil.rmtree(batch.path)
 
 
+def _worker_task(payload):
+    """ Process one batch in a worker, with the output in the batch log. """
+    with open(payload['logfile'], 'a') as f:
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = f
+        try:
+            process_batch_json(payload['batch_json'])
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+    return payload['batch_json']
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('project_folder',
+                   help="Project folder where to run the preprocessing")
+    p.add_argument('batch_json', nargs='?',
+                   help="Json file with batch info")
+    p.add_argument('--worker', metavar='FOLDER',
+                   help="Run as a worker, processing batches from this "
+                        "WorkerPool folder until the pipeline stops it.")
+    p.add_argument('--gpu', help="GPU used by the worker.")
+    args = p.parse_args()
+    os.chdir(args.project_folder)
+
+    if args.worker:
+        worker = Worker(args.worker, args.gpu, _worker_task)
+        print(f"Worker {worker.id} started, GPU = {args.gpu}", flush=True)
+        worker.run()
+        print(f"Worker {worker.id} done, tasks: {worker.tasks}", flush=True)
+    else:
+        process_batch_json(args.batch_json)
+
+
 if __name__ == '__main__':
     # The purpose of this main is to be used from launcher scripts
     # For example, to launch the processing of a given batch to
@@ -15,6 +15,7 @@
 # **************************************************************************
 
 import os
+import shlex
 import threading
 import time
 import shutil
@@ -22,12 +23,16 @@ import sys
 import json
 import argparse
 from pprint import pprint
+from datetime import timedelta
 
 from emtools.utils import Color, Timer, Path, Process
 from emtools.metadata import Acquisition, StarFile, RelionStar
 from emtools.jobs import Batch
 
 from emwrap.base import ProcessingPipeline
+from emwrap.base.scheduler import GpuScheduler
+from emwrap.base.transfer import TransferEngine
+from emwrap.base.worker_pool import WorkerPool
 from .preprocessing import Preprocessing
 
 
@@ -39,19 +44,25 @@ class PreprocessingPipeline(ProcessingPipeline):
         ProcessingPipeline.__init__(self, input_args, output)
         args = self._args
         self.gpuList = args['gpu'].split()
+        if self.gpu_lease:
+            # Lease the same number of GPUs instead of using the given ones
+            self.gpuList = [str(g) for g in self.get_gpu_list(len(self.gpuList),
+                                                              lease=self.gpu_lease)]
         self.outputDirs = {}
         self.inputStar = args['in_movies']
         self.batchSize = args.get('batch_size', 32)
         self.inputTimeOut = args.get('input_timeout', 3600)
         self.acq = self.loadAcquisition()
-        self._totalInput = self._totalOutput = 0
         self._pp_args = args
         self._pp_args['acquisition'] = Acquisition(self.acq)
 
-        # Create a lock to estimate the extraction args only once,
-        # for the first batch processed
+        # Condition to estimate the particle size only once, from a sample
+        # of the first batch (launcher mode) or the first picked batch
         self._particle_size = self._pp_args['picking'].get('particle_size', None)
-        self._particle_size_lock = threading.Lock()
+        self._particle_size_cond = threading.Condition()
+        self._estimating = False
+        self.transfer = None
+        self.pool = None
 
     @property
     def particle_size(self):
@@ -83,50 +94,198 @@ class PreprocessingPipeline(ProcessingPipeline):
 
         # Define the current pipeline with generator and processors
         outputMicStar = self.join('micrographs.star')
-        if os.path.exists(outputMicStar):
-            with StarFile(outputMicStar) as sf:
-                self._totalOutput = sf.getTableSize('micrographs')
-                self.log(f"Found {self._totalOutput} existing micrographs")
-
         g = self.addMoviesGenerator(self.inputStar, outputMicStar, self.batchSize,
                                     inputTimeOut=self.inputTimeOut,
                                     queueMaxSize=4, createBatch=False)
-        outputQueue = None
-        self.log(f"Creating {len(self.gpuList)} processing threads.", flush=True)
-        for gpu in self.gpuList:
-            p = self.addProcessor(g.outputQueue,
-                                  self.get_preprocessing(gpu),
-                                  outputQueue=outputQueue)
-            outputQueue = p.outputQueue
+        self.log(f"Found {self.progress['previous']} existing micrographs")
+        if workers := self._pp_args.get('workers', None):
+            # Each batch is fully processed by a long-lived worker
+            self._startWorkers(workers)
+            outputQueue = self.addGpuProcessors(g.outputQueue, self.get_preprocessing)
+        elif self._pp_args.get('launcher', None):
+            # Each batch is fully processed by an external process
+            outputQueue = self.addGpuProcessors(g.outputQueue, self.get_preprocessing)
+        else:
+            self.transfer = TransferEngine(streams=int(self._args.get('transfer_streams', 4)))
+            outputQueue = self._addStages(g.outputQueue)
 
         self.addProcessor(outputQueue, self._output)
 
+    def _startWorkers(self, mode):
+        """ Start the worker processes, one per GPU slot. Workers can be
+        started locally ('local') or through the launcher ('launcher').
+        """
+        if mode == 'local':
+            cmd = [sys.executable, '-m', 'emwrap.mix.preprocessing']
+        elif mode == 'launcher':
+            cmd = shlex.split(self._pp_args['launcher'])
+        else:
+            raise Exception(f"Invalid workers mode '{mode}', expected 'local' or 'launcher'")
+
+        self.pool = WorkerPool(self.join('Workers'),
+                               startTimeout=int(self._args.get('worker_timeout', 600)))
+        for gpu, device in self.scheduler.devices.items():
+            self.pool.start(cmd + [os.getcwd()], gpu, count=device.slots,
+                            logfile=self.join('Logs', f'worker_gpu{gpu}.log'))
+        self.log(f"Started {self.scheduler.totalSlots} {mode} workers.", flush=True)
+
+    def _addStages(self, inputQueue):
+        """ Add processors for each of the preprocessing stages, connected
+        through their own queues. GPU stages (motioncor and picking) have
+        one processor per GPU slot, sharing the pipeline's scheduler,
+        CPU stages (ctf and extraction) have
+        'cpu_workers' processors. In this way, a new batch can start motion
+        correction while previous ones are in the CPU stages.
+        Return the output queue of the last stage.
+        """
+        cpuWorkers = int(self._args.get('cpu_workers', 2))
+        gpuStages = ['motioncor', 'picking']
+        stages = Preprocessing(self._pp_args).stages()
+        self.log(f"Preprocessing stages: {Color.cyan(', '.join(stages))}, "
+                 f"CPU workers: {Color.cyan(str(cpuWorkers))}", flush=True)
+
+        def _failed(stage):
+            # Batches that failed in a previous stage do not count
+            # as a failure of the current GPU
+            return lambda batch: batch.get('pp.error_stage', None) == stage
+
+        for stage in stages:
+            if stage in gpuStages:
+                outputQueue = self.addGpuProcessors(
+                    inputQueue, lambda gpu, s=stage: self.get_stage(s, gpu),
+                    failed=_failed(stage),
+                    deviceError=lambda batch: GpuScheduler.is_device_error(
+                        batch.get('pp.error', None)))
+            else:
+                outputQueue = None
+                for _ in range(cpuWorkers):
+                    p = self.addProcessor(inputQueue,
+                                          self.get_stage(stage),
+                                          outputQueue=outputQueue)
+                    outputQueue = p.outputQueue
+            inputQueue = outputQueue
+
+        return inputQueue
+
+    def get_stage(self, stage, gpu=None):
+        kwargs = {'gpu': gpu, 'outputFolder': self.path, 'tmpFolder': self.tmpDir,
+                  'scratch': self.scratch, 'transfer': self.transfer}
+
+        def _stage(batch):
+            # Skip batches that failed in a previous stage
+            if batch.get('pp.error', None):
+                return batch
+
+            try:
+                pp = Preprocessing(self._pp_args)
+                if stage == 'motioncor':
+                    # Convert items to dict
+                    batch['items'] = [row._asdict() for row in batch['items']]
+                    batch = pp.stage_prepare(batch, kwargs)
+
+                if stage == 'picking' and self.particle_size is None:
+                    # Batches picked before the size is known estimate it
+                    # without blocking others, the first estimate is used.
+                    # Extraction of a batch always runs after its picking,
+                    # so the size is known by then
+                    batch.log(f"{Color.warn('Estimating the boxSize.')} "
+                              f"Running picking GPU = {gpu}", flush=True)
+                    pp = Preprocessing(self._size_args())
+                    batch = pp.stage_picking(batch, kwargs)
+                    self._set_particle_size(pp.particle_size, batch)
+                    return batch
+
+                batch = getattr(pp, f'stage_{stage}')(batch, kwargs)
+
+                if stage == 'extract':
+                    # Results are moved in background, free the batch
+                    # scratch space once they are done
+                    def _release(group, batchId=batch.id):
+                        self.scratch.release(batchId, remove=ProcessingPipeline.do_clean())
+                    batch.transfer.add_done_callback(_release)
+
+            except Exception as e:
+                batch.log(Color.red(f"ERROR in stage {stage}: {e}"), flush=True)
+                batch['pp.error'] = str(e)
+                batch['pp.error_stage'] = stage
+                import traceback
+                traceback.print_exc()
+                self.scratch.release(batch.id, remove=ProcessingPipeline.do_clean())
+
+            return batch
+
+        return _stage
+
+    def postrun(self):
+        if self.pool is not None:
+            self.pool.stop()
+        if self.transfer is not None:
+            self.transfer.shutdown()
+            self.info['summary']['transfer'] = self.transfer.stats
+            self.journalInfo('summary', 'transfer')
+
+    def _size_args(self):
+        """ Copy of the preprocessing args where the particle size
+        can be estimated without changing the pipeline's args. """
+        return dict(self._pp_args, picking=dict(self._pp_args['picking']))
+
+    def _set_particle_size(self, size, batch):
+        """ Set the estimated particle size, if it was not set before. """
+        with self._particle_size_cond:
+            if self.particle_size is None and size is not None:
+                self.particle_size = size
+                batch.log(f"Particle size (A): {Color.cyan(str(size))}", flush=True)
+
+    def _estimate_particle_size(self, batch, gpu):
+        """ Estimate the particle size from the first 'size_sample' items
+        of the batch, only running the stages up to picking. """
+        n = int(self._args.get('size_sample', 4))
+        sample = Batch(id=f"{batch.id}_size", path=batch.path,
+                       items=batch['items'][:n], index=batch['index'])
+        batch.log(f"{Color.warn('Estimating the boxSize')} from {len(sample['items'])} "
+                  f"items, GPU = {gpu}", flush=True)
+        pp = Preprocessing(self._size_args())
+        pp.process_batch(sample, gpu=gpu, pool=self.pool,
+                         outputFolder=self.path, tmpFolder=self.tmpDir,
+                         stages=['motioncor', 'ctf', 'picking'])
+        self._set_particle_size(pp.particle_size, batch)
+
+    def _wait_particle_size(self, batch, gpu):
+        """ Wait until the particle size is known. Only one thread runs
+        the estimation, if it fails, another one will try. """
+        with self._particle_size_cond:
+            while self.particle_size is None and self._estimating:
+                self._particle_size_cond.wait()
+            if self.particle_size is not None:
+                return
+            self._estimating = True
+        try:
+            self._estimate_particle_size(batch, gpu)
+        except Exception as e:
+            batch.log(Color.red(f"ERROR estimating the particle size: {e}"), flush=True)
+        finally:
+            with self._particle_size_cond:
+                self._estimating = False
+                self._particle_size_cond.notify_all()
+
     def get_preprocessing(self, gpu):
         def _preprocessing(batch):
             # Convert items to dict
             batch['items'] = [row._asdict() for row in batch['items']]
             gpuStr = Color.cyan(f"GPU = {gpu}")
-            result = None
-
-            def _runPP():
-                pp = Preprocessing(self._pp_args)
-                return pp, pp.process_batch(batch, gpu=gpu,
-                                            outputFolder=self.path,
-                                            tmpFolder=self.tmpDir)
-            with self._particle_size_lock:
-                if self.particle_size is None:
-                    batch.log(f"{Color.warn('Estimating the boxSize.')} "
-                              f"Running preprocessing {gpuStr}", flush=True)
-                    pp, result = _runPP()
-                    # This should update particle_size and other args
-                    self._pp_args.update(pp.args)
-
-            if result is None:
-                batch.log(f"{Color.warn('Using existing boxSize.')} "
-                          f"Running preprocessing {gpuStr}", flush=True)
-
-                _, result = _runPP()
 
+            # Extraction needs the particle size, so when it is not known
+            # it is estimated from a small sample before the batch is launched.
+            # If that fails, the batch estimates it from all its items
+            if self.particle_size is None:
+                self._wait_particle_size(batch, gpu)
+
+            batch.log(f"Running preprocessing {gpuStr}", flush=True)
+            pp = Preprocessing(self._pp_args)
+            result = pp.process_batch(batch, gpu=gpu, pool=self.pool,
+                                      outputFolder=self.path,
+                                      tmpFolder=self.tmpDir)
+            self._set_particle_size(pp.particle_size, batch)
             batch.log(f"Preprocessing done.", flush=True)
             return result
 
@@ -138,6 +297,19 @@ class PreprocessingPipeline(ProcessingPipeline):
         def _pair(name):
             return self.join(name), self.join(f"{batch.id}_{name}")
 
+        # Outputs can only be registered when the files have been moved
+        if transfer := getattr(batch, 'transfer', None):
+            if errors := transfer.wait():
+                batch['pp.error'] = (f"{len(errors)} files could not be moved, "
+                                     f"first error: {errors[0]}")
+            batch.info['move_elapsed'] = str(timedelta(seconds=transfer.elapsed))
+
+        if error := batch.get('pp.error', None) or batch.error:
+            batch.log(Color.red(f"Batch failed, outputs not stored: {error}"), flush=True)
+            self.updateBatchInfo(Batch(batch))
+            self.updateProgress(batch, failed=len(batch['items']))
+            return batch
+
         try:
             batch.log("Storing outputs.", flush=True)
             t = Timer()
@@ -214,13 +386,7 @@ class PreprocessingPipeline(ProcessingPipeline):
                 })
                 self.updateBatchInfo(Batch(batch))
 
-                with StarFile(self.inputStar) as sf:
-                    self._totalInput = sf.getTableSize('movies')
-                self._totalOutput += len(batch['items'])
-                percent = self._totalOutput * 100 / self._totalInput
-                batch.log(f">>> Processed {Color.green(str(self._totalOutput))} out of "
-                          f"{Color.red(str(self._totalInput))} "
-                          f"({Color.bold('%0.2f' % percent)} %)", flush=True)
+                self.updateProgress(batch, processed=len(batch['items']))
 
         except Exception as e:
             batch.log(Color.red('ERROR: ' + str(e)))
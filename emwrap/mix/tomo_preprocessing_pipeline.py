@@ -84,6 +84,9 @@ class TomoPreprocessingPipeline(ProcessingPipeline):
             for r, item in zip(batch['results'], batch['items']):
                 key, section = item
                 movieName = Mdoc.getSubFrameBase(section)
+                if 'error' in r:
+                    batch.log(f"ERROR: Skipping {movieName}, {r['error']}")
+                    continue
                 srcMicName = r.pop('rlnMicrographName')
                 srcMicStar = srcMicName.replace('.mrc', '.star')
                 micName = _move_file(srcMicName)
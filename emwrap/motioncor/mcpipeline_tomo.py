@@ -24,8 +24,7 @@ import sys
 from emtools.utils import Color, FolderManager, Path
 from emtools.metadata import Table, Column, StarFile, RelionStar, Acquisition
 from emtools.jobs import TsStarBatchManager
-from emtools.image import Image
-from emwrap.base import ProcessingPipeline
+from emwrap.base import ProcessingPipeline, ImageDims
 
 from .motioncor import Motioncor
 
@@ -112,7 +111,7 @@ class McPipelineTomo(ProcessingPipeline):
 
                     # Read image dimensions only once
                     if movieDimensions is None:
-                        movieDimensions = Image.get_dimensions(movName)
+                        movieDimensions = ImageDims.get_dimensions(movName)
 
                     baseName = Path.removeBaseExt(movName)
                     files = {}
@@ -205,14 +204,12 @@ class McPipelineTomo(ProcessingPipeline):
         self.acq = RelionStar.get_acquisition(inputTs)
         batchMgr = TsStarBatchManager(inputTs, self.tmpDir)
         g = self.addGenerator(batchMgr.generate)
-        outputQueue = None
         self.mkdir(self.outputTsDir)
-        print(f"Creating {len(self.gpuList)} processing threads.")
-        for gpu in self.gpuList:
-            p = self.addProcessor(g.outputQueue,
-                                  self.get_motioncor_proc(gpu),
-                                  outputQueue=outputQueue)
-            outputQueue = p.outputQueue
+        # Batch folders are created when processing, so slow batches
+        # can be re-dispatched to another GPU in a new folder
+        outputQueue = self.addGpuProcessors(g.outputQueue,
+                                            self.get_motioncor_proc,
+                                            clone=self.cloneBatch)
 
         self.addProcessor(outputQueue, self._output)
 
@@ -19,7 +19,8 @@ import os
 from emtools.utils import Color, Timer, Path, FolderManager
 from emtools.jobs import Args
 from emtools.metadata import Table, StarFile, TextFile, Acquisition
-from emtools.image import Image
+
+from emwrap.base import ImageDims
 
 
 class Motioncor:
@@ -150,7 +151,7 @@ class Motioncor:
              'rlnMicrographPreExposure', 'rlnVoltage',
              'rlnMicrographStartFrame', 'rlnMotionModelVersion'
              ])
-        x, y = Image.get_dimensions(micName)
+        x, y = ImageDims.get_dimensions(micName)[:2]
         tGeneral.addRowValues(x, y, 1, movieName,
                               self.bin,
                               self.acq.pixel_size, 1.0, 0.0,
@@ -24,10 +24,11 @@ from glob import glob
 from datetime import datetime, timedelta
 
 from emtools.utils import Color, FolderManager, Path, Process
-from emtools.metadata import StarFile, Acquisition, StarMonitor, Table
+from emtools.metadata import StarFile, Acquisition, Table
 from emtools.jobs import Batch
-from emtools.image import Image
-from emwrap.base import ProcessingPipeline
+from emwrap.base import ProcessingPipeline, ImageDims
+from emwrap.base.star_tail import StarTailMonitor
+from emwrap.base.star_cache import getTableFromFile
 
 from .pytom import PyTom
 
@@ -39,7 +40,7 @@ class PyTomPipeline(ProcessingPipeline):
     def __init__(self, args, output):
         ProcessingPipeline.__init__(self, args, output)
         # FIXME add support to comma separated values for parallels in batches
-        self.gpuList = [self.get_gpu_list(args['gpus'], as_string=True)]
+        self.gpuList = [self.get_gpu_list(args['gpus'], as_string=True, lease=self.gpu_lease)]
         self.launcher = args.get('launcher', '') or ProcessingPipeline.get_launcher('PYTOM')
 
         self.acq = self.loadAcquisition()
@@ -117,8 +118,8 @@ class PyTomPipeline(ProcessingPipeline):
         counter = 0
         blacklist = []
         self.outTable = None
-        inTable = StarFile.getTableFromFile('global', self.inTomoStar,
-                                            guessType=False)
+        inTable = getTableFromFile('global', self.inTomoStar,
+                                   guessType=False)
         n = len(inTable)
         if os.path.exists(self.outTomoStar):
             self.outTable = StarFile.getTableFromFile('global', self.outTomoStar,
@@ -135,10 +136,10 @@ class PyTomPipeline(ProcessingPipeline):
         self.log(f"Total input tomograms: {Color.bold(n)}")
         self.log(f"Tomograms to process: {Color.green(n - counter)}")
 
-        monitor = StarMonitor(self.inTomoStar, 'global',
-                              lambda row: row.rlnTomoName,
-                              timeout=self.wait['timeout'],
-                              blacklist=blacklist)
+        monitor = StarTailMonitor(self.inTomoStar, 'global',
+                                  lambda row: row.rlnTomoName,
+                                  timeout=self.wait['timeout'],
+                                  blacklist=blacklist)
 
         # This will keep monitor the star files for new tomograms until timed out.
         for row in monitor.newItems():
@@ -148,8 +149,8 @@ class PyTomPipeline(ProcessingPipeline):
             batchId = f"{nowPrefix}_{counter:03}_{tsName}"
             # FIXME: Now reading these values from Warp tomostar, but
             # it should be from Relion's star files
-            t = StarFile.getTableFromFile('', row.wrpTomostar,
-                                          guessType=False)
+            t = getTableFromFile('', row.wrpTomostar,
+                                 guessType=False)
             yield Batch(id=batchId, index=counter,
                         rowDict=row._asdict(),
                         path=os.path.join(self.tmpDir, batchId),
@@ -159,11 +160,11 @@ class PyTomPipeline(ProcessingPipeline):
                         dose_accumulation=[float(r.wrpDose) for r in t])
 
     def _updateInput(self):
-        inputTomoTable = StarFile.getTableFromFile('global', self.inTomoStar)
+        inputTomoTable = getTableFromFile('global', self.inTomoStar)
         first = inputTomoTable[0]
         N = len(inputTomoTable)
         if self._dims is None:
-            self._dims = Image.get_dimensions(first.rlnTomogram)
+            self._dims = ImageDims.get_dimensions(first.rlnTomogram)
         x, y, n = self._dims
         ps = first.rlnTomogramPixelSize
         bin = first.rlnTomoTomogramBinning
@@ -20,15 +20,20 @@ import pathlib
 import sys
 import time
 import json
+import threading
 import argparse
 from datetime import timedelta, datetime
 from glob import glob
 
+import numpy as np
 from emtools.utils import Color, Timer, Path, Process, FolderManager, Pretty
 from emtools.jobs import Batch
 from emtools.metadata import Mdoc, StarFile
 
 from emwrap.base import ProcessingPipeline
+from emwrap.base.info_journal import InfoJournal
+from emwrap.base.star_tail import StarTail
+from emwrap.base.star_columns import ColumnTable
 from .classify2d import RelionClassify2D
 
 
@@ -44,6 +49,8 @@ class StarBatchManager(FolderManager):
             groupColumn: column used to group particles.
                 Usually gridSquare or micrographName
             minSize: minimum size for each batch
+            checkpoint: optional file to store the input position, so
+                a restarted job continues after the last batch created
         """
         FolderManager.__init__(self, outputPath)
         self._inputStar = inputStar
@@ -54,9 +61,20 @@ class StarBatchManager(FolderManager):
         self._timeout = timedelta(seconds=kwargs.get('timeout', 7200))
         self._lastCheck = None  # Last timestamp when input was checked
         self._lastUpdate = None  # Last timestamp when new items were found
-        self._startIndex = 0  # FIXME We might read this value for restarting
-        self._count = 0
-        self._rows = []
+        self._tail = StarTail(inputStar, 'particles',
+                              checkpoint=kwargs.get('checkpoint', None))
+        # Rows already put in batches and number of batches, restored
+        # from the checkpoint if any
+        self._startIndex = self._tail.count
+        self._count = self._tail.extra.get('batches', 0)
+        self._rows = []  # Rows read but not yet in a batch
+        # Input rows until the end of each batch not yet committed and
+        # batches done, the checkpoint only advances over consecutive
+        # processed batches
+        self._batchEnds = {}
+        self._batchesDone = set()
+        self._committed = self._count
+        self._commitLock = threading.Lock()
         self.log = kwargs.get('log', print)
         self._groupColumn = groupColumn
         self._lastValue = None  # used with groupColum to create new batches
@@ -68,7 +86,7 @@ class StarBatchManager(FolderManager):
                 mTime = datetime.fromtimestamp(os.path.getmtime(self._inputStar))
                 now = datetime.now()
                 if self._lastCheck is None or mTime > self._lastCheck:
-                    self.log(f"Reading star file: {self._inputStar}, "
+                    self.log(f"Reading new rows from star file: {self._inputStar}, "
                              "checking for new batches.", flush=True)
                     for batch in self._createNewBatches():
                         self._lastUpdate = now
@@ -96,24 +114,38 @@ class StarBatchManager(FolderManager):
         return r
 
     def _createNewBatches(self, last=False):
+        """ Create batches from the rows appended to the input STAR file,
+        only the new rows are parsed. """
+        resets = self._tail.resets
+        newRows = self._tail.read()
+        if self._tail.resets > resets:
+            # The input was rewritten, skip rows already in batches
+            self.log(Color.warn("Input star file changed, reading it again."))
+            self._rows = []
+            newRows = newRows[self._startIndex:]
+
+        if self._tail.table is None:
+            return
+
         with StarFile(self._inputStar) as sf:
             tOptics = sf.getTable('optics')
-            tParticles = sf.getTableInfo('particles')
-
-            if self._groupColumn is None and self._minSize == 0:  # Take all
-                rows = [row for row in sf.iterTable('particles', start=self._startIndex)]
-                yield self._createBatch(tOptics, tParticles, rows)
-            else:
-                rows = []
-
-                for row in sf.iterTable('particles', start=self._startIndex):
-                    if self._batchCondition(row, rows):
-                        yield self._createBatch(tOptics, tParticles, rows)
-                        rows = []
-                    rows.append(row)
+        tParticles = self._tail.table
 
-                if rows and last:
+        if self._groupColumn is None and self._minSize == 0:  # Take all
+            if newRows:
+                yield self._createBatch(tOptics, tParticles, newRows)
+        else:
+            rows = self._rows
+            for row in newRows:
+                if self._batchCondition(row, rows):
                     yield self._createBatch(tOptics, tParticles, rows)
+                    rows = []
+                rows.append(row)
+            self._rows = rows
+
+            if rows and last:
+                yield self._createBatch(tOptics, tParticles, rows)
+                self._rows = []
 
     def _createBatch(self, tOptics, tParticles, rows):
         self._count += 1
@@ -124,6 +156,7 @@ class StarBatchManager(FolderManager):
                       path=self.join(batch_id))
         batch.create()
         self._startIndex += len(rows)
+        self._batchEnds[self._count] = self._startIndex
 
         outStarFile = batch.join('particles.star')
         with StarFile(outStarFile, 'w') as sfOut:
@@ -135,6 +168,19 @@ class StarBatchManager(FolderManager):
 
         return batch
 
+    def batchDone(self, batch):
+        """ Mark the batch as processed and update the checkpoint. """
+        with self._commitLock:
+            self._batchesDone.add(batch['index'])
+            end = None
+            while self._committed + 1 in self._batchesDone:
+                self._committed += 1
+                self._batchesDone.remove(self._committed)
+                end = self._batchEnds.pop(self._committed)
+            if end is not None:
+                self._tail.extra['batches'] = self._committed
+                self._tail.commit(end)
+
     def timedOut(self):
         """ Return True when there has been timeout seconds
         since last new items were found. """
@@ -153,6 +199,11 @@ class Relion2DPipeline(ProcessingPipeline):
     def __init__(self, input_args, output):
         ProcessingPipeline.__init__(self, input_args, output)
         self.gpuList = self._args['gpu'].split()
+        if self.gpu_lease:
+            # Lease the same number of GPUs instead of using the given ones
+            self.gpuList = [str(g) for g in self.get_gpu_list(len(self.gpuList),
+                                                              lease=self.gpu_lease)]
+        self._batchMgr = None
 
     def get_rln2d_proc(self, gpu):
         def _rln2d(batch):
@@ -200,16 +251,21 @@ class Relion2DPipeline(ProcessingPipeline):
                 self.updateBatchInfo(batch)
                 batch.log(f"Completed batch in {batch.info['_elapsed']},"
                           f"total batches: {len(self.info['batches'])}", flush=True)
+            self._batchMgr.batchDone(batch)
         return batch
 
     def generate_batches(self):
         """ Use a StarBatchManager to generate processing batches from the input
         StarFile. If a given batch was already processed, we will skip it. """
+        # The input position is stored in the output folder, so
+        # a restarted job does not read again the processed particles
         batchMgr = StarBatchManager(self.tmpDir, self._args['in_particles'],
                                     self._args.get('group_column', None),
                                     minSize=self._minSize,
                                     timeout=self._timeout,
+                                    checkpoint=self.join('input_particles.json'),
                                     log=self.log)
+        self._batchMgr = batchMgr
 
         batches = {b for b in self.info.get('batches', {})}
 
@@ -220,6 +276,7 @@ class Relion2DPipeline(ProcessingPipeline):
             if batch['id'] in batches:
                 self.log(f"Skipping batch ID: {batch['id']} because it is "
                          f"already processed.")
+                batchMgr.batchDone(batch)
             else:
                 yield batch
 
@@ -238,14 +295,7 @@ class Relion2DPipeline(ProcessingPipeline):
         else:
             self.mkdir('Classes2D')
 
-        outputQueue = None
-        self.log(f"Creating {len(self.gpuList)} processing threads.")
-        for gpu in self.gpuList:
-            self.log(f"Creating processor for gpu: {gpu}")
-            p = self.addProcessor(g.outputQueue,
-                                  self.get_rln2d_proc(gpu),
-                                  outputQueue=outputQueue)
-            outputQueue = p.outputQueue
+        outputQueue = self.addGpuProcessors(g.outputQueue, self.get_rln2d_proc)
 
         self.log(f"Adding output processor")
         self.addProcessor(outputQueue, self._output)
@@ -282,20 +332,17 @@ def create_subset():
             print("   Selection: ", missing)
             selection = []
 
-        with StarFile(ptsFn) as sf:
-            if partTable := sf.getTable('particles'):
-                if firstTime:
-                    sfOut.writeTimeStamp()
-                    sfOut.writeTable('optics', sf.getTable('optics'))
-                    sfOut.writeHeader('particles', partTable)
-                discarded = 0
-                for row in partTable:
-                    clsNumber = int(row.rlnClassNumber)
-                    if not selection or clsNumber in selection:
-                        sfOut.writeRow(row)
-                    else:
-                        discarded += 1
-                print(f">>> Discarded {Color.red(discarded)} particles")
+        tables = ColumnTable.readAll(ptsFn)
+        if partTable := tables.get('particles'):
+            if firstTime:
+                sfOut.writeTimeStamp()
+                tables['optics'].write(sfOut, 'optics')
+            total = len(partTable)
+            if selection:
+                mask = np.isin(partTable.numeric('rlnClassNumber', int), selection)
+                partTable = partTable.select(mask)
+            partTable.write(sfOut, 'particles', header=firstTime)
+            print(f">>> Discarded {Color.red(total - len(partTable))} particles")
         firstTime = False
 
     sfOut.close()
@@ -304,8 +351,7 @@ def create_subset():
 def register_outputs():
     run = FolderManager(os.getcwd())
 
-    with open('info.json') as f:
-        info = json.load(f)
+    info = InfoJournal.read('info.json')
 
     for batchFolder in sorted(os.listdir(run.join('tmp'))):
         clsBatch = run.join('Classes2D', batchFolder)
@@ -45,8 +45,8 @@ import os
 
 from emtools.utils import Color
 from emtools.jobs import Batch, Args
-from emtools.image import Image
 
+from emwrap.base import ImageDims
 from .relion_base import RelionBasePipeline
 
 
@@ -97,7 +97,7 @@ class RelionMaskCreate(RelionBasePipeline):
             )
 
         try:
-            dims = Image.get_dimensions(out_mask)
+            dims = ImageDims.get_dimensions(out_mask)
             if isinstance(dims, (list, tuple)) and len(dims) >= 3:
                 info = f"box size: {dims[0]} x {dims[1]} x {dims[2]} px"
             elif isinstance(dims, (list, tuple)) and len(dims) > 0:
@@ -18,8 +18,8 @@ import os
 
 from emtools.utils import Color
 from emtools.jobs import Batch, Args
-from emtools.image import Image
 
+from emwrap.base import ImageDims
 from .relion_base import RelionBasePipeline
 
 
@@ -61,7 +61,7 @@ class RelionSymmetrizeVolume(RelionBasePipeline):
 
         # Get volume dimensions for output info
         try:
-            dims = Image.get_dimensions(outVol)
+            dims = ImageDims.get_dimensions(outVol)
             if isinstance(dims, (list, tuple)) and len(dims) >= 3:
                 info = f"box size: {dims[0]} x {dims[1]} x {dims[2]} px"
             elif isinstance(dims, (list, tuple)) and len(dims) > 0:
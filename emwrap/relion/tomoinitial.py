@@ -32,10 +32,10 @@ import os
 import re
 from glob import glob
 
-from emtools.image import Image
 from emtools.jobs import Batch, Args
 from emtools.metadata import StarFile
 
+from emwrap.base import ImageDims
 from .relion_base import RelionBasePipeline
 
 
@@ -166,7 +166,7 @@ class RelionTomoinitial(RelionBasePipeline):
             n_pts = None
 
         if box is None:
-            dims = Image.get_dimensions(primary_vol)
+            dims = ImageDims.get_dimensions(primary_vol)
             box = dims[0] if isinstance(dims, (list, tuple)) else dims
             ps = "?"
 
@@ -21,8 +21,8 @@ from datetime import datetime
 from emtools.utils import Color, FolderManager, Path, Process
 from emtools.metadata import StarFile, Acquisition, Table
 from emtools.jobs import Batch, Args
-from emtools.image import Image
 
+from emwrap.base import ImageDims
 from . relion_base import RelionBasePipeline
 
 
@@ -46,7 +46,7 @@ class RelionTomoRecons(RelionBasePipeline):
             table = sf.getTable(ptsTableName, guessType=False)
             n = len(table)
             ps = '%0.3f' % float(table[0].rlnPixelSize)
-            box = Image.get_dimensions(table[0].rlnImageName)[0]
+            box = ImageDims.get_dimensions(table[0].rlnImageName)[0]
 
         self.log(f"Input star file: {Color.bold(inStar)}")
         self.log(f"Total input particles: {Color.green(n)}")
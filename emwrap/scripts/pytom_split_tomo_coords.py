@@ -18,7 +18,10 @@ import os
 import re
 import sys
 
-from emtools.metadata import StarFile, Table
+import numpy as np
+from emtools.metadata import StarFile
+
+from emwrap.base.star_columns import ColumnTable
 
 PREFIX = 'grid1_Position_'
 SINGLESHOT_OUT = 'singleshot_tomo_coords.star'
@@ -57,29 +60,26 @@ def split_tomo_coords(star_path, output_dir=None):
     output_dir = os.path.abspath(output_dir)
     os.makedirs(output_dir, exist_ok=True)
 
-    global_table = StarFile.getTableFromFile('global', star_path)
-    col_names = global_table.getColumnNames()
-    single_table = Table(col_names)
-    multi_table = Table(col_names)
-
-    for row in global_table:
-        tomo_name = getattr(row, 'rlnTomoName', None)
-        if tomo_name is None:
-            multi_table.addRowValues(**row._asdict())
-            continue
-        num = _position_number(tomo_name)
-        if num is not None and num < POSITION_THRESHOLD:
-            single_table.addRowValues(**row._asdict())
-        else:
-            multi_table.addRowValues(**row._asdict())
+    global_table = ColumnTable.read(star_path, 'global')
+    if 'rlnTomoName' in global_table:
+        def _single(tomo_name):
+            num = _position_number(tomo_name)
+            return num is not None and num < POSITION_THRESHOLD
+
+        # The rule is evaluated once per tomogram name, not per row
+        mask = global_table.where('rlnTomoName', _single)
+    else:
+        mask = np.zeros(len(global_table), dtype=bool)
+    single_table = global_table.select(mask)
+    multi_table = global_table.select(~mask)
 
     single_path = os.path.join(output_dir, SINGLESHOT_OUT)
     multi_path = os.path.join(output_dir, MULTISHOT_OUT)
 
-    with StarFile(single_path, 'w') as sf:
-        sf.writeTable('global', single_table, timeStamp=True, computeFormat='left')
-    with StarFile(multi_path, 'w') as sf:
-        sf.writeTable('global', multi_table, timeStamp=True, computeFormat='left')
+    for path, table in [(single_path, single_table), (multi_path, multi_table)]:
+        with StarFile(path, 'w') as sf:
+            sf.writeTimeStamp()
+            table.write(sf, 'global', align='left')
 
     return len(single_table), len(multi_table)
 
@@ -15,10 +15,11 @@
 # **************************************************************************
 
 import argparse
-import json
 import os
 import sys
 
+from emwrap.base.info_journal import InfoJournal
+
 # WarpBasePipeline.TS
 WARP_TILTSERIES = 'warp_tiltseries'
 TILTSTACK = 'tiltstack'
@@ -34,10 +35,8 @@ def _aligned_mrc_path(job_folder, ts_name):
 def _input_ts_from_info(job_folder):
     """Input tilt series star from job info.json (AreTomo registers TiltSeries)."""
     info_path = os.path.join(job_folder, 'info.json')
-    if not os.path.exists(info_path):
+    if (info := InfoJournal.read(info_path)) is None:
         return None
-    with open(info_path) as f:
-        info = json.load(f)
     inputs = info.get('inputs') or {}
     block = inputs.get('TiltSeries')
     if block:
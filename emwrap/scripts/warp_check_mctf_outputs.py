@@ -19,10 +19,11 @@
 # **************************************************************************
 
 import argparse
-import json
 import os
 import sys
 
+from emwrap.base.info_journal import InfoJournal
+
 # Must match WarpBasePipeline.FS in warp.py
 WARP_FRAMESERIES = 'warp_frameseries'
 
@@ -35,10 +36,8 @@ def _movie_prefix(path_or_name):
 def _input_ts_from_info(job_folder):
     """Get input tilt series star path from job info.json."""
     info_path = os.path.join(job_folder, 'info.json')
-    if not os.path.exists(info_path):
+    if (info := InfoJournal.read(info_path)) is None:
         return None
-    with open(info_path) as f:
-        info = json.load(f)
     inputs = info.get('inputs') or {}
     for key in ('FrameSeries', 'TiltSeries'):
         block = inputs.get(key)
@@ -25,6 +25,8 @@ from pprint import pp, pprint
 from emtools.metadata import StarFile, Table
 from emtools.utils import Color
 
+from emwrap.base.star_columns import ColumnTable
+
 
 TOMO_STAR = 'warp_particles_tomograms.star'
 PARTICLES_STAR = 'warp_particles.star' 
@@ -41,7 +43,7 @@ def _write_tables(sf, tablesDict, blacklist=None):
     for name, table in tablesDict.items():
         if blacklist and name in blacklist:
             continue
-        sf.writeTable(name, table)
+        table.write(sf, name)
 
 
 def merge_export_particles_outputs(args):
@@ -64,23 +66,16 @@ def merge_export_particles_outputs(args):
     primary_particles = _primary(PARTICLES_STAR)
     secondary_particles = _secondary(PARTICLES_STAR)
 
-    ogNameMap = {}
-    ogIdMap = {}
-
     # Merge tomograms star files
-    primary_tomo_tables = StarFile.getTablesDict(primary_tomo)
-    secondary_tomo_tables = StarFile.getTablesDict(secondary_tomo)
+    primary_tomo_tables = ColumnTable.readAll(primary_tomo)
+    secondary_tomo_tables = ColumnTable.readAll(secondary_tomo)
     # Merge global tables first 
     global_table = primary_tomo_tables['global']
-    dummy = global_table[0].rlnTomoTiltSeriesName
-    for row in secondary_tomo_tables['global']:
-        rowValues = row._asdict()
-        og = rowValues['rlnOpticsGroupName']
-        rowValues['rlnTomoTiltSeriesName'] = dummy
-        ogNew = f'{alias}_{og}'
-        rowValues['rlnOpticsGroupName'] = ogNew
-        ogNameMap[og] = ogNew
-        global_table.addRowValues(**rowValues)
+    secondary_global = secondary_tomo_tables['global']
+    ogNameMap = {og: f'{alias}_{og}' for og in secondary_global.unique('rlnOpticsGroupName')}
+    secondary_global.setColumn('rlnTomoTiltSeriesName', global_table.row(0)['rlnTomoTiltSeriesName'])
+    secondary_global.mapValues('rlnOpticsGroupName', lambda og: ogNameMap[og])
+    primary_tomo_tables['global'] = global_table.concat(secondary_global)
 
     output_tomo_star = _output_star(TOMO_STAR)
     with StarFile(output_tomo_star, 'w') as sf:
@@ -89,36 +84,34 @@ def merge_export_particles_outputs(args):
         _write_tables(sf, secondary_tomo_tables, blacklist=['global'])
 
     # Merge particles star files
-    primary_particles_tables = StarFile.getTablesDict(primary_particles)
-    secondary_particles_tables = StarFile.getTablesDict(secondary_particles)
+    primary_particles_tables = ColumnTable.readAll(primary_particles)
+    secondary_particles_tables = ColumnTable.readAll(secondary_particles)
     
     optics_table = primary_particles_tables['optics']
-    maxOgId = max(int(row.rlnOpticsGroup) for row in optics_table)
+    maxOgId = int(optics_table.numeric('rlnOpticsGroup', int).max())
 
-    for row in secondary_particles_tables['optics']:
-        rowValues = row._asdict()
-        ogName = rowValues['rlnOpticsGroupName']
-        ogId = rowValues['rlnOpticsGroup']
+    # Optics groups of the other folder are numbered after the primary ones
+    secondary_optics = secondary_particles_tables['optics']
+    ogIdMap = {}
+    for ogId in secondary_optics['rlnOpticsGroup']:
         maxOgId += 1
-        ogNewName = ogNameMap[ogName]
         ogIdMap[ogId] = maxOgId
-        rowValues['rlnOpticsGroup'] = maxOgId
-        rowValues['rlnOpticsGroupName'] = ogNewName
-        optics_table.addRowValues(**rowValues)
+    secondary_optics.mapValues('rlnOpticsGroup', lambda ogId: ogIdMap[ogId])
+    secondary_optics.mapValues('rlnOpticsGroupName', lambda og: ogNameMap[og])
+    primary_particles_tables['optics'] = optics_table.concat(secondary_optics)
 
     particles_table = primary_particles_tables['particles']
-    jobId = particles_table[0].rlnImageName.split('/Particles/')[0]
+    jobId = particles_table.row(0)['rlnImageName'].split('/Particles/')[0]
     newPrefix = os.path.join(jobId, alias)
 
-    for row in secondary_particles_tables['particles']:
-        rowValues = row._asdict()
-        ogId = rowValues['rlnOpticsGroup']
-        ogNewId = ogIdMap[ogId]
-        rowValues['rlnOpticsGroup'] = ogNewId
-        imageName = rowValues['rlnImageName']
-        imageNewName = os.path.join(newPrefix, 'Particles', imageName.split('/Particles/')[1])
-        rowValues['rlnImageName'] = imageNewName
-        particles_table.addRowValues(**rowValues)
+    def _imageNewName(imageName):
+        return os.path.join(newPrefix, 'Particles', imageName.split('/Particles/')[1])
+
+    # Values are rewritten once per unique value, not per particle
+    secondary_particles = secondary_particles_tables['particles']
+    secondary_particles.mapValues('rlnOpticsGroup', lambda ogId: ogIdMap[ogId])
+    secondary_particles.mapValues('rlnImageName', _imageNewName)
+    primary_particles_tables['particles'] = particles_table.concat(secondary_particles)
 
     output_particles_star = _output_star(PARTICLES_STAR)
     with StarFile(output_particles_star, 'w') as sf:
@@ -25,25 +25,26 @@ from pprint import pp, pprint
 from emtools.metadata import StarFile, Table
 from emtools.utils import Color
 
+from emwrap.base.star_columns import ColumnTable
+
 
 def subset_tomograms_star(args):
     cwd = os.getcwd()
 
-    input_tomograms_table = StarFile.getTableFromFile('global', args.input_tomograms_star)
-    input_particles_table = StarFile.getTableFromFile('particles', args.input_particles_star)
-    tomograms_names = set(row.rlnTomoName.replace('.tomostar', '') for row in input_particles_table)
+    input_tomograms_table = ColumnTable.read(args.input_tomograms_star, 'global')
+    input_particles_table = ColumnTable.read(args.input_particles_star, 'particles')
+    # Tomogram names are taken from the unique values, not from every particle
+    tomograms_names = set(name.replace('.tomostar', '')
+                          for name in input_particles_table.unique('rlnTomoName'))
+    subset_table = input_tomograms_table.select(
+        input_tomograms_table.isin('rlnTomoName', tomograms_names))
 
-    count = 0
     with StarFile(args.output_tomograms_star, 'w') as sf:
         sf.writeTimeStamp()
-        sf.writeHeader('global', input_tomograms_table)
-        for row in input_tomograms_table:
-            if row.rlnTomoName in tomograms_names:
-                sf.writeRow(row)
-                count += 1
-        print(f'>>> Created subset with {Color.green(count)} tomograms')
+        subset_table.write(sf, 'global')
+        print(f'>>> Created subset with {Color.green(len(subset_table))} tomograms')
         print(f'>>> Total tomograms: {len(input_tomograms_table)}')
-        print(f'>>> Total particles: {len(input_particles_table)}')        
+        print(f'>>> Total particles: {len(input_particles_table)}')
 
 
 def main(argv=None):
@@ -0,0 +1,839 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import sys
+import time
+import struct
+import subprocess
+import threading
+import unittest
+import tempfile
+import tracemalloc
+
+from emtools.metadata import StarFile
+
+from emwrap.base.info_journal import InfoJournal
+from emwrap.base.file_watcher import FileWatcher, InotifyWatcher
+from emwrap.base.image_dims import ImageDims
+from emwrap.base.scratch import ScratchManager
+from emwrap.base.transfer import TransferEngine, copy_file
+from emwrap.base.scheduler import GpuScheduler
+from emwrap.base.adaptive_batch import AdaptiveBatchManager
+from emwrap.base.worker_pool import WorkerPool, Worker
+from emwrap.base.star_tail import StarTail
+from emwrap.base.star_columns import ColumnTable
+from emwrap.base.star_cache import StarCache
+from emwrap.base.project_index import ProjectIndex
+from emwrap.base.job_tracker import JobStatusTracker
+from emwrap.base.project_manager import _queue_directives, _add_directives
+from emwrap.base.workflow_runner import job_resources
+from emwrap.base.gpu_lease import GpuLeaseManager
+from emwrap.warp.utils import WarpCtfIndex
+
+
+class TestInfoJournal(unittest.TestCase):
+    def _new_info(self):
+        return {'inputs': {}, 'outputs': {}, 'runs': [],
+                'summary': {}, 'batches': {}}
+
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            infoFile = os.path.join(tmp, 'info.json')
+            journal = InfoJournal(infoFile, compactEvery=100)
+            info = self._new_info()
+            journal.compact(info)
+
+            info['runs'].append({'start': 'now'})
+            journal.append(info, ['runs', 0], info['runs'][0])
+            for i in range(5):
+                info['batches'][f'b{i}'] = {'index': i}
+                journal.append(info, ['batches', f'b{i}'], {'index': i})
+
+            # Only the journal has the updates, info.json is not rewritten
+            self.assertTrue(os.path.exists(journal.journalFile))
+            self.assertEqual(InfoJournal.read(infoFile), info)
+
+            # A truncated last line should be ignored
+            with open(journal.journalFile, 'a') as f:
+                f.write('{"key": ["outputs"')
+            self.assertEqual(InfoJournal.read(infoFile), info)
+
+    def test_compact(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            infoFile = os.path.join(tmp, 'info.json')
+            journal = InfoJournal(infoFile, compactEvery=3)
+            info = self._new_info()
+            for i in range(3):
+                info['batches'][f'b{i}'] = {'index': i}
+                journal.append(info, ['batches', f'b{i}'], {'index': i})
+
+            self.assertFalse(os.path.exists(journal.journalFile))
+            self.assertEqual(InfoJournal.read(infoFile), info)
+
+    def test_other_writer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            infoFile = os.path.join(tmp, 'info.json')
+            journal = InfoJournal(infoFile, compactEvery=100)
+            info = self._new_info()
+            journal.compact(info)
+            info['batches']['b0'] = {'index': 0}
+            journal.append(info, ['batches', 'b0'], {'index': 0})
+
+            # Register a subset while the job is running
+            subset = {'files': [['subset.star', 'Particles']]}
+            InfoJournal(infoFile).append(InfoJournal.read(infoFile),
+                                         ['outputs', 'ParticlesSubset'], subset)
+            journal.compact(info)
+
+            self.assertFalse(os.path.exists(journal.journalFile))
+            self.assertEqual(info['outputs']['ParticlesSubset'], subset)
+            self.assertEqual(InfoJournal.read(infoFile), info)
+
+    def test_missing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertIsNone(InfoJournal.read(os.path.join(tmp, 'info.json')))
+
+
+class TestFileWatcher(unittest.TestCase):
+    def _touch(self, *parts):
+        fn = os.path.join(*parts)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        open(fn, 'w').close()
+        return fn
+
+    def _test_backend(self, backend):
+        with tempfile.TemporaryDirectory() as tmp:
+            pattern = os.path.join(tmp, 'Images-Disc1', '*', 'Data', '*_EER.eer')
+            fn1 = self._touch(tmp, 'Images-Disc1', 'GridSquare_1', 'Data', 'm1_EER.eer')
+            self._touch(tmp, 'Images-Disc1', 'GridSquare_1', 'Data', 'm1.xml')
+
+            watcher = FileWatcher.create(pattern, backend=backend)
+            self.assertEqual(watcher.name, backend)
+            self.assertEqual(watcher.newFiles(), [fn1])
+            self.assertEqual(watcher.newFiles(), [])
+
+            # New file in existing folder and in a new grid square
+            fn2 = self._touch(tmp, 'Images-Disc1', 'GridSquare_1', 'Data', 'm2_EER.eer')
+            fn3 = self._touch(tmp, 'Images-Disc1', 'GridSquare_2', 'Data', 'm3_EER.eer')
+            self.assertEqual(sorted(watcher.newFiles()), [fn2, fn3])
+            self.assertEqual(watcher.newFiles(), [])
+            watcher.close()
+
+    def test_poll(self):
+        self._test_backend('poll')
+
+    def test_inotify(self):
+        if not InotifyWatcher.available():
+            self.skipTest("inotify is not available")
+        self._test_backend('inotify')
+
+
+class TestImageDims(unittest.TestCase):
+    def _write_mrc(self, fn, x, y, n):
+        with open(fn, 'wb') as f:
+            f.write(struct.pack('<3i', x, y, n) + bytes(1012))
+
+    def _write_tiff(self, fn, x, y, n):
+        """ Write a minimal classic TIFF with n IFDs (no pixel data). """
+        entries = [(256, 3, 1, x), (257, 4, 1, y)]
+        ifdSize = 2 + 12 * len(entries) + 4
+        with open(fn, 'wb') as f:
+            f.write(b'II' + struct.pack('<HI', 42, 8))
+            for i in range(n):
+                offset = 8 + (i + 1) * ifdSize if i < n - 1 else 0
+                f.write(struct.pack('<H', len(entries)))
+                for tag, typ, count, value in entries:
+                    fmt = '<HHIH2x' if typ == 3 else '<HHII'
+                    f.write(struct.pack(fmt, tag, typ, count, value))
+                f.write(struct.pack('<I', offset))
+
+    def test_headers(self):
+        ImageDims.clear()
+        with tempfile.TemporaryDirectory() as tmp:
+            mrc = os.path.join(tmp, 'mic.mrc')
+            tiff = os.path.join(tmp, 'movie.tiff')
+            eer = os.path.join(tmp, 'movie.eer')
+            self._write_mrc(mrc, 4096, 4000, 1)
+            self._write_tiff(tiff, 5760, 4092, 40)
+            self._write_tiff(eer, 4096, 4096, 600)
+
+            self.assertEqual(ImageDims.get_dimensions(mrc), (4096, 4000, 1))
+            self.assertEqual(ImageDims.get_dimensions(tiff), (5760, 4092, 40))
+            self.assertEqual(ImageDims.get_dimensions(eer), (4096, 4096, 600))
+            self.assertEqual(ImageDims.misses, 3)
+
+            missing = os.path.join(tmp, 'missing.mrc')
+            allDims = ImageDims.get_dimensions_many([mrc, tiff, eer, missing])
+            self.assertEqual(allDims[tiff], (5760, 4092, 40))
+            self.assertIsNone(allDims[missing])
+            self.assertEqual(ImageDims.hits, 3)
+
+            # A modified file should be read again
+            self._write_mrc(mrc, 512, 512, 256)
+            os.utime(mrc, ns=(0, 0))
+            self.assertEqual(ImageDims.get_dimensions(mrc), (512, 512, 256))
+
+
+class TestWarpCtfIndex(unittest.TestCase):
+    XML = """<Movie DataDimensionsUnscaled="4096,4096,1">
+  <CTF>
+    <Param Name="Defocus" Value="{defocus}" />
+    <Param Name="DefocusDelta" Value="0.05" />
+    <Param Name="DefocusAngle" Value="12.5" />
+    <Param Name="Cs" Value="2.7" />
+  </CTF>
+  <GridCTF Width="1" Height="1" Duration="1"><Node X="0" Y="0" Z="0" Value="2.1" /></GridCTF>
+</Movie>"""
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            xmlFiles = [os.path.join(tmp, f'movie{i}.xml') for i in range(3)]
+            for i, xmlFile in enumerate(xmlFiles[:2]):
+                with open(xmlFile, 'w') as f:
+                    f.write(self.XML.format(defocus=i + 1))
+
+            indexFile = os.path.join(tmp, 'ctf_index.json')
+            allCtf = WarpCtfIndex(indexFile).get_many(xmlFiles)
+            self.assertEqual(allCtf[xmlFiles[1]],
+                             {'Defocus': '2', 'DefocusDelta': '0.05', 'DefocusAngle': '12.5'})
+            self.assertIsNone(allCtf[xmlFiles[2]])
+
+            # Values are taken from the index unless the xml is modified
+            index = WarpCtfIndex(indexFile)
+            index._index[xmlFiles[1]][1]['Defocus'] = 'cached'
+            index.save()
+            with open(xmlFiles[0], 'w') as f:
+                f.write(self.XML.format(defocus=5))
+            os.utime(xmlFiles[0], ns=(0, 0))
+            allCtf = WarpCtfIndex(indexFile).get_many(xmlFiles)
+            self.assertEqual(allCtf[xmlFiles[0]]['Defocus'], '5')
+            self.assertEqual(allCtf[xmlFiles[1]]['Defocus'], 'cached')
+
+
+class TestScratchManager(unittest.TestCase):
+    def test_reserve(self):
+        with tempfile.TemporaryDirectory() as tmp1, tempfile.TemporaryDirectory() as tmp2:
+            scratch = ScratchManager([tmp1, tmp2], minFree=0, timeout=0, sleep=0)
+            self.assertEqual(scratch.roots[:2], [tmp1, tmp2])
+            free = scratch._available(tmp1)
+
+            path1 = scratch.reserve('b1', free // 2)
+            self.assertTrue(path1.startswith(tmp1) and os.path.isdir(path1))
+            # Not enough space in the first root, use the second one
+            path2 = scratch.reserve('b2', free // 2 + free // 4)
+            self.assertTrue(path2.startswith(tmp2))
+            stats = scratch.stats()
+            self.assertEqual(stats['active'], 2)
+            self.assertEqual(stats['fallbacks'], 1)
+
+            scratch.release('b1')
+            self.assertFalse(os.path.exists(path1))
+            self.assertEqual(scratch.stats()['roots'][tmp1]['reserved'], 0)
+            self.assertEqual(scratch.stats()['roots'][tmp1]['high_water'], free // 2)
+
+            with self.assertRaises(Exception):
+                scratch.reserve('b3', 100 * free)
+
+
+class TestGpuScheduler(unittest.TestCase):
+    def test_slots(self):
+        slots = GpuScheduler.parse_slots('0:2 1:1', ['0', '1'])
+        self.assertEqual(slots, {'0': 2, '1': 1})
+        scheduler = GpuScheduler(['0', '1'], slots=slots, log=lambda m: None)
+        self.assertEqual(scheduler.totalSlots, 3)
+        gpus = [scheduler.acquire(block=False) for _ in range(4)]
+        self.assertEqual(sorted(gpus[:3]), ['0', '0', '1'])
+        self.assertIsNone(gpus[3])
+
+    def test_failures(self):
+        scheduler = GpuScheduler(['0', '1'], maxFailures=2, log=lambda m: None)
+
+        def _func(gpu):
+            def _process(task):
+                if gpu == '0':
+                    raise Exception("CUDA error: unspecified launch failure")
+                return task
+            return _process
+
+        for i in range(6):
+            try:
+                scheduler.run(i, _func)
+            except Exception:
+                pass
+        stats = scheduler.stats()['devices']
+        self.assertTrue(stats['0']['disabled'])
+        self.assertEqual(stats['0']['failures'], 2)
+        self.assertFalse(stats['1']['disabled'])
+        # Only the healthy GPU is used now
+        self.assertEqual(scheduler.run(10, _func), 10)
+
+    def test_task_errors(self):
+        scheduler = GpuScheduler(['0'], maxFailures=1, log=lambda m: None)
+
+        def _func(gpu):
+            def _process(task):
+                raise Exception("Input file not found")
+            return _process
+
+        for i in range(3):
+            with self.assertRaises(Exception):
+                scheduler.run(i, _func)
+        # Errors of the inputs do not disable the GPU
+        stats = scheduler.stats()['devices']['0']
+        self.assertFalse(stats['disabled'])
+        self.assertEqual((stats['failures'], stats['errors']), (0, 3))
+        isDeviceError = GpuScheduler.is_device_error
+        self.assertTrue(isDeviceError("CUDA error: out of memory"))
+        self.assertTrue(isDeviceError("cudaErrorIllegalAddress in kernel"))
+        self.assertFalse(isDeviceError("Missing files: a.mrc"))
+        # The command line of the program is not checked
+        self.assertFalse(isDeviceError("Failed: MotionCor3 -InMrc a.mrc -Gpu 0 "
+                                       "(NVIDIA GPU)"))
+        cmd = ['MotionCor3', '-Gpu', '0', 'CUDA_ERROR']
+        self.assertFalse(isDeviceError(subprocess.CalledProcessError(1, cmd, stderr='bad')))
+        # Only crashes count, not programs killed (e.g. SIGKILL, SIGTERM)
+        self.assertTrue(isDeviceError(subprocess.CalledProcessError(-11, cmd)))
+        self.assertTrue(isDeviceError(subprocess.CalledProcessError(134, cmd)))
+        self.assertFalse(isDeviceError(subprocess.CalledProcessError(-9, cmd)))
+        self.assertFalse(isDeviceError(subprocess.CalledProcessError(143, cmd)))
+
+    def test_cooldown(self):
+        probes = []
+        scheduler = GpuScheduler(['0'], maxFailures=1, cooldown=0.2,
+                                 probe=lambda gpu: probes.append(gpu) or len(probes) > 1,
+                                 log=lambda m: None)
+        scheduler.release(scheduler.acquire(), 1, False, deviceError=True)
+        self.assertIsNone(scheduler.acquire(block=False))
+        # The first probe fails, the GPU is enabled after the second one
+        self.assertEqual(scheduler.acquire(), '0')
+        self.assertEqual(probes, ['0', '0'])
+        # On probation, a single device failure disables it again
+        scheduler.release('0', 1, False, deviceError=True)
+        self.assertTrue(scheduler.devices['0'].disabled)
+        self.assertEqual(scheduler.stats()['devices']['0']['failures'], 2)
+
+    def test_straggler(self):
+        scheduler = GpuScheduler(['0', '1'], minSamples=1, checkInterval=0.05,
+                                 stragglerFactor=2, log=lambda m: None)
+        scheduler._durations.append(0.05)
+        discarded = []
+
+        def _func(gpu):
+            def _process(task):
+                time.sleep(2 if gpu == '0' else 0.01)
+                return f"{task}-{gpu}"
+            return _process
+
+        result = scheduler.run('t', _func, clone=lambda t: t,
+                               discard=discarded.append)
+        self.assertEqual(result, 't-1')
+        self.assertEqual(scheduler.speculative, 1)
+
+
+class TestAdaptiveBatchManager(unittest.TestCase):
+    def _manager(self, items, tmp, **kwargs):
+        return AdaptiveBatchManager(8, iter(items), tmp, log=lambda m: None,
+                                    itemFileNameFunc=lambda item: item,
+                                    createBatch=False, **kwargs)
+
+    def test_sizes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            mgr = self._manager([], tmp, minSize=2, maxSize=16, maxLatency=100)
+            self.assertEqual(mgr.target(10), (2, 'startup'))
+            mgr.record(4, 40)  # 10 seconds per item
+            self.assertEqual(mgr.target(3), (10, 'rate'))
+            self.assertEqual(mgr.target(12), (12, 'backlog'))
+            self.assertEqual(mgr.target(40), (16, 'backlog'))
+            mgr.queueDepth = lambda: 2
+            self.assertEqual(mgr.target(5), (5, 'backlog'))
+
+    def test_latency(self):
+        def _slow_items():
+            yield 'a.mrc'
+            time.sleep(1)
+            yield 'b.mrc'
+
+        with tempfile.TemporaryDirectory() as tmp:
+            mgr = self._manager(_slow_items(), tmp, minSize=4, maxLatency=0.2)
+            # Items should not wait for the batch to be full
+            sizes = [len(b['items']) for b in mgr.generate()]
+            self.assertEqual(sizes, [1, 1])
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_tasks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pool = WorkerPool(tmp, startTimeout=1, sleep=0.05)
+            threads = set()
+
+            def _handler(payload):
+                threads.add(threading.get_ident())
+                if payload['n'] < 0:
+                    raise Exception("Negative")
+                return payload['n'] * 2
+
+            worker = Worker(tmp, 0, _handler, sleep=0.05)
+            t = threading.Thread(target=worker.run)
+            t.start()
+
+            for n in [1, 2, -1]:
+                pool.submit(f'task{n}', 0, {'n': n})
+            self.assertEqual(pool.wait('task1', 0)['result'], 2)
+            self.assertEqual(pool.wait('task2', 0)['result'], 4)
+            self.assertIn('error', pool.wait('task-1', 0))
+            self.assertEqual(len(pool.workers(0)), 1)
+            # The same worker processed all tasks
+            self.assertEqual(len(threads), 1)
+
+            # No worker for this GPU
+            pool.submit('other', 1, {'n': 1})
+            self.assertIn('error', pool.wait('other', 1))
+
+            pool.stop()
+            t.join()
+            self.assertEqual(worker.tasks, 3)
+            self.assertEqual(pool.workers(), [])
+
+    def test_start_stop(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pool = WorkerPool(os.path.join(tmp, 'pool'))
+            logFile = os.path.join(tmp, 'workers.log')
+            pool.start([sys.executable, '-c', 'print("started")'], 0, logfile=logFile)
+            out = pool._procs[0][2]
+            pool.stop()
+            # The log file of local workers is closed when they stop
+            self.assertTrue(out.closed)
+            with open(logFile) as f:
+                self.assertEqual(f.read().strip(), 'started')
+
+
+class TestStarTail(unittest.TestCase):
+    HEADER = "\ndata_optics\n\n_rlnOpticsGroup 1\n\ndata_particles\n\nloop_\n_rlnImageName\n_rlnDefocusU\n"
+
+    def _append(self, fn, start, end):
+        with open(fn, 'a') as f:
+            for i in range(start, end):
+                f.write(f"{i:06}@particles.mrcs {10000 + i}.0\n")
+
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'particles.star')
+            checkpoint = os.path.join(tmp, 'checkpoint.json')
+            tail = StarTail(fn, 'particles', checkpoint=checkpoint)
+            self.assertEqual(tail.read(), [])
+            with open(fn, 'w') as f:
+                f.write(self.HEADER)
+            self.assertEqual(tail.read(), [])
+
+            self._append(fn, 0, 10)
+            rows = tail.read()
+            self.assertEqual(len(rows), 10)
+            self.assertEqual(rows[3].rlnDefocusU, 10003.0)
+            self.assertEqual(tail.read(), [])
+            self._append(fn, 10, 15)
+            with open(fn, 'a') as f:
+                f.write("000015@particles.mrcs")  # incomplete line
+            self.assertEqual([r.rlnImageName for r in tail.read()][0], '000010@particles.mrcs')
+            self.assertEqual(tail.count, 15)
+            tail.extra['batches'] = 2
+            tail.commit(12)
+
+            # Resume from the checkpoint, file replaced with the same content
+            with open(fn) as f:
+                content = f.read()
+            os.remove(fn)
+            with open(fn, 'w') as f:
+                f.write(content + " 10015.0\n")
+            tail2 = StarTail(fn, 'particles', checkpoint=checkpoint)
+            self.assertEqual(tail2.extra['batches'], 2)
+            rows = tail2.read()
+            self.assertEqual([r.rlnImageName for r in rows],
+                             [f'{i:06}@particles.mrcs' for i in range(12, 16)])
+            self.assertEqual(tail2.resets, 0)
+
+            # A different file is read from the start
+            with open(fn, 'w') as f:
+                f.write(self.HEADER)
+            self._append(fn, 100, 103)
+            self.assertEqual(len(tail2.read()), 3)
+            self.assertEqual(tail2.resets, 1)
+
+
+class TestColumnTable(unittest.TestCase):
+    STAR = """
+data_optics
+
+loop_
+_rlnOpticsGroupName #1
+_rlnOpticsGroup #2
+opticsGroup1 1
+opticsGroup2 2
+
+data_particles
+
+loop_
+_rlnImageName #1
+_rlnOpticsGroup #2
+_rlnClassNumber #3
+"""
+
+    def _write(self, fn, n):
+        with open(fn, 'w') as f:
+            f.write(self.STAR)
+            for i in range(n):
+                f.write(f"{i:06}@Particles/mic{i % 3}.mrcs {i % 2 + 1} {i % 5 + 1}\n")
+
+    def test_read_select_write(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'particles.star')
+            self._write(fn, 100)
+            tables = ColumnTable.readAll(fn)
+            self.assertEqual(list(tables.keys()), ['optics', 'particles'])
+            particles = tables['particles']
+            self.assertEqual(len(particles), 100)
+            self.assertEqual(len(particles.unique('rlnClassNumber')), 5)
+
+            subset = particles.select(particles.isin('rlnClassNumber', [1, 2]))
+            self.assertEqual(len(subset), 40)
+            self.assertEqual(subset.where('rlnClassNumber', lambda v: v == '3').sum(), 0)
+
+            subset.mapValues('rlnImageName', lambda v: os.path.join('Job', v))
+            merged = subset.concat(particles.select(slice(0, 10)))
+            self.assertEqual(len(merged), 50)
+
+            outFn = os.path.join(tmp, 'subset.star')
+            with open(outFn, 'w') as f:
+                tables['optics'].write(f, 'optics')
+                merged.write(f, 'particles')
+
+            particles2 = ColumnTable.read(outFn, 'particles')
+            self.assertEqual(particles2.getColumnNames(), particles.getColumnNames())
+            self.assertEqual(list(particles2['rlnImageName']), list(merged['rlnImageName']))
+            self.assertEqual(particles2.row(0)['rlnImageName'], 'Job/000000@Particles/mic0.mrcs')
+            self.assertEqual(particles2.numeric('rlnClassNumber', int).max(), 5)
+            self.assertEqual(len(ColumnTable.read(outFn, 'optics')), 2)
+
+    def test_chunks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'particles.star')
+            self._write(fn, 100)
+            with open(fn, 'a') as f:
+                f.write('\ndata_extra\n\nloop_\n_rlnText #1\n_rlnValue #2\n'
+                        '"a b" 1\n# comment\nc 2\n')
+            tables = ColumnTable.parseFile(fn)
+            # Chunks smaller than a row give the same tables
+            small = ColumnTable.parseFile(fn, chunkSize=7)
+            self.assertEqual(list(small.keys()), ['optics', 'particles', 'extra'])
+            for name, table in tables.items():
+                for col in table.getColumnNames():
+                    self.assertEqual(list(small[name][col]), list(table[col]))
+            self.assertEqual(list(tables['extra']['rlnText']), ['"a b"', 'c'])
+            # Numbers and values different per row are not dictionary-encoded
+            particles = tables['particles']
+            self.assertIsNone(particles._columns['rlnImageName'][1])
+            self.assertIsNone(particles._columns['rlnClassNumber'][1])
+            names = ColumnTable.fromValues(['rlnMicrographName'], [['a'], ['a'], ['b'], ['a']])
+            self.assertIsNotNone(names._columns['rlnMicrographName'][1])
+            self.assertEqual(list(names.unique('rlnMicrographName')), ['a', 'b'])
+
+    def test_memory(self):
+        """ Peak memory to read a table is lower than with StarFile. """
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'particles.star')
+            with open(fn, 'w') as f:
+                f.write("data_particles\n\nloop_\n_rlnImageName #1\n_rlnMicrographName #2\n"
+                        "_rlnCoordinateX #3\n_rlnCoordinateY #4\n_rlnDefocusU #5\n"
+                        "_rlnAnglePsi #6\n_rlnClassNumber #7\n")
+                for i in range(50000):
+                    f.write(f"{i % 200 + 1:06}@Particles/mic{i // 200}.mrcs mic{i // 200}.mrc "
+                            f"{i * 1.5:.2f} {i * 2.5:.2f} {i * 3.7:.6f} {i % 360:.6f} {i % 50 + 1}\n")
+
+            def _peak(func):
+                tracemalloc.start()
+                try:
+                    n = len(func())
+                    return n, tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+
+            def _rows():
+                with StarFile(fn) as sf:
+                    return sf.getTable('particles')
+
+            n1, colPeak = _peak(lambda: ColumnTable.read(fn, 'particles', cache=False))
+            n2, rowPeak = _peak(_rows)
+            self.assertEqual(n1, n2)
+            self.assertLess(colPeak, rowPeak / 2)
+
+
+class TestStarCache(unittest.TestCase):
+    def test_sidecar(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'particles.star')
+            TestColumnTable()._write(fn, 50)
+            cache = StarCache()
+            self.assertIsNone(cache.load(fn))
+
+            tables = ColumnTable.readAll(fn, cache=True)
+            self.assertTrue(os.path.exists(cache.path(fn)))
+            cached = cache.load(fn)
+            self.assertEqual(list(cached.keys()), ['optics', 'particles'])
+            self.assertEqual(list(cached['particles']['rlnImageName']),
+                             list(tables['particles']['rlnImageName']))
+
+            table = cached['particles'].toTable()
+            self.assertEqual(len(table), 50)
+            self.assertEqual(table[7].rlnClassNumber, 3)
+            self.assertEqual(table[7].rlnImageName, '000007@Particles/mic1.mrcs')
+
+            # The sidecar is outdated when the file changes
+            with open(fn, 'a') as f:
+                f.write("000050@Particles/mic2.mrcs 1 1\n")
+            self.assertIsNone(cache.load(fn))
+            self.assertTrue(cache.warm(fn))
+            self.assertEqual(len(cache.load(fn)['particles']), 51)
+            self.assertFalse(cache.warm(fn))
+
+            self.assertTrue(cache.purge(fn))
+            self.assertFalse(os.path.exists(cache.path(fn)))
+
+    def test_growing_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'particles.star')
+            TestColumnTable()._write(fn, 50)
+            cache = StarCache()
+            key = cache._key(fn)
+            tables = ColumnTable.parseFile(fn)
+            # A row is appended after parsing, the old content is not cached
+            time.sleep(0.01)
+            with open(fn, 'a') as f:
+                f.write("000050@Particles/mic2.mrcs 1 1\n")
+            self.assertFalse(cache.save(fn, tables, key))
+            self.assertIsNone(cache.load(fn))
+            self.assertEqual(len(cache.getTables(fn)['particles']), 51)
+
+
+class TestProjectIndex(unittest.TestCase):
+    class Job(dict):
+        def __init__(self, jobId, outputs=(), **kwargs):
+            dict.__init__(self, **kwargs)
+            self.id = jobId
+            self.outputs = [type('Data', (), {'id': o}) for o in outputs]
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = os.path.join(tmp, 'default_pipeline.star')
+            with open(pipeline, 'w') as f:
+                f.write('data_pipeline_general\n')
+            jobs = [self.Job('Import/job001', ['Import/job001/movies.star'],
+                             jobtype='import', status='Succeeded'),
+                    self.Job('External/job002', jobtype='motioncor', status='Running')]
+            workflow = type('Workflow', (), {'jobs': lambda self: jobs})()
+
+            index = ProjectIndex(tmp)
+            self.assertIsNone(index.jobs(pipeline))
+            index.setJobs(pipeline, workflow)
+            rows = index.jobs(pipeline)
+            self.assertEqual([r['id'] for r in rows], ['Import/job001', 'External/job002'])
+            self.assertEqual(rows[0]['outputs'], ['Import/job001/movies.star'])
+
+            # Files are only loaded again after they change
+            jobStar = os.path.join(tmp, 'job.star')
+            with open(jobStar, 'w') as f:
+                f.write('a')
+            loads = []
+
+            def _load():
+                loads.append(1)
+                return {'input': 'Import/job001/movies.star'}
+
+            for _ in range(3):
+                params = index.cached('params', 'External/job002', [jobStar], _load)
+            self.assertEqual(params['input'], 'Import/job001/movies.star')
+            self.assertEqual(len(loads), 1)
+            with open(jobStar, 'a') as f:
+                f.write('bc')
+            index.cached('params', 'External/job002', [jobStar], _load)
+            self.assertEqual(len(loads), 2)
+
+            index.setInputs('External/job002', [('input', 'Import/job001/movies.star',
+                                                 'Import/job001')])
+            self.assertEqual(len(index.inputs('External/job002')), 1)
+            index.deleteJob('Import/job001')
+            self.assertEqual(index.inputs(), [])
+
+            # The index is outdated when the pipeline changes
+            with open(pipeline, 'a') as f:
+                f.write('\n')
+            self.assertIsNone(ProjectIndex(tmp).jobs(pipeline))
+            index.close()
+
+
+class TestJobStatusTracker(unittest.TestCase):
+    STATUS_FILES = {
+        'RELION_JOB_RUNNING': 'Running',
+        'RELION_JOB_EXIT_SUCCESS': 'Succeeded',
+        'RELION_JOB_EXIT_FAILURE': 'Failed'
+    }
+
+    def _touch(self, *parts):
+        fn = os.path.join(*parts)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        open(fn, 'w').close()
+
+    def test_refresh(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for jobId in ['External/job001', 'External/job002', 'External/job003']:
+                os.makedirs(os.path.join(tmp, jobId))
+            self._touch(tmp, 'External/job001', 'RELION_JOB_RUNNING')
+            # job002 and job003 were submitted, only 101 is still in the queue
+            for jobId, queueId in [('External/job002', '101'), ('External/job003', '102')]:
+                with open(os.path.join(tmp, jobId, 'job.id'), 'w') as f:
+                    f.write(queueId)
+            queue = {'name': 'test', 'status': 'echo 101 RUN'}
+
+            tracker = JobStatusTracker(tmp, self.STATUS_FILES, 'RELION_JOB_EXIT_FAILURE',
+                                       getQueue=lambda jobId: queue,
+                                       backend='poll', log=lambda msg: None)
+            active = {'External/job001': 'Launched',
+                      'External/job002': 'Running',
+                      'External/job003': 'Running'}
+            failedFile = os.path.join(tmp, 'External/job003', 'RELION_JOB_EXIT_FAILURE')
+            # job003 is only failed if it is still missing in the next queue check
+            self.assertEqual(tracker.refresh(active), {'External/job001': 'Running'})
+            self.assertFalse(os.path.exists(failedFile))
+            tracker._lastQueueCheck = 0
+            active['External/job001'] = 'Running'
+            self.assertEqual(tracker.refresh(active), {'External/job003': 'Failed'})
+            self.assertTrue(os.path.exists(failedFile))
+
+            # Only changes of status files are reported until the next queue check
+            active = {'External/job001': 'Running', 'External/job002': 'Running'}
+            self.assertEqual(tracker.refresh(active), {})
+            self._touch(tmp, 'External/job001', 'RELION_JOB_EXIT_SUCCESS')
+            self.assertEqual(tracker.refresh(active), {'External/job001': 'Succeeded'})
+            tracker.close()
+
+    def test_query_queue(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tracker = JobStatusTracker(tmp, self.STATUS_FILES, 'RELION_JOB_EXIT_FAILURE',
+                                       backend='poll', log=lambda msg: None)
+            # Purged jobs are reported as errors by bjobs/squeue
+            for error in ['Job <101> is not found',
+                          'slurm_load_jobs error: Invalid job id specified']:
+                queue = {'status': f'sh -c "echo \'{error}\' >&2; exit 1"'}
+                self.assertEqual(tracker._queryQueue(queue, ['101']), {})
+            queue = {'status': 'sh -c "echo 102 RUN; echo \'Job <101> is not found\' >&2; exit 1"'}
+            self.assertEqual(tracker._queryQueue(queue, ['101', '102']), {'102': 'RUN'})
+            # Any other error is a failure of the command
+            queue = {'status': 'sh -c "echo \'Connection refused\' >&2; exit 1"'}
+            self.assertIsNone(tracker._queryQueue(queue, ['101']))
+            self.assertIsNone(tracker._queryQueue({'status': 'false'}, ['101']))
+            tracker.close()
+
+
+class TestQueueDirectives(unittest.TestCase):
+    def test_directives(self):
+        lsf = {'name': 'cpu', 'submit': 'lsf_submit.sh {job_script}'}
+        slurm = {'name': 'gpu', 'type': 'slurm', 'submit': 'submit.sh {job_script}'}
+        self.assertEqual(_queue_directives(lsf, ['10', '11[2]'], arraySize=3, name='emw_x'),
+                         ['#BSUB -w "done(10) && done(11[2])"', '#BSUB -J "emw_x[1-3]"'])
+        self.assertEqual(_queue_directives(slurm, ['10', '11_2']),
+                         ['#SBATCH --dependency=afterok:10:11_2',
+                          '#SBATCH --kill-on-invalid-dep=yes'])
+        self.assertEqual(_queue_directives(slurm), [])
+
+        script = "#!/bin/bash\n#SBATCH --nodes=1\n\nrun"
+        self.assertEqual(_add_directives(script, ['#SBATCH --array=1-2']),
+                         "#!/bin/bash\n#SBATCH --array=1-2\n#SBATCH --nodes=1\n\nrun")
+        self.assertEqual(_add_directives(script, []), script)
+
+
+class TestGpuLeaseManager(unittest.TestCase):
+    def test_lease(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            manager = GpuLeaseManager(tmp, gpus=[0, 1, 2])
+            lease1, gpus1 = manager.acquire(2, owner='Class2D/job002')
+            self.assertEqual(gpus1, [0, 1])
+            self.assertRaises(Exception, manager.acquire, 4)
+            self.assertRaises(Exception, manager.acquire, 2, timeout=0, wait=0)
+
+            # A waiting request with higher priority gets the next free GPUs
+            with manager._state() as state:
+                state['waiting']['other'] = {'owner': 'External/job003', 'pid': os.getpid(),
+                                             'n': 1, 'priority': 10, 'time': time.time()}
+            self.assertRaises(Exception, manager.acquire, 1, timeout=0, wait=0)
+            with manager._state() as state:
+                self.assertEqual(manager._grant(state, 'other'), [2])
+
+            (host, state), = manager.status()
+            self.assertEqual(len(state['leases']), 2)
+            self.assertEqual(state['waiting'], {})
+
+            # Leases are released explicitly or when the process is gone
+            manager.release(lease1)
+            with manager._state() as state:
+                state['leases']['other']['pid'] = 2 ** 22 + 1
+            self.assertEqual(manager.status(), [])
+            self.assertEqual(manager.acquire(3)[1], [0, 1, 2])
+
+
+class TestWorkflowRunner(unittest.TestCase):
+    def test_job_resources(self):
+        self.assertEqual(job_resources({}), (1, 0))
+        self.assertEqual(job_resources({'cpus': '4x8', 'gpus': '2'}), (32, 2))
+        self.assertEqual(job_resources({'cpus': 12, 'gpus': '1 3'}), (12, 2))
+
+
+class TestTransferEngine(unittest.TestCase):
+    def test_move(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src, dst = os.path.join(tmp, 'src'), os.path.join(tmp, 'dst')
+            os.mkdir(src)
+            os.mkdir(dst)
+            data = os.urandom(1024 * 1024)
+            pairs = []
+            for i in range(10):
+                fn = os.path.join(src, f'mic{i}.mrc')
+                with open(fn, 'wb') as f:
+                    f.write(data)
+                pairs.append((fn, os.path.join(dst, f'mic{i}.mrc')))
+            pairs.append((os.path.join(src, 'missing.mrc'), os.path.join(dst, 'missing.mrc')))
+
+            released = []
+            with TransferEngine(streams=3, retries=1, retryDelay=0) as engine:
+                group = engine.submit(pairs)
+                group.add_done_callback(lambda g: released.append(True))
+                errors = group.wait()
+
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(released, [True])
+            self.assertEqual(engine.stats['files'], 10)
+            self.assertEqual(engine.stats['failed'], 1)
+            self.assertEqual(sorted(os.listdir(src)), [])
+            with open(os.path.join(dst, 'mic3.mrc'), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_copy_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src, dst = os.path.join(tmp, 'a.bin'), os.path.join(tmp, 'b.bin')
+            data = os.urandom(3 * 1024 * 1024 + 7)
+            with open(src, 'wb') as f:
+                f.write(data)
+            self.assertEqual(copy_file(src, dst), len(data))
+            with open(dst, 'rb') as f:
+                self.assertEqual(f.read(), data)
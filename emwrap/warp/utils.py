@@ -20,6 +20,8 @@ import glob
 import numpy as np
 import time
 import json
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 
 from emtools.utils import Color, Process, System, Path, FolderManager
 from emtools.jobs import BatchManager, Args
@@ -129,3 +131,105 @@ def load_tomograms_table(tomo_session):
 
     return table
 
+
+CTF_FIELDS = ('Defocus', 'DefocusDelta', 'DefocusAngle')
+
+
+def read_xml_ctf(xmlFile, fields=CTF_FIELDS):
+    """ Read CTF params from a Warp XML file, equivalent to
+    WarpXml(xmlFile).getDict(<root>, 'CTF', 'Param') but only keeping
+    the given fields. The file is parsed incrementally and parsing stops
+    after the top-level CTF element, skipping the (large) grids that follow.
+    """
+    ctf = {}
+    depth = 0
+    inCtf = False
+    for event, elem in ET.iterparse(xmlFile, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2 and elem.tag == 'CTF':
+                inCtf = True
+        else:
+            depth -= 1
+            if inCtf and elem.tag == 'Param' and (name := elem.get('Name')) in fields:
+                ctf[name] = elem.get('Value')
+            elif depth == 1:
+                if inCtf:
+                    break
+                elem.clear()  # Free memory of skipped elements
+    return ctf
+
+
+class WarpCtfIndex:
+    """ On-disk index of CTF values extracted from Warp XML files.
+
+    Values are stored in a JSON file together with the XML modification
+    time, so only new or modified XML files are parsed again (from a pool
+    of processes). Existence and modification times are taken by listing
+    each folder once, instead of stat'ing every file.
+    """
+    def __init__(self, indexFile, fields=CTF_FIELDS, workers=None):
+        self.indexFile = indexFile
+        self.fields = fields
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self._index = {}
+        if os.path.exists(indexFile):
+            try:
+                with open(indexFile) as f:
+                    self._index = json.load(f)
+            except json.JSONDecodeError:
+                self._index = {}
+
+    @staticmethod
+    def list_mtimes(folder):
+        """ Return a dict of file names -> mtime in the given folder. """
+        try:
+            return {e.name: e.stat().st_mtime_ns for e in os.scandir(folder)}
+        except FileNotFoundError:
+            return {}
+
+    def get_many(self, xmlFiles):
+        """ Return a dict xmlFile -> CTF params dict, None for missing files. """
+        mtimes = {}
+        folders = {}
+        for xmlFile in xmlFiles:
+            folder, name = os.path.split(xmlFile)
+            if folder not in folders:
+                folders[folder] = self.list_mtimes(folder)
+            mtimes[xmlFile] = folders[folder].get(name)
+
+        result = {}
+        stale = []
+        for xmlFile, mtime in mtimes.items():
+            if mtime is None:
+                result[xmlFile] = None
+            elif (entry := self._index.get(xmlFile)) and entry[0] == mtime:
+                result[xmlFile] = entry[1]
+            else:
+                stale.append(xmlFile)
+
+        if stale:
+            fieldsList = [self.fields] * len(stale)
+            if len(stale) < 32 or self.workers == 1:
+                values = map(read_xml_ctf, stale, fieldsList)
+                self._update(stale, values, mtimes, result)
+            else:
+                with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    chunksize = max(1, len(stale) // (4 * self.workers))
+                    values = executor.map(read_xml_ctf, stale, fieldsList,
+                                          chunksize=chunksize)
+                    self._update(stale, values, mtimes, result)
+            self.save()
+
+        return result
+
+    def _update(self, xmlFiles, values, mtimes, result):
+        for xmlFile, ctf in zip(xmlFiles, values):
+            self._index[xmlFile] = [mtimes[xmlFile], ctf]
+            result[xmlFile] = ctf
+
+    def save(self):
+        tmpFile = self.indexFile + '.tmp'
+        with open(tmpFile, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmpFile, self.indexFile)
@@ -19,8 +19,8 @@ import os
 from emtools.utils import FolderManager, Path
 from emtools.metadata import StarFile, Table
 from emtools.jobs import Batch, Args
-from emtools.image import Image
-from emwrap.base import ProcessingPipeline
+from emwrap.base import ProcessingPipeline, ImageDims
+from emwrap.base.star_cache import getTableFromFile
 
 
 class WarpBasePipeline(ProcessingPipeline):
@@ -110,7 +110,7 @@ class WarpBasePipeline(ProcessingPipeline):
             gpus = str(gpus).strip()
         else:
             gpus = ''
-        self.gpuList = self.get_gpu_list(gpus) if gpus else []
+        self.gpuList = self.get_gpu_list(gpus, lease=self.gpu_lease) if gpus else []
         self.acq = self.loadAcquisition()
         if gainFile := self.acq.get('gain', None):
             self.gain = os.path.basename(gainFile)
@@ -264,11 +264,11 @@ class WarpBaseTsAlign(WarpBasePipeline):
         """ Load input or output information. """
         first = tsAllTable[0]
         ps = first.rlnTomoTiltSeriesPixelSize
-        tsTable = StarFile.getTableFromFile(first.rlnTomoName, first.rlnTomoTiltSeriesStarFile)
+        tsTable = getTableFromFile(first.rlnTomoName, first.rlnTomoTiltSeriesStarFile)
         N = len(tsAllTable)
         n = len(tsTable)
         movieFn = tsTable[0].rlnMicrographMovieName
-        dim = Image.get_dimensions(movieFn)
+        dim = ImageDims.get_dimensions(movieFn)
         self.log(f"get_dimensions: {dim}")
         x = dim[0]
         y = dim[1]
@@ -281,7 +281,7 @@ class WarpBaseTsAlign(WarpBasePipeline):
     def runBatch(self, batch, importInputs=True, **kwargs):
         # Input run folder from the Motion correction and CTF job
         inputTs = kwargs['inputTs']
-        tsAllTable = StarFile.getTableFromFile('global', inputTs)
+        tsAllTable = getTableFromFile('global', inputTs)
         N, x, y, n, ps = self._getInfo(tsAllTable)
 
         # FIXME: Remove input information, it should be taken from the output of the previous step
@@ -344,7 +344,7 @@ class WarpBaseTsAlign(WarpBasePipeline):
 
         batch.mkdir('tilt_series')
         self.log("Registering output STAR files.")
-        tsAllTable = StarFile.getTableFromFile('global', self.inputTs)
+        tsAllTable = getTableFromFile('global', self.inputTs)
 
         newTsStarFile = batch.join('tilt_series_aln.star')
         failedStarFile = batch.join('tilt_series_failed.star')
@@ -352,18 +352,23 @@ class WarpBaseTsAlign(WarpBasePipeline):
         newTsAllTable = Table(tsAllTable.getColumnNames() + ['rlnTiltSeriesAligned'])
         failedTable = Table(newTsAllTable.getColumnNames())
 
+        def _aligned(tsName):
+            return self.join(self.TS, 'tiltstack', tsName, f"{tsName}_aligned.mrc")
+
+        # Read all headers in parallel, missing files will have None dims
+        allDims = ImageDims.get_dimensions_many(_aligned(row.rlnTomoName) for row in tsAllTable)
+
         dims = 0, 0, 0
         for tsRow in tsAllTable:
             tsName = tsRow.rlnTomoName
             # FIXME: The proper star files for each aligned TS needs to be generated
             tsStarFile = self.join('tilt_series', tsName + '.star')
-            tsAligned = self.join(self.TS, 'tiltstack', tsName, f"{tsName}_aligned.mrc")
-            if not os.path.exists(tsAligned):
+            tsAligned = _aligned(tsName)
+            if (newDims := allDims[tsAligned]) is None:
                 self.log(f"ERROR: Missing expected aligned TS: {tsAligned}")
                 tsAligned = "None"  # FIXME Handle missing aligned TS
                 table = failedTable
             else:
-                newDims = Image.get_dimensions(tsAligned)
                 if newDims[2] > dims[2]:
                     dims = newDims
                 table = newTsAllTable
@@ -20,9 +20,10 @@ from datetime import datetime
 
 from emtools.utils import Color, FolderManager, Path, Process
 from emtools.jobs import Batch, Args
-from emtools.metadata import StarFile, Table, WarpXml
-from emtools.image import Image
+from emtools.metadata import Table, WarpXml
 
+from emwrap.base import ImageDims
+from emwrap.base.star_cache import getTableFromFile
 from .warp import WarpBasePipeline
 
 
@@ -34,10 +35,10 @@ class WarpCtfReconstruct(WarpBasePipeline):
     def runBatch(self, batch, **kwargs):
         inputTs = kwargs['inputTs']
         inputFolder = FolderManager(os.path.dirname(inputTs))
-        tsAllTable = StarFile.getTableFromFile('global', inputTs)
+        tsAllTable = getTableFromFile('global', inputTs)
         N = len(tsAllTable)
         ps = tsAllTable[0].rlnTomoTiltSeriesPixelSize
-        x, y, n = Image.get_dimensions(tsAllTable[0].rlnTiltSeriesAligned)
+        x, y, n = ImageDims.get_dimensions(tsAllTable[0].rlnTiltSeriesAligned)
 
         if kwargs.get('importInputs', True):
             self._importInputs(inputFolder)
@@ -75,7 +76,7 @@ class WarpCtfReconstruct(WarpBasePipeline):
             return round(float(v), 3)
 
         self.log("Registering output STAR files.")
-        tsAllTable = StarFile.getTableFromFile('global', self.inputTs)
+        tsAllTable = getTableFromFile('global', self.inputTs)
 
         newTsStarFile = batch.join('tomograms.star')
 
@@ -115,7 +116,7 @@ class WarpCtfReconstruct(WarpBasePipeline):
             if tomoFile := tomoDict.get(tsName, ''):
                 t, te, to = _rec(tomoFile), _rec('even', tomoFile), _rec('odd', tomoFile)
                 if dims is None:
-                    dims = Image.get_dimensions(t)
+                    dims = ImageDims.get_dimensions(t)
                     bin = _float(newPs / tsDict['rlnTomoTiltSeriesPixelSize'])
             else:
                 t, te, to = '', '', ''
@@ -17,8 +17,9 @@
 import os
 
 from emtools.jobs import Args
-from emtools.metadata import StarFile, Table
+from emtools.metadata import Table
 from emwrap.base import ProcessingPipeline
+from emwrap.base.star_cache import getTableFromFile
 
 from .warp import WarpBaseTsAlign
 
@@ -50,7 +51,7 @@ class WarpEtomoPatches(WarpBaseTsAlign):
         # Generate aligned TS using IMOD's newstack
         imod_launcher = ProcessingPipeline.get_launcher('IMOD')
 
-        tsAllTable = StarFile.getTableFromFile('global', self.inputTs)
+        tsAllTable = getTableFromFile('global', self.inputTs)
 
         def _tsFile(tsName, suffix):
             # Paths relative to the job directory, since will be executed from the batch there
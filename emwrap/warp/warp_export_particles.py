@@ -28,6 +28,8 @@ from emtools.metadata import StarFile, Acquisition, Table
 from emtools.jobs import Batch, Args
 from emtools.image import Image
 
+from emwrap.base.star_columns import ColumnTable
+from emwrap.base.star_cache import getTableFromFile
 
 from .warp import WarpBasePipeline
 
@@ -39,7 +41,7 @@ class WarpExportParticles(WarpBasePipeline):
     def prerun(self):
         inTomoStar = self._args['input_tomograms']
 
-        inTable = StarFile.getTableFromFile('global', inTomoStar)
+        inTable = getTableFromFile('global', inTomoStar)
         firstRow = inTable[0]
         columns = inTable.getColumnNames()
 
@@ -178,26 +180,16 @@ class WarpExportParticles(WarpBasePipeline):
         """ Add the run folder to the star file paths. """
         starFnOut = starFn.replace('.star', '_fixed.star')
         # Iterate over all tables and fix paths for the selected one
-        with StarFile(starFn) as sf:
-            with StarFile(starFnOut, 'w') as sfOut:
-                sfOut.writeTimeStamp()
-                tableNames = sf.getTableNames()
-                for tn in tableNames:
-                    table = sf.getTable(tn, guessType=False)
-
-                    if tn == tableName:
-                        newTable = table.cloneColumns()
-                        for row in table:
-                            rowDict = row._asdict()
-                            for label in labels:
-                                if label in rowDict:
-                                    rowDict[label] = self.join(rowDict[label])
-                            newTable.addRowValues(**rowDict)
-                    else:
-                        newTable = table
-
-                    singleRow = len(newTable) == 1
-                    sfOut.writeTable(tn, newTable, computeFormat='right', singleRow=singleRow)
+        with StarFile(starFnOut, 'w') as sfOut:
+            sfOut.writeTimeStamp()
+            for tn, table in ColumnTable.readAll(starFn).items():
+                if tn == tableName:
+                    for label in labels:
+                        if label in table:
+                            # Only unique values are joined, not every row
+                            table.mapValues(label, self.join)
+                table.singleRow = len(table) == 1
+                table.write(sfOut, tn)
         # Override input star file
         shutil.move(starFnOut, starFn)
 
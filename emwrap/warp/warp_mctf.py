@@ -14,17 +14,18 @@
 # *
 # **************************************************************************
 
-import os
 from glob import glob
 from datetime import datetime
 from collections import defaultdict
 
 from emtools.utils import FolderManager, Path
 from emtools.jobs import Args
-from emtools.metadata import StarFile, Table, WarpXml
-from emtools.image import Image
+from emtools.metadata import Table, WarpXml
 
+from emwrap.base import ImageDims
+from emwrap.base.star_cache import getTableFromFile
 from .warp import WarpBasePipeline
+from .utils import WarpCtfIndex
 
 
 class WarpMotionCtf(WarpBasePipeline):
@@ -65,12 +66,12 @@ class WarpMotionCtf(WarpBasePipeline):
 
         # Input movies pattern for the frame series
         inputTsStar = kwargs['inputTs']
-        tsAllTable = StarFile.getTableFromFile('global', inputTsStar)
+        tsAllTable = getTableFromFile('global', inputTsStar)
 
         for tsRow in tsAllTable:
             tsName = tsRow.rlnTomoName
             ps = tsRow.rlnMicrographOriginalPixelSize
-            tsTable = StarFile.getTableFromFile(tsName, tsRow.rlnTomoTiltSeriesStarFile)
+            tsTable = getTableFromFile(tsName, tsRow.rlnTomoTiltSeriesStarFile)
             mdocsFm.link(tsRow.rlnMdocFile)
             N = len(tsTable)
             for frameRow in tsTable:
@@ -78,7 +79,7 @@ class WarpMotionCtf(WarpBasePipeline):
                 # Calculate extension only once
                 if ext is None:
                     ext = Path.getExt(frameBase)
-                    dims = Image.get_dimensions(frameRow.rlnMicrographMovieName)
+                    dims = ImageDims.get_dimensions(frameRow.rlnMicrographMovieName)
 
         x, y, n = dims
         # FIXME: Remove input information, it should be taken from the output of the previous step
@@ -188,7 +189,7 @@ class WarpMotionCtf(WarpBasePipeline):
 
         batch.mkdir('tilt_series')
         self.log("Registering output STAR files.")
-        tsAllTable = StarFile.getTableFromFile('global', self.inputTs)
+        tsAllTable = getTableFromFile('global', self.inputTs)
 
         newTsStarFile = batch.join('tilt_series_ctf.star')
         failedStarFile = batch.join('tilt_series_failed.star')
@@ -200,6 +201,23 @@ class WarpMotionCtf(WarpBasePipeline):
         newTsAllTable = Table(tsAllTable.getColumnNames() + [newPsLabel])
         failedTable = Table(newTsAllTable.getColumnNames())
 
+        # Read all TS tables first, to check files and extract CTF values at once
+        tsTables = {row.rlnTomoName: getTableFromFile(row.rlnTomoName,
+                                                      row.rlnTomoTiltSeriesStarFile)
+                    for row in tsAllTable}
+
+        def _prefix(frameRow):
+            return Path.removeBaseExt(frameRow.rlnMicrographMovieName)
+
+        def _xml(moviePrefix):
+            return batch.join(self.FS, moviePrefix + '.xml')
+
+        averages = WarpCtfIndex.list_mtimes(batch.join(self.FS, 'average'))
+        ctfIndex = WarpCtfIndex(batch.join('ctf_index.json'))
+        allCtf = ctfIndex.get_many(_xml(_prefix(frameRow))
+                                   for tsTable in tsTables.values()
+                                   for frameRow in tsTable)
+
         for tsRow in tsAllTable:
             tsName = tsRow.rlnTomoName
             tsStarFile = self.join('tilt_series', tsName + '.star')
@@ -207,21 +225,21 @@ class WarpMotionCtf(WarpBasePipeline):
             if newPs is None:
                 newPs = self.targetPs(ps)
 
-            tsTable = StarFile.getTableFromFile(tsName, tsRow.rlnTomoTiltSeriesStarFile)
+            tsTable = tsTables[tsName]
             n = len(tsTable)
 
             # Each input movie must have xml + average mrc (same idea as WarpAreTomo
             # requiring aligned stack per TS). Collect missing before building output.
             missing = []
             for frameRow in tsTable:
-                moviePrefix = Path.removeBaseExt(frameRow.rlnMicrographMovieName)
+                moviePrefix = _prefix(frameRow)
                 movieMrc = moviePrefix + '.mrc'
-                movieXml = batch.join(self.FS, moviePrefix + '.xml')
-                movieAvgMrc = batch.join(self.FS, 'average', movieMrc)
-                if not os.path.exists(movieXml):
+                movieXml = _xml(moviePrefix)
+                if allCtf[movieXml] is None:
                     missing.append((moviePrefix, 'xml', movieXml))
-                if not os.path.exists(movieAvgMrc):
-                    missing.append((moviePrefix, 'average mrc', movieAvgMrc))
+                if movieMrc not in averages:
+                    missing.append((moviePrefix, 'average mrc',
+                                    batch.join(self.FS, 'average', movieMrc)))
 
             tsDict = tsRow._asdict()
             tsDict.update({
@@ -261,14 +279,13 @@ class WarpMotionCtf(WarpBasePipeline):
                 frameDict['rlnMicrographMetadata'] = "None"
 
                 avgMrcPath = frameDict['rlnMicrographName']
-                if dims is None and os.path.exists(avgMrcPath):
-                    dims = Image.get_dimensions(avgMrcPath)
+                if dims is None:
+                    dims = ImageDims.get_dimensions(avgMrcPath)
 
-                movieXml = batch.join(self.FS, moviePrefix + '.xml')
                 defocusDict = defaultdict(lambda: 0)
 
                 # xml and average mrc already validated for whole TS above
-                ctf = WarpXml(movieXml).getDict('Movie', 'CTF', 'Param')
+                ctf = allCtf[_xml(moviePrefix)]
                 defocusDict['rlnDefocusU'] = _float(ctf['Defocus'])
                 defocusDict['rlnCtfAstigmatism'] = _float(ctf['DefocusDelta'])
                 defocusDict['rlnDefocusV'] = _float(defocusDict['rlnDefocusU'] + defocusDict['rlnCtfAstigmatism'])
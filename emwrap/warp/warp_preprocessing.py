@@ -115,19 +115,13 @@ class WarpPreprocessing(WarpBasePipeline):
         batchMgr = MdocBatchManager(self._args['mdocs'], self.tmpDir,
                                     moviesPath=self._args['in_movies'])
         g = self.addGenerator(batchMgr.generate, queueMaxSize=4)
-        outputQueue = None
 
         # Create output folders
         for d in self.WARP_FOLDERS:
             self.mkdir(d)
 
-        self.log(f"Creating {len(self.gpuList)} processing threads.", flush=True)
-
-        for gpu in self.gpuList:
-            p = self.addProcessor(g.outputQueue,
-                                  self.get_preprocessing_proc(gpu),
-                                  outputQueue=outputQueue)
-            outputQueue = p.outputQueue
+        outputQueue = self.addGpuProcessors(g.outputQueue,
+                                            self.get_preprocessing_proc)
 
         self.addProcessor(outputQueue, self._output)
 
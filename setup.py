@@ -72,7 +72,8 @@ setup(
            'emw-import-movies = emwrap.base.import_movies:main',
            'emw-mc-tomo = emwrap.motioncor.mcpipeline_tomo:main',
            'emw = emwrap.base:ProjectManager.main',
-           'emw-config = emwrap.base:ProcessingConfig.main'
+           'emw-config = emwrap.base:ProcessingConfig.main',
+           'emw-star-cache = emwrap.base.star_cache:main'
        ],
 
     }